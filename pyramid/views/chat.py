@@ -2,32 +2,233 @@
 
 """Allow web visitors to chat with local users logged into a Jabber server"""
 
+import math
+import time
+
+from pyramid.response import Response
 from pyramid.security import authenticated_userid
 from seshat import client
 
+# The longest a visitor's browser may ask recvmessage to wait for a
+# message, in seconds, unless seshat_longpolltimeout says otherwise.
+# The chat window asks for this long.
+LONGPOLLTIMEOUT = 30
+
+# How long streammessages keeps a connection open, in seconds, before
+# letting the browser reconnect, unless seshat_streamtimeout says
+# otherwise
+STREAMTIMEOUT = 300
+
+# Whether chat windows use streammessages instead of polling, unless
+# seshat_streaming says otherwise. Each open stream ties up one of the
+# web server's threads, so it's off unless the server has enough.
+STREAMING = False
+
+# How often streammessages sends something on an idle connection, in
+# seconds, so that proxies don't close it
+STREAMKEEPALIVE = 15
+
 def getseshatvalues(request):
-    """Return a configured Seshat client and the username of the visitor"""
+    """Return a configured Seshat client and the username of the visitor
+
+    The client is borrowed from the process's shared pool and returned
+    to it when the request is finished."""
     user = authenticated_userid(request)
-    return (client.SeshatClient(request.registry.settings['seshat_sqlitedb']),
+    pool = client.getpool(request.registry.settings)
+    seshatclient = pool.get()
+    request.add_finished_callback(lambda request: pool.release(seshatclient))
+    return (seshatclient,
             user if user is not None else 'Anonymous')
 
+def getadmissionkey(request):
+    """Return what to tell visitors apart by when limiting how fast
+    they chat: None (their username) if they're logged in, or else
+    their browser's address, since every anonymous visitor shares the
+    username "Anonymous"."""
+    if authenticated_userid(request) is not None:
+        return None
+    return request.client_addr
+
+def toomanyrequests(error):
+    """Return a 429 response asking the browser to wait as long as the
+    AdmissionError says before trying again"""
+    retryafter = int(math.ceil(error.retryafter))
+    response = Response('%s. Please try again in %d seconds.' % (error, retryafter), status='429 Too Many Requests', content_type='text/plain')
+    response.headers['Retry-After'] = str(retryafter)
+    return response
+
+def getlastmessageid(request, lasteventid=None):
+    """Return the messageid the browser last saw, from lasteventid if
+    given or else the 'after' parameter, or None if it isn't a
+    messageid"""
+    if not lasteventid:
+        lasteventid = request.params.get('after', 0)
+    try:
+        lastmessageid = int(lasteventid)
+    except (TypeError, ValueError):
+        return None
+    if lastmessageid < 0:
+        return None
+    return lastmessageid
+
+def badmessageid():
+    """Return a 400 response for a request whose last-seen messageid
+    can't be understood"""
+    return Response('The last message ID must be a whole number.', status='400 Bad Request', content_type='text/plain')
+
+def getlongpolltimeout(request):
+    """Return the longest the recvmessage views may hold a request open
+    waiting for a message, in seconds"""
+    return float(request.registry.settings.get('seshat_longpolltimeout', LONGPOLLTIMEOUT))
+
+def getwait(request):
+    """Return how long the browser asked, in the 'wait' parameter, for
+    a recvmessage view to wait for a message, up to the longest they
+    may (see: getlongpolltimeout), or None if it isn't a number of
+    seconds"""
+    try:
+        wait = float(request.params.get('wait', 0))
+    except (TypeError, ValueError):
+        return None
+    # Also rules out NaN
+    if not wait >= 0:
+        return None
+    return min(wait, getlongpolltimeout(request))
+
+def badwait():
+    """Return a 400 response for a request whose wait can't be
+    understood"""
+    return Response('The wait must be a number of seconds.', status='400 Bad Request', content_type='text/plain')
+
+def isstreaming(request):
+    """Return True if chat windows should stream their messages with
+    streammessages"""
+    return str(request.registry.settings.get('seshat_streaming', STREAMING)).strip().lower() in ('true', 'yes', 'on', '1')
+
 def chat(request):
     """Get a new chatid and open the chat window"""
     message = 'Coming from page %s' % request.referer if request.referer is not None else None
     seshatclient, user = getseshatvalues(request)
-    return {'chatid': seshatclient.startchat(user, message)}
+    try:
+        return {'chatid': seshatclient.startchat(user, message, getadmissionkey(request)),
+                'streaming': 'true' if isstreaming(request) else 'false',
+                'wait': getlongpolltimeout(request)}
+    except client.AdmissionError, error:
+        return toomanyrequests(error)
 
 def recvmessage(request):
-    """Poll the server for the first queued message in this chat"""
+    """Poll the server for the first queued message in this chat. If
+    the 'wait' parameter is given, hold the request open for up to that
+    many seconds until a message arrives."""
     chatid = int(request.matchdict['chatid'])
+    wait = getwait(request)
+    if wait is None:
+        return badwait()
     seshatclient, user = getseshatvalues(request)
-    message = seshatclient.getmessage(chatid, user)
+    message = seshatclient.getmessage(chatid, user, wait)
     if message is None:
         return ''
     return message
 
+def recvmessages(request):
+    """Poll the server for every queued message in this chat. Like
+    recvmessage, the 'wait' parameter holds the request open until at
+    least one message arrives."""
+    chatid = int(request.matchdict['chatid'])
+    wait = getwait(request)
+    if wait is None:
+        return badwait()
+    seshatclient, user = getseshatvalues(request)
+    return seshatclient.getmessages(chatid, user, timeout=wait)
+
+def recvmessagessince(request):
+    """Fetch the messages in this chat after the one whose ID is given
+    in the 'after' parameter. Unlike recvmessages, an idle poll doesn't
+    lock the database. Like recvmessage, the 'wait' parameter holds the
+    request open until at least one message arrives."""
+    chatid = int(request.matchdict['chatid'])
+    lastmessageid = getlastmessageid(request)
+    if lastmessageid is None:
+        return badmessageid()
+    wait = getwait(request)
+    if wait is None:
+        return badwait()
+    seshatclient, user = getseshatvalues(request)
+    messages = seshatclient.getmessagessince(chatid, user, lastmessageid, timeout=wait)
+    if messages:
+        lastmessageid = messages[-1][0]
+    return {'after': lastmessageid,
+            'messages': [message for messageid, message in messages]}
+
+def streammessages(request):
+    """Stream the messages in this chat to the visitor's browser as
+    Server-Sent Events, each tagged with its messageid. A browser that
+    reconnects sends the last one it saw in the Last-Event-ID header
+    (or the 'after' parameter) and picks up where it left off.
+
+    Each open stream ties up one of the web server's threads, but only
+    borrows a Seshat client while it's checking for messages. Streams
+    end once the chat does, and the browser is told not to reconnect
+    with a 204 response, as it is if streaming isn't turned on (see:
+    isstreaming). Chats that don't exist or belong to someone else get
+    a 404."""
+    chatid = int(request.matchdict['chatid'])
+    lastmessageid = getlastmessageid(request, request.headers.get('Last-Event-ID'))
+    if lastmessageid is None:
+        return badmessageid()
+    seshatclient, user = getseshatvalues(request)
+    if not seshatclient.haschat(chatid, user):
+        return Response('There is no such chat.', status='404 Not Found', content_type='text/plain')
+    if not isstreaming(request) or (seshatclient.isfinished(chatid) and not seshatclient.getmessagessince(chatid, user, lastmessageid, 1)):
+        return Response(status='204 No Content')
+    settings = request.registry.settings
+    response = Response(content_type='text/event-stream',
+                        app_iter=_eventstream(settings, chatid, user, lastmessageid,
+                                              float(settings.get('seshat_streamtimeout', STREAMTIMEOUT))))
+    response.cache_control = 'no-cache'
+    # Keep nginx from buffering the events
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def _eventstream(settings, chatid, user, lastmessageid, duration):
+    """Yield the chat's messages after lastmessageid as Server-Sent
+    Events as they arrive, for up to duration seconds or until the chat
+    ends"""
+    pool = client.getpool(settings)
+    deadline = time.time() + duration
+    # Have the browser reconnect right away when the stream ends
+    yield 'retry: 1000\n\n'
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        seshatclient = pool.get()
+        try:
+            # A chat's last messages are queued as it ends, so once
+            # it's ended, anything not read next never will be
+            finished = seshatclient.isfinished(chatid)
+            messages = seshatclient.getmessagessince(chatid, user, lastmessageid, timeout=0 if finished else min(remaining, STREAMKEEPALIVE))
+        finally:
+            pool.release(seshatclient)
+        if not messages:
+            if finished:
+                return
+            yield ': keepalive\n\n'
+            continue
+        events = []
+        for messageid, message in messages:
+            if isinstance(message, unicode):
+                message = message.encode('utf-8')
+            lines = message.splitlines() or ['']
+            events.append('id: %d\n%s\n' % (messageid, ''.join('data: %s\n' % line for line in lines)))
+        lastmessageid = messages[-1][0]
+        yield ''.join(events)
+
 def sendmessage(request):
     """Queue the visitor's message for delivery to the chat's localuser"""
     chatid = int(request.matchdict['chatid'])
     seshatclient, user = getseshatvalues(request)
-    seshatclient.sendmessage(chatid, user, request.params['text'])
+    try:
+        seshatclient.sendmessage(chatid, user, request.params['text'], getadmissionkey(request))
+    except client.AdmissionError, error:
+        return toomanyrequests(error)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""Tests for the chat views, run against an in-memory backend with
+Pyramid and Seshat installed:
+
+    $ cd pyramid/views && python -m unittest test_chat"""
+
+import time
+import unittest
+
+from pyramid import testing
+
+import chat
+
+class ChatViewTest(unittest.TestCase):
+    """Calls the views the way Pyramid would, as an anonymous
+    visitor"""
+
+    def setUp(self):
+        """Give each test its own in-memory store and a chat"""
+        self.settings = {'seshat_backend': 'memory', 'seshat_memorystore': self.id(), 'seshat_longpolltimeout': '0.2'}
+        self.config = testing.setUp(settings=self.settings)
+        self.seshatclient = chat.client.getpool(self.settings).get()
+        self.chatid = self.seshatclient.startchat('Anonymous', 'hello')
+        # Skip the greeting queued by startchat
+        self.seshatclient.getmessages(self.chatid, 'Anonymous')
+
+    def tearDown(self):
+        """Forget the Pyramid configuration"""
+        testing.tearDown()
+
+    def request(self, chatid=None, **params):
+        """Return a request for the chat, with the given parameters"""
+        return testing.DummyRequest(params=params, matchdict={'chatid': str(chatid or self.chatid)})
+
+    def queueremote(self, message):
+        """Queue a message to the visitor"""
+        self.seshatclient.backend._queueremote(self.chatid, message)
+
+    def test_recvmessage(self):
+        """recvmessage returns the first queued message, or an empty
+        string if none arrives in time"""
+        self.assertEqual(chat.recvmessage(self.request()), '')
+        self.queueremote('hi there')
+        self.assertEqual(chat.recvmessage(self.request(wait='1')), 'hi there')
+
+    def test_recvmessages(self):
+        """recvmessages returns every queued message at once"""
+        self.queueremote('one')
+        self.queueremote('two')
+        self.assertEqual(chat.recvmessages(self.request()), ['one', 'two'])
+        self.assertEqual(chat.recvmessages(self.request()), [])
+
+    def test_recvmessagessince(self):
+        """recvmessagessince returns the messages after the one given,
+        and where to pick up next time"""
+        greeting = chat.recvmessagessince(self.request(after='0'))
+        self.queueremote('one')
+        first = chat.recvmessagessince(self.request(after=str(greeting['after'])))
+        self.assertEqual(first['messages'], ['one'])
+        self.queueremote('two')
+        second = chat.recvmessagessince(self.request(after=str(first['after'])))
+        self.assertEqual(second['messages'], ['two'])
+        self.assertEqual(chat.recvmessagessince(self.request(after=str(second['after'])))['messages'], [])
+
+    def test_waitlimit(self):
+        """A long poll gives up after seshat_longpolltimeout, however
+        long the browser asks to wait"""
+        starttime = time.time()
+        self.assertEqual(chat.recvmessages(self.request(wait='600')), [])
+        self.assertTrue(time.time() - starttime < 5)
+
+    def test_badwait(self):
+        """A wait that isn't a number of seconds gets a 400"""
+        for wait in ('abc', '-1', 'nan'):
+            for view in (chat.recvmessage, chat.recvmessages):
+                self.assertEqual(view(self.request(wait=wait)).status_int, 400)
+            self.assertEqual(chat.recvmessagessince(self.request(after='0', wait=wait)).status_int, 400)
+
+    def test_badafter(self):
+        """An after parameter that isn't a messageid gets a 400"""
+        for after in ('abc', '-1'):
+            self.assertEqual(chat.recvmessagessince(self.request(after=after)).status_int, 400)
+
+    def test_unknownchat(self):
+        """Polling a chat that doesn't exist finds nothing"""
+        self.assertEqual(chat.recvmessage(self.request(chatid=self.chatid + 1)), '')
+        self.assertEqual(chat.recvmessages(self.request(chatid=self.chatid + 1)), [])
+
+    def test_stream(self):
+        """streammessages sends each message as an event tagged with
+        its messageid, and ends once the chat has"""
+        self.config.add_settings(seshat_streaming='true')
+        self.queueremote('one')
+        self.queueremote('two\nlines')
+        self.seshatclient.backend._acceptchat(self.chatid, 'joe@example.com')
+        self.seshatclient.endchat(self.chatid)
+        response = chat.streammessages(self.request(after='0'))
+        self.assertEqual(response.content_type, 'text/event-stream')
+        body = ''.join(response.app_iter)
+        self.assertTrue(body.startswith('retry: 1000\n\n'))
+        self.assertTrue('data: one\n' in body)
+        self.assertTrue('data: two\ndata: lines\n' in body)
+        self.assertTrue('data: The chat is now closed.\n' in body)
+        lastmessageid = self.seshatclient.getmessagessince(self.chatid, 'Anonymous')[-1][0]
+        self.assertTrue('id: %d\n' % lastmessageid in body)
+        # Reconnecting after the last message finds nothing more
+        request = testing.DummyRequest(headers={'Last-Event-ID': str(lastmessageid)}, matchdict={'chatid': str(self.chatid)})
+        self.assertEqual(chat.streammessages(request).status_int, 204)
+
+    def test_streamingoff(self):
+        """Browsers are told not to reconnect unless streaming is
+        turned on"""
+        self.assertEqual(chat.streammessages(self.request()).status_int, 204)
+
+    def test_streambadrequests(self):
+        """Bad messageids get a 400, and chats that don't exist or
+        belong to someone else get a 404"""
+        self.config.add_settings(seshat_streaming='true')
+        request = testing.DummyRequest(headers={'Last-Event-ID': 'abc'}, matchdict={'chatid': str(self.chatid)})
+        self.assertEqual(chat.streammessages(request).status_int, 400)
+        self.assertEqual(chat.streammessages(self.request(chatid=self.chatid + 1)).status_int, 404)
+        otherchatid = self.seshatclient.startchat('someone else')
+        self.assertEqual(chat.streammessages(self.request(chatid=otherchatid)).status_int, 404)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright (c) 2011, Daycos
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#     * Neither the name of Daycos nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL
+# <COPYRIGHT HOLDER> BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+"""Defines Seshat's client-server (backend) API
+
+SeshatClient and SeshatServer do all their storage through an object
+implementing the Backend interface below, so they make no assumptions
+about where chats and messages are kept. The implementation is chosen
+by the "backend" setting:
+
+    sqlite - sqlitebackend.SqliteBackend, in the file named by
+             "sqlitedb" (the default)
+    sharded - shardedbackend.ShardedBackend, split across several
+              SQLite databases named after "sqlitedb"
+    memory - memorybackend.MemoryBackend, in the process's memory.
+             Only useful when the web application and broker bot run
+             in the same process, or for benchmarking."""
+
+# The modules and classes implementing each backend, by name. They're
+# imported on demand so that unused backends cost nothing.
+BACKENDS = {
+    'sqlite': ('sqlitebackend', 'SqliteBackend'),
+    'sharded': ('shardedbackend', 'ShardedBackend'),
+    'memory': ('memorybackend', 'MemoryBackend'),
+    }
+
+def getsetting(settings, key, default=None):
+    """Return a value from a dictionary of configuration values, such
+    as the items in an .ini file section or a Pyramid application's
+    settings. Prefer keys named like "seshat_sqlitedb" but fall back to
+    "sqlitedb" so that Seshat settings can be embedded in Pyramid
+    config files with little risk of conflicts."""
+    for name in ('seshat_%s' % key, key):
+        if name in settings:
+            return settings[name]
+    return default
+
+def getbackendclass(settings):
+    """Return the Backend class chosen by the configuration"""
+    name = getsetting(settings, 'backend', 'sqlite')
+    try:
+        modulename, classname = BACKENDS[name]
+    except KeyError:
+        raise ValueError('Unknown Seshat backend: %s' % name)
+    module = __import__(modulename, globals(), locals(), [classname])
+    return getattr(module, classname)
+
+def getbackend(settings, **options):
+    """Return a new instance of the Backend chosen by the
+    configuration. The options are passed to its constructor."""
+    return getbackendclass(settings).fromsettings(settings, **options)
+
+class Availability(object):
+    """A snapshot of how busy the localusers are, published by the
+    broker bot so that clients don't have to work it out"""
+    def __init__(self, availablelocalusers, waitingchats, generation, updatetime):
+        """See: ChatInfo.__init__.__doc__"""
+        self.availablelocalusers = availablelocalusers
+        self.waitingchats = waitingchats
+        self.generation = generation
+        self.updatetime = updatetime
+
+class ChatInfo(object):
+    """A chat's parameters"""
+    def __init__(self, chatid, localuser, remoteuser, starttime, endtime, status, startmessage):
+        """This would be a namedtuple, but those aren't available in
+        all the versions of Python that Pyramid supports and I'd hate
+        to leave someone out over something so trivial."""
+        self.chatid = chatid
+        self.localuser = localuser
+        self.remoteuser = remoteuser
+        self.starttime = starttime
+        self.endtime = endtime
+        self.status = status
+        self.startmessage = startmessage
+
+class QueuedMessage(object):
+    """Everything needed to represent a message that's been stored for
+    delivery to a localuser"""
+    def __init__(self, chatid, localuser, remoteuser, messageid, message, posttime=None):
+        """See: ChatInfo.__init__.__doc__"""
+        self.chatid = chatid
+        self.localuser = localuser
+        self.remoteuser = remoteuser
+        self.messageid = messageid
+        self.message = message
+        self.posttime = posttime
+
+class ChatStatuses(object):
+    """The codes stored in a chat's status"""
+
+    STATUS_WAITING = 0
+    STATUS_NOTIFIED = 1
+    STATUS_OPEN = 2
+    STATUS_CLOSED = 3
+    STATUS_FAILED = 4
+    STATUS_CANCELEDLOCALLY = 5
+
+    # Chats with these statuses will never change again
+    FINALSTATUSES = (STATUS_CLOSED, STATUS_FAILED, STATUS_CANCELEDLOCALLY)
+
+class Backend(ChatStatuses):
+    """The interface that every Seshat backend implements. Each
+    instance is used by one thread at a time."""
+
+    # The setting naming where the backend keeps its data
+    LOCATIONSETTING = None
+
+    # The path of the socket clients use to wake the broker bot, if
+    # any (see: seshat.notify)
+    notifypath = None
+
+    # A name for the data this instance stores, which is the same for
+    # every instance in the process that sees the same data, or None
+    # if the data isn't shared
+    location = None
+
+    # True if the data is kept in the process's memory and lost when
+    # it exits
+    inmemory = False
+
+    @classmethod
+    def fromsettings(cls, settings, **options):
+        """Return an instance configured from a dictionary of
+        settings (see: getsetting)"""
+        return cls(getsetting(settings, cls.LOCATIONSETTING), **options)
+
+    def transaction(self, immediate=False):
+        """Return a context manager that groups every change made
+        inside its "with" block into one atomic unit, committed when
+        the block finishes or discarded if it raises an exception.
+        Transactions nest, and only the outermost one commits. If
+        immediate is True, lock out other writers from the start of
+        the block instead of from its first change."""
+        raise NotImplementedError
+
+    def _abort(self):
+        """Discard any unfinished transaction"""
+        raise NotImplementedError
+
+    def _acceptchat(self, chatid, localuser):
+        """Open a chat and set its localuser to the given value, if
+        it's still waiting to be accepted. Return True if it was,
+        otherwise False."""
+        raise NotImplementedError
+
+    def _archivechats(self, cutoff, batchsize):
+        """Archive up to batchsize closed, failed, or canceled chats
+        that ended before cutoff, along with any of their messages
+        still in the queues. Return the number of chats archived."""
+        raise NotImplementedError
+
+    def _archivemessages(self, cutoff, batchsize):
+        """Archive up to batchsize messages from each queue that were
+        delivered before cutoff. Return the number of messages
+        archived."""
+        raise NotImplementedError
+
+    def _attacharchive(self, archivedb):
+        """Prepare to archive into archivedb"""
+        raise NotImplementedError
+
+    def _claimchatswithstatus(self, status, workerid, leasetime):
+        """Return the (possibly empty) list of ChatInfos for the chats
+        with the given status that no other worker has a current claim
+        on, and claim them for workerid for leasetime seconds. Claims
+        let several broker bots share the work without doing it
+        twice."""
+        raise NotImplementedError
+
+    def _claimqueuedlocalmessages(self, workerid, leasetime):
+        """Return the (possibly empty) list of QueuedMessages waiting
+        for delivery to localusers, oldest first, in chats that no
+        other worker has a current claim on, and claim those chats for
+        workerid for leasetime seconds"""
+        raise NotImplementedError
+
+    def _clearonlineusers(self, workerid):
+        """Remove the cache of online user information kept by
+        workerid, leaving other broker bots' alone"""
+        raise NotImplementedError
+
+    def _close(self):
+        """Release any resources held by the backend"""
+        raise NotImplementedError
+
+    def _closechat(self, chatid, status):
+        """Mark the chat as closed with the given status code"""
+        raise NotImplementedError
+
+    def _countunsentlocalmessages(self, chatid):
+        """Return the number of the chat's messages still waiting to be
+        delivered to its localuser"""
+        raise NotImplementedError
+
+    def _getallqueuedremotemessages(self, chatid, limit=None):
+        """Return the (possibly empty) list of messages queued for a
+        chat, oldest first, and mark them all sent at once"""
+        raise NotImplementedError
+
+    def _getavailabilities(self):
+        """Return the (possibly empty) list of the Availabilities last
+        stored by each broker bot with _setavailability"""
+        raise NotImplementedError
+
+    def _getavailablelocalusers(self):
+        """Return a list of localusers who are currently online from
+        at least one place, but not involved in a chat"""
+        raise NotImplementedError
+
+    def _getchatinfo(self, chatid):
+        """Return the ChatInfo for a chat, or None if it doesn't
+        exist"""
+        raise NotImplementedError
+
+    def _getchatssince(self, lastchatid, limit, startedafter=None, startedbefore=None):
+        """Return the (possibly empty) list of up to limit ChatInfos
+        for the chats after lastchatid, in chatid order, including
+        ones moved to the archive. If given, only chats started at or
+        after startedafter and before startedbefore are included."""
+        raise NotImplementedError
+
+    def _getchatswithstatus(self, status):
+        """Return the (possibly empty) list of ChatInfos for the chats
+        with the given status"""
+        raise NotImplementedError
+
+    def _getdataversion(self, chatid=None):
+        """Return a value that changes every time another client
+        changes the stored data (see: _waitforchange). If chatid is
+        given, the value only has to change when that chat's data
+        does."""
+        raise NotImplementedError
+
+    def _getfirstqueuedremotemessage(self, chatid):
+        """Return the oldest queued message for a chat and mark it
+        sent, or return None. Each message is returned at most once,
+        even to concurrent callers."""
+        raise NotImplementedError
+
+    def _getlocaluserchat(self, localuser):
+        """Return the ChatInfo for the localuser's current open chat,
+        if any (otherwise None)"""
+        raise NotImplementedError
+
+    def _getlocaluserchats(self, localuser):
+        """Return the (possibly empty) list of ChatInfos for all the
+        localuser's open chats, oldest first"""
+        raise NotImplementedError
+
+    def _getmessagessince(self, chatid, queue, lastmessageid, limit):
+        """Return the (possibly empty) list of up to limit (messageid,
+        posttime, message) tuples for the chat's messages in queue
+        ('localmessagequeue' or 'remotemessagequeue') after
+        lastmessageid, oldest first, including ones moved to the
+        archive. Unlike the other queue methods, this never marks
+        messages sent."""
+        raise NotImplementedError
+
+    def _getopenchatinfo(self, chatid):
+        """Like _getchatinfo, but only return information if the chat
+        is open"""
+        chatinfo = self._getchatinfo(chatid)
+        if chatinfo is not None and chatinfo.status == self.STATUS_OPEN:
+            return chatinfo
+        return None
+
+    def _getqueuedepths(self):
+        """Return a dictionary mapping 'localmessagequeue' and
+        'remotemessagequeue' to the number of messages waiting in
+        each and the posttime of the oldest (or None if there aren't
+        any)"""
+        raise NotImplementedError
+
+    def _getremotemessagessince(self, chatid, lastmessageid, limit=None):
+        """Return the (possibly empty) list of (messageid, message)
+        pairs queued for a chat after lastmessageid, oldest first, and
+        mark any unsent ones as sent. This shouldn't lock out other
+        clients when there's nothing to return."""
+        raise NotImplementedError
+
+    def _incrementalvacuum(self, pages):
+        """Release up to the given number of units of unused storage,
+        and return how many remain"""
+        raise NotImplementedError
+
+    def _markmessagesent(self, messageid):
+        """Record the time that the given message was sent"""
+        self._markmessagessent([messageid])
+
+    def _markmessagessent(self, messageids):
+        """Record the time that all the given messages were sent, at
+        once"""
+        raise NotImplementedError
+
+    def _openchat(self, remoteuser, message=''):
+        """Issue a new chat request and return its chatid"""
+        raise NotImplementedError
+
+    def _queuelocal(self, chatid, message):
+        """Queue a message for delivery to a localuser"""
+        raise NotImplementedError
+
+    def _queueremote(self, chatid, message):
+        """Send a web message to the chat's remoteuser"""
+        raise NotImplementedError
+
+    def _releasechats(self, chatids, workerid):
+        """Give up workerid's claims on the chats, so that other
+        workers don't have to wait for them to expire"""
+        raise NotImplementedError
+
+    def _setavailability(self, availablelocalusers, waitingchats, workerid):
+        """Replace the Availability stored by workerid with one that
+        has the given counts, the current time, and the next
+        generation number"""
+        raise NotImplementedError
+
+    def _setchatstatus(self, chatid, status):
+        """Change the chat's status"""
+        raise NotImplementedError
+
+    def _setonlinestatus(self, localuser, resource, online, workerid):
+        """Record whether the localuser is online from the given
+        resource, as seen by the broker bot named workerid. For
+        example, they might be online with both their desktop and
+        laptop."""
+        self._setonlinestatuses([(localuser, resource, online)], workerid)
+
+    def _setonlinestatuses(self, statuses, workerid):
+        """Record a list of (localuser, resource, online) changes like
+        _setonlinestatus, at once"""
+        raise NotImplementedError
+
+    def _waitforchange(self, timeout, dataversion=None, chatid=None):
+        """Wait up to timeout seconds for another client to change the
+        stored data since _getdataversion(chatid) returned dataversion
+        (or since now, if it's None). Return True if one did, or False
+        if the timeout expired first. If chatid is given, changes to
+        other chats' data may be ignored."""
+        raise NotImplementedError
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Measures how much chat traffic a broker bot and backend can carry
+
+A benchmark runs a real SeshatServer against a fakexmpp.FakeClient in
+this process. Simulated visitors use SeshatClients to start chats,
+send messages at a steady rate, and wait for replies. Simulated agents
+(localusers) accept every chat they're offered and echo each message
+back. The results are printed as JSON so they can be compared between
+releases:
+
+    $ ./benchmark.py --visitors 50 --agents 10 --messages 20 --rate 2
+    $ ./benchmark.py --backend memory --engine threaded -o results.json
+    $ ./benchmark.py -s journal_mode=WAL -s synchronous=NORMAL
+
+Reported latencies are in seconds:
+
+* roundtrip - From a visitor sending a message until they receive the
+  agent's echo of it
+* relay - From a message being queued until it was delivered
+  (posttime to sendtime), for each queue
+
+Any "database is locked" errors seen by visitors are counted under
+errors.locked, and the operation is retried. So are chats and messages
+turned away by the client's admission control, under errors.throttled,
+after waiting as long as they were asked to. Raise the limits with
+settings such as -s messagerate=0 to measure the system without them."""
+
+from __future__ import with_statement
+
+import logging
+import optparse
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import backend
+import client
+import dispatch
+import fakexmpp
+import sendqueue
+import server
+import threadedserver
+
+MODULELOG = logging.getLogger(__name__)
+
+# Recognizes the broker bot's messages to agents
+OFFERPATTERN = re.compile(r"reply with the message '!ACCEPT (\d+)'")
+BUSYPATTERN = re.compile(r'^You are already handling ')
+TAKENPATTERN = re.compile(r'^Chat #\d+ (?:does not exist|is already)')
+CLOSEDPATTERN = re.compile(r'The chat is now closed\.$|^Chat #\d+ is now closed\.$')
+RELAYPATTERN = re.compile(r'^(?:#(\d+) [^:]*: )?(bench \d+ \d+)$')
+
+# How long (in seconds) visitors wait for anything before giving up
+TIMEOUT = 30
+
+def percentiles(values):
+    """Return the median, 95th and 99th percentiles, and maximum of a
+    list of numbers, or None if it's empty"""
+    if not values:
+        return None
+    values = sorted(values)
+    result = {'count': len(values), 'max': values[-1]}
+    for name, fraction in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+        # The nearest-rank method
+        result[name] = values[max(0, int(round(fraction * len(values))) - 1)]
+    return result
+
+def getrelaylatencies(storage, since):
+    """Return a dictionary of lists of the time each message queued
+    since the given time took to be delivered, by queue"""
+    latencies = {}
+    for table in ('localmessagequeue', 'remotemessagequeue'):
+        latencies[table] = []
+        if hasattr(storage, 'store'):
+            with storage.store.condition:
+                rows = [(row[1], row[2]) for row in storage.store.tables[table].itervalues()]
+            latencies[table] = [sendtime - posttime for posttime, sendtime in rows if posttime >= since and sendtime is not None]
+            continue
+        for database in getattr(storage, 'shards', [storage]):
+            latencies[table].extend(row[0] for row in database.dbconn.execute(
+                    "SELECT sendtime - posttime FROM %s WHERE posttime >= ? AND sendtime IS NOT NULL" % table, (since,)))
+    return latencies
+
+class Benchmark(object):
+    """One run of simulated visitors and agents"""
+
+    def __init__(self, settings, visitors=10, agents=2, messages=10, rate=1.0, engine='simple', maxchats=None, dispatchpolicy='broadcast'):
+        """Prepare to have the given number of visitors each send the
+        given number of messages, rate times per second, to the given
+        number of agents. Each agent handles up to maxchats chats at
+        once, by default enough to take every visitor."""
+        self.settings = settings
+        self.visitors = visitors
+        self.agents = ['agent%d@example.com' % agent for agent in range(agents)]
+        self.messages = messages
+        self.rate = rate
+        self.engine = engine
+        if maxchats is None:
+            maxchats = -(-visitors // agents)
+        self.maxchats = maxchats
+        self.dispatchpolicy = dispatchpolicy
+        self.fakeclient = fakexmpp.FakeClient()
+        self.lock = threading.Lock()
+        self.roundtrips = []
+        self.counts = {'started': 0, 'accepted': 0, 'failed': 0, 'sent': 0, 'echoed': 0}
+        self.errors = {'locked': 0, 'throttled': 0, 'other': 0}
+        self.server = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        """Run the benchmark and return a dictionary of results"""
+        ready = threading.Event()
+        serverthread = threading.Thread(target=self._runserver, args=(ready,), name='benchmark-server')
+        serverthread.setDaemon(True)
+        serverthread.start()
+        ready.wait()
+        for agent in self.agents:
+            self.fakeclient.presence(agent + '/benchmark')
+        agentthread = threading.Thread(target=self._runagents, name='benchmark-agents')
+        agentthread.setDaemon(True)
+        agentthread.start()
+        # Give the bot a moment to see the agents come online
+        time.sleep(0.5)
+
+        pool = client.getpool(self.settings)
+        starttime = time.time()
+        visitorthreads = [threading.Thread(target=self._runvisitor, args=(pool, visitor), name='benchmark-visitor-%d' % visitor)
+                          for visitor in range(self.visitors)]
+        for thread in visitorthreads:
+            thread.start()
+        for thread in visitorthreads:
+            thread.join()
+        elapsed = time.time() - starttime
+        self.stopped.set()
+        agentthread.join()
+        self.fakeclient.disconnect()
+        serverthread.join(5)
+
+        seshatclient = pool.get()
+        try:
+            relay = getrelaylatencies(seshatclient.backend, starttime)
+        finally:
+            pool.release(seshatclient)
+        return {
+            'settings': dict((key, value) for key, value in self.settings.items() if 'password' not in key),
+            'engine': self.engine,
+            'dispatch': self.dispatchpolicy,
+            'visitors': self.visitors,
+            'agents': len(self.agents),
+            'maxchats': self.maxchats,
+            'messagespervisitor': self.messages,
+            'rate': self.rate,
+            'elapsed': elapsed,
+            'chats': dict((key, self.counts[key]) for key in ('started', 'accepted', 'failed')),
+            'messages': {'sent': self.counts['sent'],
+                         'echoed': self.counts['echoed'],
+                         'throughput': self.counts['echoed'] / elapsed if elapsed else None},
+            'roundtrip': percentiles(self.roundtrips),
+            'relay': {'local': percentiles(relay['localmessagequeue']),
+                      'remote': percentiles(relay['remotemessagequeue'])},
+            'errors': self.errors,
+            }
+
+    def _count(self, key, amount=1):
+        """Add to one of the counts"""
+        with self.lock:
+            self.counts[key] += amount
+
+    def _retry(self, function, *args):
+        """Return function(*args), counting and retrying any database
+        errors or admission failures"""
+        while True:
+            try:
+                return function(*args)
+            except client.AdmissionError, error:
+                with self.lock:
+                    self.errors['throttled'] += 1
+                time.sleep(error.retryafter)
+            except sqlite3.OperationalError, error:
+                with self.lock:
+                    if 'locked' in str(error):
+                        self.errors['locked'] += 1
+                    else:
+                        self.errors['other'] += 1
+                time.sleep(0.01)
+
+    def _runagents(self):
+        """Play every agent: accept each chat offered, and echo every
+        message relayed. Agents who are too busy to accept a chat try
+        again when one of theirs closes."""
+        seen = 0
+        # agent -> [the chatid they're trying to accept or None,
+        # chatids offered but not tried yet]
+        offers = {}
+        while not self.stopped.isSet():
+            self.fakeclient.waitforsent(seen + 1, 1)
+            with self.fakeclient.lock:
+                stanzas = self.fakeclient.sent[seen:]
+            seen += len(stanzas)
+            for stanza in stanzas:
+                agent = stanza.getTo().getStripped() + '/benchmark'
+                # The bot may merge several messages into one stanza
+                for body in (stanza.getBody() or '').split('\n'):
+                    trying, pending = offers.setdefault(agent, [None, []])
+                    match = OFFERPATTERN.search(body)
+                    if match is not None:
+                        pending.append(match.group(1))
+                    elif body.startswith('You are now handling') or TAKENPATTERN.match(body):
+                        offers[agent][0] = None
+                    elif BUSYPATTERN.match(body):
+                        # Wait for a chat to close
+                        pending.insert(0, trying)
+                        offers[agent][0] = None
+                        continue
+                    elif CLOSEDPATTERN.search(body):
+                        pass
+                    if offers[agent][0] is None and pending:
+                        offers[agent][0] = pending.pop(0)
+                        self.fakeclient.message(agent, '!ACCEPT %s' % offers[agent][0])
+                    match = RELAYPATTERN.match(body)
+                    if match is not None:
+                        chatid, text = match.groups()
+                        if chatid is None:
+                            self.fakeclient.message(agent, 'echo %s' % text)
+                        else:
+                            self.fakeclient.message(agent, '#%s echo %s' % (chatid, text))
+
+    def _runserver(self, ready):
+        """Create and run the broker bot in this thread"""
+        scheduler = dispatch.Scheduler(self.dispatchpolicy, maxchats=self.maxchats, maxwaiting=self.visitors)
+        outbox = sendqueue.fromsettings(self.settings)
+        if self.engine == 'threaded':
+            self.server = threadedserver.ThreadedSeshatServer('bot@example.com', 'benchmark', self.agents, lambda: backend.getbackend(self.settings),
+                                                              xmppclient=self.fakeclient, scheduler=scheduler, outbox=outbox)
+        else:
+            self.server = server.SeshatServer('bot@example.com', 'benchmark', self.agents, backend.getbackend(self.settings),
+                                              xmppclient=self.fakeclient, scheduler=scheduler, outbox=outbox)
+        ready.set()
+        self.server.run()
+
+    def _runvisitor(self, pool, visitor):
+        """Play one visitor: start a chat, wait for it to be accepted,
+        then send messages at the configured rate, timing how long
+        each takes to be echoed back"""
+        seshatclient = pool.get()
+        try:
+            remoteuser = 'visitor%d' % visitor
+            chatid = self._retry(seshatclient.startchat, remoteuser, 'benchmark')
+            self._count('started')
+            lastmessageid = 0
+            deadline = time.time() + TIMEOUT
+            accepted = False
+            while not accepted and time.time() < deadline:
+                for lastmessageid, message in self._retry(seshatclient.getmessagessince, chatid, remoteuser, lastmessageid, None, 1):
+                    if message == "Your chat has started.":
+                        accepted = True
+                    elif message.startswith("No one is available"):
+                        deadline = 0
+            if not accepted:
+                self._count('failed')
+                return
+            self._count('accepted')
+            for message in range(self.messages):
+                nextsend = time.time() + 1.0 / self.rate
+                text = 'bench %d %d' % (visitor, message)
+                sendtime = time.time()
+                self._retry(seshatclient.sendmessage, chatid, remoteuser, text)
+                self._count('sent')
+                deadline = sendtime + TIMEOUT
+                echoed = False
+                while not echoed and time.time() < deadline:
+                    for lastmessageid, reply in self._retry(seshatclient.getmessagessince, chatid, remoteuser, lastmessageid, None, 1):
+                        if reply == 'echo ' + text:
+                            echoed = True
+                if echoed:
+                    with self.lock:
+                        self.roundtrips.append(time.time() - sendtime)
+                        self.counts['echoed'] += 1
+                time.sleep(max(0, nextsend - time.time()))
+            self._retry(seshatclient.endchat, chatid)
+        except Exception:
+            MODULELOG.exception('Visitor %d failed', visitor)
+            with self.lock:
+                self.errors['other'] += 1
+        finally:
+            pool.release(seshatclient)
+
+def main(argv=None):
+    """Run a benchmark configured from the command line"""
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--visitors', type='int', default=10, help='number of simulated visitors [%default]')
+    parser.add_option('--agents', type='int', default=2, help='number of simulated agents [%default]')
+    parser.add_option('--messages', type='int', default=10, help='messages sent by each visitor [%default]')
+    parser.add_option('--rate', type='float', default=1.0, help='messages per second sent by each visitor [%default]')
+    parser.add_option('--maxchats', type='int', help='chats each agent can handle at once [enough for every visitor]')
+    parser.add_option('--dispatch', default='broadcast', choices=dispatch.POLICIES, help='how chats are offered to agents [%default]')
+    parser.add_option('--engine', default='simple', choices=('simple', 'threaded'), help='broker bot engine [%default]')
+    parser.add_option('--backend', default='sqlite', choices=sorted(backend.BACKENDS), help='storage backend [%default]')
+    parser.add_option('--sqlitedb', help='database to use [a new temporary file]')
+    parser.add_option('-s', '--setting', action='append', default=[], metavar='KEY=VALUE',
+                      help='any other Seshat setting, such as journal_mode=WAL (may be repeated)')
+    parser.add_option('-o', '--output', help='file to write the results to [standard output]')
+    options, args = parser.parse_args(argv)
+
+    logging.basicConfig()
+    settings = {'backend': options.backend}
+    for setting in options.setting:
+        key, value = setting.split('=', 1)
+        settings[key.strip()] = value.strip()
+    tempdir = None
+    if options.sqlitedb is None:
+        tempdir = tempfile.mkdtemp(prefix='seshat-benchmark-')
+        options.sqlitedb = os.path.join(tempdir, 'seshat.db')
+    settings['sqlitedb'] = options.sqlitedb
+    settings.setdefault('memorystore', 'benchmark')
+    try:
+        results = Benchmark(settings, options.visitors, options.agents, options.messages, options.rate, options.engine,
+                            options.maxchats, options.dispatch).run()
+    finally:
+        if tempdir is not None:
+            shutil.rmtree(tempdir, ignore_errors=True)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output is None:
+        print output
+    else:
+        outfile = open(options.output, 'w')
+        try:
+            outfile.write(output + '\n')
+        finally:
+            outfile.close()
+
+if __name__ == '__main__':
+    main()
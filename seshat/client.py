@@ -33,54 +33,469 @@
 These are all the methods needed for establishing and interacting with
 chat sessions"""
 
+from __future__ import with_statement
+
 import logging
+import threading
+import time
 
+import backend
+import notify
 import sqlitebackend
 
 MODULELOG = logging.getLogger(__name__)
 
-class SeshatClient(sqlitebackend.SqliteBackend):
+# How long (in seconds) a cached chat's status may be trusted before
+# it's read from the database again
+CHATINFOMAXAGE = 2
+
+# How long (in seconds) the broker bot's availability snapshot may be
+# trusted before it's read from the database again
+AVAILABILITYMAXAGE = 2
+
+# How old (in seconds) the snapshot can get before the broker bot is
+# assumed to have stopped. The broker bot republishes it at least
+# every server.AVAILABILITYINTERVAL seconds.
+AVAILABILITYSTALE = 90
+
+# How many chats each visitor may start at once, and how many more
+# per second after that. A rate of 0 means no limit.
+CHATRATE = 0.1
+CHATBURST = 5
+
+# How many messages each visitor may send at once, and how many more
+# per second after that. A rate of 0 means no limit.
+MESSAGERATE = 2
+MESSAGEBURST = 20
+
+# The most messages a chat may have waiting to be delivered to its
+# localuser, or 0 for no limit
+MAXPENDINGMESSAGES = 50
+
+# The most chats that may be waiting for a localuser at once, or 0 for
+# no limit. Offers that nobody answers keep counting against it until
+# a localuser accepts or cancels them, so it's off unless asked for.
+MAXWAITINGCHATS = 0
+
+# How long (in seconds) visitors turned away by either of those limits
+# are asked to wait before trying again
+RETRYAFTER = 5
+
+# The process-wide SeshatClientPools returned by getpool, by backend
+# and location
+POOLS = {}
+POOLSLOCK = threading.Lock()
+
+# The process-wide ChatInfoCaches returned by getchatinfocache, by
+# backend location
+CHATINFOCACHES = {}
+CHATINFOCACHESLOCK = threading.Lock()
+
+# The availability snapshots read by this process, by backend
+# location, as (Availability or None, time read)
+AVAILABILITIES = {}
+AVAILABILITIESLOCK = threading.Lock()
+
+class AdmissionError(Exception):
+    """Raised when a visitor may not start a chat or send a message
+    right now because they, their chat, or the whole site is too busy.
+    Its retryafter attribute says how many seconds they should wait
+    before trying again."""
+
+    def __init__(self, message, retryafter):
+        Exception.__init__(self, message)
+        self.retryafter = retryafter
+
+class SeshatClient(backend.ChatStatuses):
     """Provide an interface for web clients to send and receive
     message, start chats, and otherwise interact with the
     SeshatServer"""
+
+    def __init__(self, backend, notifysocket=None, admission=None):
+        """Store everything through the given Backend (or, for
+        compatibility with older versions, in the SQLite database at
+        the given path), and prepare to wake the broker bot listening
+        at notifysocket, or at the backend's default notification
+        socket if None. Visitors are held to the AdmissionControl's
+        limits, if one is given."""
+        if isinstance(backend, basestring):
+            backend = sqlitebackend.SqliteBackend(backend)
+        self.backend = backend
+        self.admission = admission
+        self.chatinfocache = getchatinfocache(backend.location)
+        if notifysocket is None:
+            notifysocket = backend.notifypath
+        self.notifier = notify.Notifier(notifysocket)
     
     def endchat(self, chatid):
         """Say goodbye"""
-        chatinfo = self._getopenchatinfo(chatid)
-        if chatinfo is None:
+        # Don't risk missing a chat that was accepted moments ago
+        chatinfo = self._getchatinfo(chatid, maxage=0)
+        if chatinfo is None or chatinfo.status != self.STATUS_OPEN:
             return
-        self._closechat(chatid, self.STATUS_CLOSED)
-        self._queuelocal(chatid, "The chat is now closed.")
-        self._queueremote(chatid, "The chat is now closed.")
+        with self.backend.transaction():
+            self.backend._closechat(chatid, self.STATUS_CLOSED)
+            self.backend._queuelocal(chatid, "The chat is now closed.")
+            self.backend._queueremote(chatid, "The chat is now closed.")
+        self.chatinfocache.put(backend.ChatInfo(chatid, chatinfo.localuser, chatinfo.remoteuser, chatinfo.starttime,
+                                                time.time(), self.STATUS_CLOSED, chatinfo.startmessage))
+        self.notifier.notify()
 
-    def getmessage(self, chatid, remoteuser):
+    def getavailability(self, maxage=AVAILABILITYMAXAGE):
+        """Return the broker bots' latest backend.Availability
+        snapshots combined into one (see: combineavailabilities), or
+        None if none has been published. A copy read by this process
+        within the last maxage seconds will do."""
+        with AVAILABILITIESLOCK:
+            cached = AVAILABILITIES.get(self.backend.location)
+        if cached is not None and time.time() - cached[1] <= maxage:
+            return cached[0]
+        availability = combineavailabilities(self.backend._getavailabilities())
+        with AVAILABILITIESLOCK:
+            AVAILABILITIES[self.backend.location] = (availability, time.time())
+        return availability
+
+    def getmessage(self, chatid, remoteuser, timeout=0):
         """Get the first queued message for the remoteuser in the
-        given chatid"""
-        chatinfo = self._getchatinfo(chatid)
-        if chatinfo.remoteuser != remoteuser:
+        given chatid. If nothing is queued, wait up to timeout seconds
+        for a message to arrive before returning None.
+
+        A waiting call checks again whenever anything in the backend
+        changes, not just this chat, but each check is a plain indexed
+        read that only takes the write lock if it finds a message."""
+        # A chat's remoteuser never changes, so any cached copy will do
+        chatinfo = self._getchatinfo(chatid, maxage=None)
+        if chatinfo is None or chatinfo.remoteuser != remoteuser:
             return
-        return self._getfirstqueuedremotemessage(chatid)
+        return self._longpoll(chatid, lambda: self.backend._getfirstqueuedremotemessage(chatid), timeout)
+
+    def getmessages(self, chatid, remoteuser, limit=None, timeout=0):
+        """Get every queued message (or the oldest limit of them) for
+        the remoteuser in the given chatid, oldest first. If nothing is
+        queued, wait up to timeout seconds for messages to arrive
+        before returning an empty list."""
+        chatinfo = self._getchatinfo(chatid, maxage=None)
+        if chatinfo is None or chatinfo.remoteuser != remoteuser:
+            return []
+        return self._longpoll(chatid, lambda: self.backend._getallqueuedremotemessages(chatid, limit), timeout)
     
+    def getmessagessince(self, chatid, remoteuser, lastmessageid=0, limit=None, timeout=0):
+        """Get the (possibly empty) list of (messageid, message) pairs
+        for the remoteuser in the given chatid that came after
+        lastmessageid, oldest first. If there aren't any, wait up to
+        timeout seconds for messages to arrive.
+
+        Pass the last messageid returned by one call to the next. An
+        idle poll is a single indexed read and never waits on another
+        client's write lock."""
+        chatinfo = self._getchatinfo(chatid, maxage=None)
+        if chatinfo is None or chatinfo.remoteuser != remoteuser:
+            return []
+        return self._longpoll(chatid, lambda: self.backend._getremotemessagessince(chatid, lastmessageid, limit), timeout)
+
+    def haschat(self, chatid, remoteuser):
+        """Return True if the chat exists and belongs to the
+        remoteuser"""
+        chatinfo = self._getchatinfo(chatid, maxage=None)
+        return chatinfo is not None and chatinfo.remoteuser == remoteuser
+
+    def isfinished(self, chatid):
+        """Return True if the chat has ended (or never existed), so no
+        more messages will be queued for its remoteuser"""
+        chatinfo = self._getchatinfo(chatid)
+        return chatinfo is None or chatinfo.status in self.FINALSTATUSES
+
     def isavailable(self):
-        """Returns True if at least one localuser is online, or else
-        False"""
-        return bool(self._getavailablelocalusers())
+        """Returns True if at least one localuser is online and free to
+        take a chat, or else False. This is cheap enough to call on
+        every page view: it usually doesn't touch the database at all
+        (see: getavailability)."""
+        availability = self.getavailability()
+        if availability is None:
+            # The broker bot is too old to publish its availability
+            return bool(self.backend._getavailablelocalusers())
+        if time.time() - availability.updatetime > AVAILABILITYSTALE:
+            return False
+        return availability.availablelocalusers > 0
 
-    def sendmessage(self, chatid, remoteuser, message):
+    def sendmessage(self, chatid, remoteuser, message, admissionkey=None):
         """Send a Jabber message to the chat's localuser. Return True
-        if the message was sent, otherwise False."""
+        if the message was sent, otherwise False. Raise AdmissionError
+        if the visitor is sending too fast or the chat's localuser is
+        too far behind (see: startchat)."""
         chatinfo = self._getchatinfo(chatid)
-        if chatinfo.remoteuser != remoteuser:
+        if chatinfo is None or chatinfo.remoteuser != remoteuser:
             return False
+        self._admitmessage(chatid, remoteuser if admissionkey is None else admissionkey)
         if chatinfo.status in (self.STATUS_WAITING, self.STATUS_NOTIFIED):
-            self._queueremote(chatid, "Your message will be delivered when the chat begins.")
-        elif chatinfo.status in (self.STATUS_CLOSED, self.STATUS_FAILED, self.STATUS_CANCELEDLOCALLY):
-            self._queueremote(chatid, "This chat is already closed.")
-            return False
-        self._queuelocal(chatid, message)
+            # The chat may have been accepted since it was cached
+            chatinfo = self._getchatinfo(chatid, maxage=0)
+        with self.backend.transaction():
+            if chatinfo.status in (self.STATUS_WAITING, self.STATUS_NOTIFIED):
+                self.backend._queueremote(chatid, "Your message will be delivered when the chat begins.")
+            elif chatinfo.status in (self.STATUS_CLOSED, self.STATUS_FAILED, self.STATUS_CANCELEDLOCALLY):
+                self.backend._queueremote(chatid, "This chat is already closed.")
+                return False
+            self.backend._queuelocal(chatid, message)
+        self.notifier.notify()
         return True
 
-    def startchat(self, remoteuser, message=''):
-        """Issue a new chat request and return its chatid"""
-        return self._openchat(remoteuser, message)
+    def startchat(self, remoteuser, message='', admissionkey=None):
+        """Issue a new chat request and return its chatid. Raise
+        AdmissionError if the visitor is starting chats too fast or
+        too many chats are already waiting.
+
+        Visitors are told apart by admissionkey, or by remoteuser if
+        it's None. Pass something else, such as the address of the
+        visitor's browser, when many visitors share a remoteuser."""
+        self._admitchat(remoteuser if admissionkey is None else admissionkey)
+        chatid = self.backend._openchat(remoteuser, message)
+        self.chatinfocache.put(backend.ChatInfo(chatid, None, remoteuser, time.time(), None, self.STATUS_WAITING, message))
+        self.notifier.notify()
+        return chatid
+
+    def _admitchat(self, admissionkey):
+        """Raise AdmissionError if the visitor may not start a chat
+        now"""
+        if self.admission is None:
+            return
+        retryafter = self.admission.chatbuckets.take(admissionkey)
+        if retryafter:
+            raise AdmissionError('Too many chats started', retryafter)
+        if self.admission.maxwaitingchats and self._countwaitingchats() >= self.admission.maxwaitingchats:
+            raise AdmissionError('Too many chats waiting', RETRYAFTER)
+
+    def _admitmessage(self, chatid, admissionkey):
+        """Raise AdmissionError if the visitor may not send a message
+        to the chat now"""
+        if self.admission is None:
+            return
+        retryafter = self.admission.messagebuckets.take(admissionkey)
+        if retryafter:
+            raise AdmissionError('Too many messages sent', retryafter)
+        if self.admission.maxpendingmessages and self.backend._countunsentlocalmessages(chatid) >= self.admission.maxpendingmessages:
+            raise AdmissionError('Too many messages waiting', RETRYAFTER)
+
+    def _countwaitingchats(self):
+        """Return roughly how many chats are waiting for a localuser,
+        preferring the broker bot's snapshot to counting them"""
+        availability = self.getavailability()
+        if availability is not None and time.time() - availability.updatetime <= AVAILABILITYSTALE:
+            return availability.waitingchats
+        return len(self.backend._getchatswithstatus(self.STATUS_WAITING)) + len(self.backend._getchatswithstatus(self.STATUS_NOTIFIED))
+
+    def _getchatinfo(self, chatid, maxage=CHATINFOMAXAGE):
+        """Like Backend._getchatinfo, but answered from the process's
+        cache if it was read from the backend within the last maxage
+        seconds (or at any time if maxage is None)"""
+        chatinfo = self.chatinfocache.get(chatid, maxage)
+        if chatinfo is None:
+            chatinfo = self.backend._getchatinfo(chatid)
+            if chatinfo is not None:
+                self.chatinfocache.put(chatinfo)
+        return chatinfo
+
+    def _longpoll(self, chatid, fetch, timeout):
+        """Return the result of fetch() as soon as it's something
+        other than None or an empty list, trying again each time the
+        chat's data changes until timeout seconds have passed"""
+        deadline = time.time() + timeout
+        while True:
+            # Note the version first, so that a change committed after
+            # fetch looks but before the wait starts still ends it
+            dataversion = self.backend._getdataversion(chatid)
+            result = fetch()
+            if result not in (None, []):
+                return result
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.backend._waitforchange(remaining, dataversion, chatid):
+                return result
+
+class AdmissionControl(object):
+    """The limits on how fast visitors may start chats and send
+    messages, shared by all the SeshatClients in a process. Each
+    visitor has a TokenBuckets entry for chats and another for
+    messages. Since every web process keeps its own, a site running N
+    processes admits up to N times as much."""
+
+    def __init__(self, chatrate=CHATRATE, chatburst=CHATBURST, messagerate=MESSAGERATE, messageburst=MESSAGEBURST,
+                 maxpendingmessages=MAXPENDINGMESSAGES, maxwaitingchats=MAXWAITINGCHATS):
+        """Prepare to admit visitors within the given limits"""
+        self.chatbuckets = TokenBuckets(chatrate, chatburst)
+        self.messagebuckets = TokenBuckets(messagerate, messageburst)
+        self.maxpendingmessages = int(maxpendingmessages)
+        self.maxwaitingchats = int(maxwaitingchats)
+
+class ChatInfoCache(object):
+    """A thread-safe cache of ChatInfo records shared by all the
+    SeshatClients in a process. When it holds more than maxsize chats,
+    the least recently used ones are forgotten."""
+
+    # Chats with these statuses will never change again, so their
+    # cached copies never go stale
+    FINALSTATUSES = backend.ChatStatuses.FINALSTATUSES
+
+    def __init__(self, maxsize=10000):
+        """Prepare an empty cache"""
+        self.maxsize = maxsize
+        # chatid -> [chatinfo, time cached, last use]
+        self.entries = {}
+        self.usecounter = 0
+        self.lock = threading.Lock()
+
+    def get(self, chatid, maxage=None):
+        """Return the cached ChatInfo for the chat, or None if it isn't
+        cached or if the chat could have changed since it was cached
+        more than maxage seconds ago"""
+        with self.lock:
+            entry = self.entries.get(chatid)
+            if entry is None:
+                return None
+            chatinfo, cachetime = entry[0], entry[1]
+            if maxage is not None and chatinfo.status not in self.FINALSTATUSES and time.time() - cachetime > maxage:
+                return None
+            self.usecounter += 1
+            entry[2] = self.usecounter
+            return chatinfo
+
+    def put(self, chatinfo):
+        """Add a ChatInfo to the cache, or replace the cached copy"""
+        with self.lock:
+            self.usecounter += 1
+            self.entries[chatinfo.chatid] = [chatinfo, time.time(), self.usecounter]
+            if len(self.entries) > self.maxsize:
+                # Evict the least recently used tenth all at once so
+                # the cost of sorting is spread over many puts
+                entries = sorted(self.entries.items(), key=lambda item: item[1][2])
+                for chatid, entry in entries[:max(1, self.maxsize // 10)]:
+                    del self.entries[chatid]
+
+class TokenBuckets(object):
+    """A thread-safe token bucket for each of any number of keys: each
+    key may take up to burst tokens at once, and rate more per second
+    after that. A rate of 0 means no limit. When more than maxsize
+    keys have been seen, those whose buckets are closest to full are
+    forgotten."""
+
+    def __init__(self, rate, burst, maxsize=10000):
+        """Prepare a full bucket for every key"""
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.maxsize = maxsize
+        # key -> (tokens left, time the tokens were counted)
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key):
+        """Take a token from the key's bucket and return 0, or if it's
+        empty, return how many seconds until it won't be"""
+        if not self.rate:
+            return 0
+        now = time.time()
+        with self.lock:
+            tokens, counted = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - counted) * self.rate)
+            if tokens < 1:
+                return (1 - tokens) / self.rate
+            self.buckets[key] = (tokens - 1, now)
+            if len(self.buckets) > self.maxsize:
+                # Forget the tenth closest to full all at once so the
+                # cost of sorting is spread over many takes. A
+                # forgotten bucket starts out full again.
+                buckets = sorted(self.buckets.items(), key=lambda item: item[1][1] + (self.burst - item[1][0]) / self.rate)
+                for forgotten, bucket in buckets[:max(1, self.maxsize // 10)]:
+                    del self.buckets[forgotten]
+            return 0
+
+class SeshatClientPool(object):
+    """A thread-safe collection of SeshatClients that can be shared by
+    every thread in a process. Connections are reused across requests
+    instead of being opened (and having their schema checked) for each
+    one."""
+
+    def __init__(self, settings, maxidle=10):
+        """Prepare to hand out clients using the backend described by
+        a dictionary of settings (see: backend.getbackend), keeping at
+        most maxidle of them open while they're not in use"""
+        self.settings = settings
+        self.maxidle = maxidle
+        self.admission = getadmissioncontrol(settings)
+        self.idleclients = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Return a SeshatClient for the exclusive use of the calling
+        thread until it's passed to release"""
+        with self.lock:
+            if self.idleclients:
+                return self.idleclients.pop()
+        return SeshatClient(backend.getbackend(self.settings, crossthread=True),
+                            backend.getsetting(self.settings, 'notifysocket'), self.admission)
+
+    def release(self, seshatclient):
+        """Return a client to the pool once the caller is finished
+        with it"""
+        # Don't let a half-finished transaction leak into the next
+        # user's request
+        seshatclient.backend._abort()
+        with self.lock:
+            if len(self.idleclients) < self.maxidle:
+                self.idleclients.append(seshatclient)
+                return
+        seshatclient.notifier.close()
+        seshatclient.backend._close()
+
+def combineavailabilities(availabilities):
+    """Return one backend.Availability summing up the snapshots of
+    every broker bot sharing a backend, or None if there aren't any.
+    Bots whose snapshots are stale have probably stopped, so they're
+    left out. If every snapshot is stale, the newest is returned as
+    is. Bots may share localusers, so the largest number available is
+    used, but each has its own waiting chats, so those are added up."""
+    if not availabilities:
+        return None
+    fresh = [availability for availability in availabilities if time.time() - availability.updatetime <= AVAILABILITYSTALE]
+    if not fresh:
+        return max(availabilities, key=lambda availability: availability.updatetime)
+    return backend.Availability(max(availability.availablelocalusers for availability in fresh),
+                                sum(availability.waitingchats for availability in fresh),
+                                sum(availability.generation for availability in fresh),
+                                max(availability.updatetime for availability in fresh))
+
+def getadmissioncontrol(settings):
+    """Return an AdmissionControl configured by the "chatrate",
+    "chatburst", "messagerate", "messageburst", "maxpendingmessages",
+    and "maxwaitingchats" settings (see: backend.getsetting)"""
+    options = {}
+    for key in ('chatrate', 'chatburst', 'messagerate', 'messageburst', 'maxpendingmessages', 'maxwaitingchats'):
+        value = backend.getsetting(settings, key)
+        if value is not None:
+            options[key] = value
+    return AdmissionControl(**options)
+
+def getchatinfocache(location):
+    """Return the process-wide ChatInfoCache for the backend location
+    (see: Backend.location)"""
+    if location is None:
+        # The data isn't shared, so neither is the cache
+        return ChatInfoCache()
+    with CHATINFOCACHESLOCK:
+        try:
+            return CHATINFOCACHES[location]
+        except KeyError:
+            cache = CHATINFOCACHES[location] = ChatInfoCache()
+            return cache
 
+def getpool(settings):
+    """Return the process-wide SeshatClientPool for the backend
+    described by a dictionary of settings, such as a Pyramid
+    application's (see: backend.getbackend). Pools are shared by every
+    caller whose settings name the same backend and location."""
+    backendclass = backend.getbackendclass(settings)
+    key = (backendclass, backend.getsetting(settings, backendclass.LOCATIONSETTING))
+    with POOLSLOCK:
+        try:
+            return POOLS[key]
+        except KeyError:
+            pool = POOLS[key] = SeshatClientPool(settings)
+            return pool
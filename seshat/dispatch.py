@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Decides which localusers are offered each chat request
+
+By default every free localuser is offered every chat request, each
+localuser handles one chat at a time, and a request fails if nobody is
+free when it arrives. A Scheduler can instead:
+
+* offer each request to one localuser at a time, either taking turns
+  ("roundrobin") or picking whoever has the fewest open chats
+  ("leastloaded"), and offer it to someone else if it isn't accepted
+  within offertimeout seconds,
+* let each localuser handle up to maxchats chats at once, and
+* hold up to maxwaiting requests until someone is free instead of
+  failing them.
+
+The Scheduler only keeps the broker bot's bookkeeping. The broker bot
+does the actual offering and stores the results."""
+
+from __future__ import with_statement
+
+import threading
+import time
+
+import backend
+
+# The ways of choosing who to offer a chat to
+POLICIES = ('broadcast', 'roundrobin', 'leastloaded')
+
+class Scheduler(object):
+    """Tracks each localuser's open chats and the outstanding offers.
+    It's safe to use from several threads."""
+
+    def __init__(self, policy='broadcast', maxchats=1, maxwaiting=0, offertimeout=60):
+        """Prepare to schedule chats using one of the POLICIES"""
+        if policy not in POLICIES:
+            raise ValueError('The dispatch policy must be one of %s, not %s' % (', '.join(POLICIES), policy))
+        self.policy = policy
+        self.maxchats = int(maxchats)
+        self.maxwaiting = int(maxwaiting)
+        self.offertimeout = float(offertimeout)
+        self.lock = threading.Lock()
+        # localuser -> set of the chatids they're handling
+        self.openchats = {}
+        # localuser -> the chatid their unaddressed messages go to
+        self.currentchats = {}
+        # chatid -> [time last offered, set of localusers offered it,
+        # the localuser it's waiting on or None if it was broadcast].
+        # An entry offered to nobody is waiting for someone to be
+        # free so that it can be offered again.
+        self.offers = {}
+        # The chatids whose remoteusers have been told to wait
+        self.queued = set()
+        # The last localuser offered a chat by "roundrobin"
+        self.lastoffered = None
+
+    def accepted(self, localuser, chatid):
+        """Record that the localuser is now handling the chat, and
+        make it the one their unaddressed messages go to"""
+        with self.lock:
+            self.openchats.setdefault(localuser, set()).add(chatid)
+            self.currentchats[localuser] = chatid
+            self.offers.pop(chatid, None)
+            self.queued.discard(chatid)
+
+    def available(self, onlineusers):
+        """Return a sorted list of the online localusers who can take
+        another chat"""
+        with self.lock:
+            return sorted(localuser for localuser in onlineusers if self._load(localuser) < self.maxchats)
+
+    def choose(self, chatid, onlineusers):
+        """Return the (possibly empty) list of localusers to offer the
+        chat to now, and record the offer. Nobody is offered the same
+        chat twice, except that once everyone free has let it go
+        unanswered, it's offered to all of them at once. That offer
+        expires too, so that anyone free by then is offered it, alone
+        if they haven't been yet or with everyone else free if not. If
+        nobody is free, it's tried again from scratch after another
+        offertimeout."""
+        with self.lock:
+            # The chat's own offer doesn't count against its offeree
+            offer = self.offers.pop(chatid, None)
+            offered = offer[1] if offer is not None else set()
+            free = sorted(localuser for localuser in onlineusers if self._load(localuser) < self.maxchats)
+            candidates = [localuser for localuser in free if localuser not in offered]
+            if not candidates:
+                if offer is None:
+                    return []
+                if free:
+                    self.offers[chatid] = [time.time(), offered.union(free), None]
+                    self.queued.discard(chatid)
+                    return free
+                self.offers[chatid] = [time.time(), set(), None]
+                return []
+            if self.policy == 'broadcast':
+                chosen = candidates
+                offeree = None
+            else:
+                # Take turns starting after whoever was offered a chat
+                # last, so that ties are broken fairly
+                later = [localuser for localuser in candidates if self.lastoffered is None or localuser > self.lastoffered]
+                candidates = later + [localuser for localuser in candidates if localuser not in later]
+                if self.policy == 'leastloaded':
+                    candidates.sort(key=self._load)
+                chosen = candidates[:1]
+                offeree = self.lastoffered = chosen[0]
+            self.offers[chatid] = [time.time(), offered.union(chosen), offeree]
+            self.queued.discard(chatid)
+            return chosen
+
+    def closed(self, localuser, chatid):
+        """Record that the chat is over"""
+        with self.lock:
+            self.openchats.get(localuser, set()).discard(chatid)
+            if self.currentchats.get(localuser) == chatid:
+                del self.currentchats[localuser]
+            self.offers.pop(chatid, None)
+            self.queued.discard(chatid)
+
+    def currentchat(self, localuser):
+        """Return the chatid the localuser's unaddressed messages go
+        to, or None"""
+        with self.lock:
+            return self.currentchats.get(localuser)
+
+    def expiredoffers(self):
+        """Return the sorted list of chatids whose latest offer has gone
+        unanswered for offertimeout seconds, or that have waited that
+        long for someone to be free. With the "broadcast" policy every
+        chat goes to everyone at once, so offers never expire."""
+        if self.policy == 'broadcast':
+            return []
+        cutoff = time.time() - self.offertimeout
+        with self.lock:
+            return sorted(chatid for chatid, offer in self.offers.items() if offer[0] < cutoff)
+
+    def forget(self, chatid):
+        """Stop tracking offers for a chat that's no longer waiting"""
+        with self.lock:
+            self.offers.pop(chatid, None)
+            self.queued.discard(chatid)
+
+    def hold(self, chatid, position):
+        """Decide what to do with a chat request that nobody is free to
+        take, when position other requests are ahead of it. Return
+        'wait' if its remoteuser should be told to wait, 'waiting' if
+        they already have been, or 'fail' if the queue is full."""
+        with self.lock:
+            if position >= self.maxwaiting:
+                self.queued.discard(chatid)
+                return 'fail'
+            if chatid in self.queued:
+                return 'waiting'
+            self.queued.add(chatid)
+            return 'wait'
+
+    def prune(self, chatids):
+        """Stop tracking offers and held requests for every chat but
+        the given ones, which are still waiting for a localuser. The
+        others may have been accepted by another broker bot or given
+        up on by their remoteusers."""
+        with self.lock:
+            chatids = set(chatids)
+            for chatid in self.offers.keys():
+                if chatid not in chatids:
+                    del self.offers[chatid]
+            self.queued.intersection_update(chatids)
+
+    def refresh(self, openchats):
+        """Replace the record of who's handling which chats with the
+        given list of open ChatInfos, and stop tracking offers for
+        them"""
+        with self.lock:
+            self.openchats = {}
+            for chat in openchats:
+                self.openchats.setdefault(chat.localuser, set()).add(chat.chatid)
+                self.offers.pop(chat.chatid, None)
+                self.queued.discard(chat.chatid)
+            for localuser, chatid in self.currentchats.items():
+                if chatid not in self.openchats.get(localuser, ()):
+                    del self.currentchats[localuser]
+
+    def route(self, localuser, chatid):
+        """Make chatid the one the localuser's unaddressed messages go
+        to"""
+        with self.lock:
+            self.currentchats[localuser] = chatid
+
+    def waiting(self):
+        """Return how many chats have been offered or held but not yet
+        accepted"""
+        with self.lock:
+            return len(self.queued.union(self.offers))
+
+    def _load(self, localuser):
+        """Return the number of chats the localuser is handling or has
+        been offered alone. A chat offered to one localuser is theirs
+        to take, so it counts against the number they can handle. The
+        caller must hold the lock."""
+        return len(self.openchats.get(localuser, ())) + len([offer for offer in self.offers.values() if offer[2] == localuser])
+
+def fromsettings(settings):
+    """Return a Scheduler configured by the "dispatch", "maxchats",
+    "maxwaiting", and "offertimeout" settings (see:
+    backend.getsetting)"""
+    options = {}
+    for key, option in (('dispatch', 'policy'), ('maxchats', 'maxchats'), ('maxwaiting', 'maxwaiting'), ('offertimeout', 'offertimeout')):
+        value = backend.getsetting(settings, key)
+        if value is not None:
+            options[option] = value
+    return Scheduler(**options)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""A stand-in for xmpppy's Client that needs no Jabber server
+
+FakeClient implements the parts of xmpp.Client that the broker bot
+uses, plus methods for playing the part of the localusers. It lets a
+SeshatServer be exercised offline, from tests or benchmarks:
+
+    client = fakexmpp.FakeClient()
+    bot = server.SeshatServer('bot@example.com', 'pw', ['joe@example.com'],
+                              storage, xmppclient=client)
+    # ...run the bot in another thread, then:
+    client.presence('joe@example.com/desk')
+    client.message('joe@example.com/desk', '!ACCEPT 1')
+    client.waitforsent(1)
+
+Stanzas are built with xmpppy's own classes, so the bot's handlers see
+exactly what they would from a real connection."""
+
+from __future__ import with_statement
+
+import select
+import socket
+import threading
+import time
+import xmpp
+
+class FakeConnection(object):
+    """The part of xmpppy's connection object that the broker bot
+    looks at. The client's end of a socket pair stands in for the
+    connection to the Jabber server so that the bot can select on
+    it."""
+
+    def __init__(self):
+        """Create the socket pair"""
+        self._sock, self.peer = socket.socketpair()
+
+    def pending_data(self, timeout=0):
+        """Return True if a stanza arrives within timeout seconds"""
+        return bool(select.select([self._sock], [], [], timeout)[0])
+
+class FakeClient(object):
+    """An in-memory Jabber client. Stanzas passed to presence and
+    message are handed to the registered handlers by Process, and
+    stanzas sent by the bot are collected in sent."""
+
+    def __init__(self, jid='bot@example.com', senddelay=0):
+        """Prepare a client for the given account. If senddelay is
+        given, every send takes that many seconds, like a slow Jabber
+        server."""
+        self.jid = xmpp.protocol.JID(jid)
+        self.senddelay = senddelay
+        self.Connection = FakeConnection()
+        self.handlers = {}
+        self.connected = False
+        self.incoming = []
+        self.sent = []
+        self.lock = threading.Condition()
+
+    #### The xmpp.Client interface
+
+    def connect(self):
+        """Pretend to connect to the server"""
+        self.connected = True
+        return 'tcp'
+
+    def auth(self, user, password, resource=''):
+        """Pretend to log in"""
+        self.jid = xmpp.protocol.JID(node=user, domain=self.jid.getDomain(), resource=resource)
+        return 'sasl'
+
+    def sendInitPresence(self):
+        """Pretend to announce the bot's presence"""
+        pass
+
+    def RegisterHandler(self, name, handler):
+        """Call handler(client, stanza) for each incoming stanza of
+        the named kind"""
+        self.handlers.setdefault(name, []).append(handler)
+
+    def Process(self, timeout=0):
+        """Wait up to timeout seconds for stanzas, then hand them to
+        their handlers. Like xmpp.Client.Process, return the number of
+        stanzas handled or '0' if none arrived, but 0 if the
+        connection was lost."""
+        if not self.connected:
+            return 0
+        if not self.Connection.pending_data(timeout):
+            return '0'
+        self.Connection._sock.recv(4096)
+        with self.lock:
+            incoming, self.incoming = self.incoming, []
+        for name, stanza in incoming:
+            for handler in self.handlers.get(name, ()):
+                handler(self, stanza)
+        return len(incoming) or '0'
+
+    def send(self, stanza):
+        """Record a stanza sent by the bot"""
+        if self.senddelay:
+            time.sleep(self.senddelay)
+        with self.lock:
+            self.sent.append(stanza)
+            self.lock.notifyAll()
+
+    #### Playing the localusers
+
+    def disconnect(self):
+        """Simulate losing the connection to the server. The bot
+        reconnects by calling connect."""
+        self.connected = False
+        self.Connection.peer.send('x')
+
+    def message(self, jid, body):
+        """Deliver a chat message from jid to the bot"""
+        self._deliver('message', xmpp.protocol.Message(self.jid, body, typ='chat', frm=jid))
+
+    def presence(self, jid, typ=None, show=None):
+        """Deliver a presence update from jid to the bot. typ is None
+        or 'unavailable', and show is None (for available) or a status
+        like 'away'."""
+        self._deliver('presence', xmpp.protocol.Presence(self.jid, typ=typ, show=show, frm=jid))
+
+    def sentto(self, jid):
+        """Return the bodies of the messages sent to jid so far"""
+        with self.lock:
+            return [stanza.getBody() for stanza in self.sent if stanza.getTo().getStripped() == jid]
+
+    def waitforsent(self, count, timeout=5):
+        """Wait up to timeout seconds for the bot to have sent count
+        stanzas in all. Return True if it did."""
+        deadline = time.time() + timeout
+        with self.lock:
+            while len(self.sent) < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def _deliver(self, name, stanza):
+        """Queue an incoming stanza and wake whoever's waiting on the
+        connection"""
+        with self.lock:
+            self.incoming.append((name, stanza))
+        self.Connection.peer.send('x')
@@ -0,0 +1,581 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright (c) 2011, Daycos
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#     * Neither the name of Daycos nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL
+# <COPYRIGHT HOLDER> BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+
+"""Implements Seshat's client-server API in the process's memory
+
+Nothing is written to disk, so everything is lost when the process
+exits. This is useful for running the web application and broker bot
+in one process, and for measuring how much time the other backends
+spend on storage (see: seshat.backend)."""
+
+from __future__ import with_statement
+
+import bisect
+import contextlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import backend
+import notify
+from backend import Availability, ChatInfo, QueuedMessage
+
+MODULELOG = logging.getLogger(__name__)
+
+# The store used if the "memorystore" setting isn't given
+DEFAULTSTORE = 'default'
+
+# Every MemoryStore in the process, by name
+STORES = {}
+STORESLOCK = threading.Lock()
+
+# The columns of each table's rows. These match the SQLite backend's
+# tables so that the two are easy to compare, except that chat claims
+# are kept in a table of their own.
+TABLES = {
+    'availability': ('workerid', 'availablelocalusers', 'waitingchats', 'generation', 'updatetime'),
+    'chat': ('chatid', 'localuser', 'remoteuser', 'starttime', 'endtime', 'status', 'startmessage'),
+    'chatclaim': ('chatid', 'claimworker', 'claimexpires'),
+    'localmessagequeue': ('messageid', 'posttime', 'sendtime', 'chatid', 'message'),
+    'onlinestatus': ('workerid', 'localuser', 'resource', 'online'),
+    'remotemessagequeue': ('messageid', 'posttime', 'sendtime', 'chatid', 'message'),
+    }
+
+# The tables that retention.Archiver moves old rows out of
+ARCHIVEDTABLES = ('chat', 'localmessagequeue', 'remotemessagequeue')
+
+# The indexes kept on the tables so that lookups don't scan them, like
+# the SQLite backend's. Each maps an index's name to its table, a
+# function returning the key a row is filed under, or None to leave
+# the row out, and optionally a function returning the value to order
+# the rows filed under each key by. An index holds the primary keys
+# filed under each key, in order, or if it has an order function,
+# (value, primary key) pairs ordered by value.
+INDEXES = {
+    'chat_chatid': ('chat', lambda row: True),
+    'chat_status': ('chat', lambda row: row[5]),
+    'chat_localuser_status': ('chat', lambda row: (row[1], row[5])),
+    'chat_finished_endtime': ('chat', lambda row: True if row[5] in backend.Backend.FINALSTATUSES else None, lambda row: row[4] or row[3]),
+    'localmessagequeue_chatid': ('localmessagequeue', lambda row: row[3]),
+    'localmessagequeue_chatid_unsent': ('localmessagequeue', lambda row: row[3] if row[2] is None else None),
+    'localmessagequeue_unsent': ('localmessagequeue', lambda row: True if row[2] is None else None),
+    'localmessagequeue_sendtime': ('localmessagequeue', lambda row: True if row[2] is not None else None, lambda row: row[2]),
+    'remotemessagequeue_chatid': ('remotemessagequeue', lambda row: row[3]),
+    'remotemessagequeue_chatid_unsent': ('remotemessagequeue', lambda row: row[3] if row[2] is None else None),
+    'remotemessagequeue_unsent': ('remotemessagequeue', lambda row: True if row[2] is None else None),
+    'remotemessagequeue_sendtime': ('remotemessagequeue', lambda row: True if row[2] is not None else None, lambda row: row[2]),
+    'archive.chat_chatid': ('archive.chat', lambda row: True),
+    'archive.localmessagequeue_chatid': ('archive.localmessagequeue', lambda row: row[3]),
+    'archive.remotemessagequeue_chatid': ('archive.remotemessagequeue', lambda row: row[3]),
+    }
+
+class MemoryStore(object):
+    """The tables shared by every MemoryBackend with the same store
+    name. Rows are tuples that are replaced, never modified, so
+    readers holding the lock always see consistent data."""
+
+    def __init__(self, name):
+        """Create a new, empty store"""
+        self.name = name
+        self.condition = threading.Condition(threading.RLock())
+        self.version = 0
+        self.tables = {}
+        self.lastids = {}
+        for table in TABLES:
+            self.tables[table] = {}
+        for table in ARCHIVEDTABLES:
+            self.tables['archive.%s' % table] = {}
+            self.lastids[table] = 0
+        self.indexes = {}
+        # table -> list of (index name, key function, order function)
+        self.tableindexes = {}
+        for name, index in INDEXES.items():
+            table, keyfunction, orderfunction = (index + (None,))[:3]
+            self.indexes[name] = {}
+            self.tableindexes.setdefault(table, []).append((name, keyfunction, orderfunction))
+
+    def before(self, index, key, value, limit):
+        """Return the ordered list of up to limit primary keys filed
+        under key in the named index, which must have an order
+        function, whose rows' values are less than value"""
+        entries = self.lookup(index, key)
+        end = min(bisect.bisect_left(entries, (value,)), limit)
+        return [primarykey for ordervalue, primarykey in entries[:end]]
+
+    def lookup(self, index, key):
+        """Return the ordered list of the primary keys (or (value,
+        primary key) pairs) filed under key in the named index. The
+        list mustn't be changed, and changes to the store change
+        it."""
+        return self.indexes[index].get(key, [])
+
+    def nextid(self, table):
+        """Return a new, unused primary key for the table"""
+        self.lastids[table] += 1
+        return self.lastids[table]
+
+    def put(self, table, key, row):
+        """Store row under key in the table, or delete the key's row if
+        row is None, and update the table's indexes. Return the row it
+        replaced, if any."""
+        rows = self.tables[table]
+        oldrow = rows.get(key)
+        if row is None:
+            rows.pop(key, None)
+        else:
+            rows[key] = row
+        for name, keyfunction, orderfunction in self.tableindexes.get(table, ()):
+            oldindexkey, oldentry = self._getentry(key, oldrow, keyfunction, orderfunction)
+            newindexkey, newentry = self._getentry(key, row, keyfunction, orderfunction)
+            if (oldindexkey, oldentry) == (newindexkey, newentry):
+                continue
+            index = self.indexes[name]
+            if oldindexkey is not None:
+                entries = index[oldindexkey]
+                del entries[bisect.bisect_left(entries, oldentry)]
+                if not entries:
+                    del index[oldindexkey]
+            if newindexkey is not None:
+                bisect.insort(index.setdefault(newindexkey, []), newentry)
+        return oldrow
+
+    def _getentry(self, key, row, keyfunction, orderfunction):
+        """Return the key an index files the row stored under key
+        under, and the entry it files, or (None, None) if the index
+        leaves it out"""
+        indexkey = keyfunction(row) if row is not None else None
+        if indexkey is None:
+            return None, None
+        if orderfunction is None:
+            return indexkey, key
+        return indexkey, (orderfunction(row), key)
+
+def getstore(name):
+    """Return the process's MemoryStore with the given name, creating
+    it if necessary"""
+    with STORESLOCK:
+        try:
+            return STORES[name]
+        except KeyError:
+            store = STORES[name] = MemoryStore(name)
+            return store
+
+class MemoryBackend(backend.Backend):
+    """An implementation of the Seshat backend API that keeps
+    everything in memory shared by the process's threads"""
+
+    LOCATIONSETTING = 'memorystore'
+    inmemory = True
+
+    def __init__(self, memorystore=None, crossthread=False):
+        """Connect to the named store, creating it if this is the
+        first time it's been used. crossthread is accepted for
+        compatibility with SqliteBackend, but every MemoryBackend may
+        be handed from one thread to another."""
+        if memorystore is None:
+            memorystore = DEFAULTSTORE
+        self.store = getstore(memorystore)
+        self.transactiondepth = 0
+        self.undolog = []
+        self.location = 'memory:%s' % memorystore
+        self.notifypath = notify.getnotifypath(os.path.join(tempfile.gettempdir(), 'seshat-%d-%s' % (os.getpid(), memorystore)))
+
+    @contextlib.contextmanager
+    def transaction(self, immediate=False):
+        """Hold the store's lock for the duration of the "with" block,
+        and undo every change made inside it if it raises an exception.
+        Transactions nest, so only the outermost block commits. The
+        lock is always taken right away, so immediate is ignored."""
+        with self.store.condition:
+            self.transactiondepth += 1
+            try:
+                yield
+            except:
+                self.transactiondepth -= 1
+                if not self.transactiondepth:
+                    self._abort()
+                raise
+            self.transactiondepth -= 1
+            if not self.transactiondepth:
+                self._commit()
+
+    def _abort(self):
+        """Undo every change made by the unfinished transaction"""
+        with self.store.condition:
+            while self.undolog:
+                table, key, row = self.undolog.pop()
+                self.store.put(table, key, row)
+
+    def _acceptchat(self, chatid, localuser):
+        """Open a chat and set its localuser to the given value, if
+        it's still waiting to be accepted. Return True if it was."""
+        with self.transaction():
+            row = self.store.tables['chat'].get(chatid)
+            if row is None or row[5] not in (self.STATUS_WAITING, self.STATUS_NOTIFIED):
+                return False
+            self._put('chat', chatid, row[:1] + (localuser,) + row[2:5] + (self.STATUS_OPEN,) + row[6:])
+        return True
+
+    def _archivechats(self, cutoff, batchsize):
+        """Move up to batchsize closed, failed, or canceled chats that
+        ended before cutoff, along with any of their messages that are
+        still in the queues, to the archive tables. Return the number
+        of chats moved."""
+        with self.transaction():
+            chatids = self.store.before('chat_finished_endtime', True, cutoff, batchsize)
+            for chatid in chatids:
+                for table in ('localmessagequeue', 'remotemessagequeue'):
+                    for messageid in list(self.store.lookup('%s_chatid' % table, chatid)):
+                        self._move(table, messageid)
+                self._move('chat', chatid)
+                self._put('chatclaim', chatid, None)
+        return len(chatids)
+
+    def _archivemessages(self, cutoff, batchsize):
+        """Move up to batchsize messages from each queue that were
+        delivered before cutoff to the archive tables. Return the
+        number of messages moved."""
+        moved = 0
+        with self.transaction():
+            for table in ('localmessagequeue', 'remotemessagequeue'):
+                messageids = self.store.before('%s_sendtime' % table, True, cutoff, batchsize)
+                for messageid in messageids:
+                    self._move(table, messageid)
+                moved += len(messageids)
+        return moved
+
+    def _attacharchive(self, archivedb):
+        """Do nothing. The archive tables are kept in the store
+        alongside the live ones, so archivedb is ignored."""
+        pass
+
+    def _claimchats(self, chatids, workerid, leasetime):
+        """Claim the chats for workerid until leasetime seconds from
+        now"""
+        claimexpires = time.time() + leasetime
+        for chatid in chatids:
+            self._put('chatclaim', chatid, (chatid, workerid, claimexpires))
+
+    def _claimchatswithstatus(self, status, workerid, leasetime):
+        """Return the (possibly empty) list of chats with the given
+        status that no other worker has a current claim on, and claim
+        them for workerid for leasetime seconds"""
+        with self.transaction():
+            chats = [chat for chat in self._getchatswithstatus(status) if self._isclaimable(chat.chatid, workerid)]
+            self._claimchats([chat.chatid for chat in chats], workerid, leasetime)
+        return chats
+
+    def _claimqueuedlocalmessages(self, workerid, leasetime):
+        """Return the (possibly empty) list of messages queued for
+        delivery to localusers in chats that no other worker has a
+        current claim on, and claim those chats for workerid for
+        leasetime seconds"""
+        messages = []
+        with self.transaction():
+            for messageid in self.store.lookup('localmessagequeue_unsent', True):
+                message = self.store.tables['localmessagequeue'][messageid]
+                chat = self.store.tables['chat'].get(message[3])
+                if chat is not None and chat[1] is not None and self._isclaimable(chat[0], workerid):
+                    messages.append(QueuedMessage(chat[0], chat[1], chat[2], messageid, message[4], message[1]))
+            self._claimchats(set(message.chatid for message in messages), workerid, leasetime)
+        return messages
+
+    def _clearonlineusers(self, workerid):
+        """Remove the cache of online user information kept by
+        workerid"""
+        with self.transaction():
+            for key in self.store.tables['onlinestatus'].keys():
+                if key[0] == workerid:
+                    self._put('onlinestatus', key, None)
+
+    def _close(self):
+        """Discard any unfinished transaction. The store itself lives
+        as long as the process."""
+        self._abort()
+
+    def _closechat(self, chatid, status):
+        """Mark the chat as closed with the given status code"""
+        with self.transaction():
+            row = self.store.tables['chat'][chatid]
+            self._put('chat', chatid, row[:4] + (time.time(), status) + row[6:])
+        MODULELOG.info("Chat #%d between %s and %s is closed." % (chatid, row[1], row[2]))
+
+    def _commit(self):
+        """Make the finished transaction's changes permanent and wake
+        anyone waiting for them"""
+        if self.undolog:
+            self.undolog = []
+            self.store.version += 1
+            self.store.condition.notifyAll()
+
+    def _countunsentlocalmessages(self, chatid):
+        """Return the number of the chat's messages still waiting to be
+        delivered to its localuser"""
+        with self.store.condition:
+            return len(self.store.lookup('localmessagequeue_chatid_unsent', chatid))
+
+    def _getallqueuedremotemessages(self, chatid, limit=None):
+        """Return the (possibly empty) list of messages queued for a
+        chat, oldest first, and mark them all sent in one transaction"""
+        with self.transaction():
+            rows = self._getunsentremotemessages(chatid, limit)
+            sendtime = time.time()
+            for row in rows:
+                self._put('remotemessagequeue', row[0], row[:2] + (sendtime,) + row[3:])
+        return [row[4] for row in rows]
+
+    def _getavailabilities(self):
+        """Return the (possibly empty) list of the Availabilities last
+        stored by each broker bot"""
+        with self.store.condition:
+            return [Availability(*row[1:]) for workerid, row in sorted(self.store.tables['availability'].iteritems())]
+
+    def _getavailablelocalusers(self):
+        """Return a list of localusers who are currently online from
+        at least one place, but not involved in a chat"""
+        with self.store.condition:
+            rows = self.store.tables['chat']
+            chattingusers = set(rows[chatid][1] for chatid in self.store.lookup('chat_status', self.STATUS_OPEN))
+            return sorted(set(localuser for (workerid, localuser, resource), row in self.store.tables['onlinestatus'].iteritems()
+                              if row[3] and localuser not in chattingusers))
+
+    def _getchatinfo(self, chatid):
+        """Return all the stored information about a chat"""
+        row = self.store.tables['chat'].get(chatid)
+        if row is None:
+            return None
+        return ChatInfo(*row)
+
+    def _getchatssince(self, lastchatid, limit, startedafter=None, startedbefore=None):
+        """Return the (possibly empty) list of up to limit ChatInfos
+        for the live and archived chats after lastchatid, in chatid
+        order"""
+        rows = []
+        with self.store.condition:
+            for table in ('chat', 'archive.chat'):
+                chatids = self.store.lookup('%s_chatid' % table, True)
+                found = 0
+                for chatid in chatids[bisect.bisect_right(chatids, lastchatid):]:
+                    if found >= limit:
+                        break
+                    row = self.store.tables[table][chatid]
+                    if (startedafter is None or row[3] >= startedafter) and (startedbefore is None or row[3] < startedbefore):
+                        rows.append(row)
+                        found += 1
+        rows.sort()
+        return [ChatInfo(*row) for row in rows[:limit]]
+
+    def _getchatswithstatus(self, status):
+        """Return the (possibly empty) list of chats with the given status"""
+        with self.store.condition:
+            rows = self.store.tables['chat']
+            return [ChatInfo(*rows[chatid]) for chatid in self.store.lookup('chat_status', status)]
+
+    def _getdataversion(self, chatid=None):
+        """Return a number that changes every time a change to the
+        store is committed. Every chat is in the same store, so chatid
+        makes no difference."""
+        return self.store.version
+
+    def _getfirstqueuedremotemessage(self, chatid):
+        """Return the oldest queued message for a chat"""
+        messages = self._getallqueuedremotemessages(chatid, 1)
+        if not messages:
+            return None
+        return messages[0]
+
+    def _getlocaluserchat(self, localuser):
+        """Return information about the localuser's current open chat,
+        if any (otherwise None)"""
+        with self.store.condition:
+            chatids = self.store.lookup('chat_localuser_status', (localuser, self.STATUS_OPEN))
+            if chatids:
+                return ChatInfo(*self.store.tables['chat'][chatids[0]])
+        return None
+
+    def _getlocaluserchats(self, localuser):
+        """Return the (possibly empty) list of the localuser's open
+        chats, oldest first"""
+        with self.store.condition:
+            rows = self.store.tables['chat']
+            return [ChatInfo(*rows[chatid]) for chatid in self.store.lookup('chat_localuser_status', (localuser, self.STATUS_OPEN))]
+
+    def _getmessagessince(self, chatid, queue, lastmessageid, limit):
+        """Return the (possibly empty) list of up to limit (messageid,
+        posttime, message) tuples for the chat's live and archived
+        messages in queue after lastmessageid, oldest first"""
+        if queue not in ('localmessagequeue', 'remotemessagequeue'):
+            raise ValueError('Unknown message queue: %s' % queue)
+        rows = []
+        with self.store.condition:
+            for table in (queue, 'archive.%s' % queue):
+                messageids = self.store.lookup('%s_chatid' % table, chatid)
+                start = bisect.bisect_right(messageids, lastmessageid)
+                rows.extend(self.store.tables[table][messageid] for messageid in messageids[start:start + limit])
+        rows.sort()
+        return [(row[0], row[1], row[4]) for row in rows[:limit]]
+
+    def _getqueuedepths(self):
+        """Return a dictionary mapping each message queue to the number
+        of messages waiting in it and the posttime of the oldest, which
+        is the first one queued"""
+        depths = {}
+        with self.store.condition:
+            for table in ('localmessagequeue', 'remotemessagequeue'):
+                messageids = self.store.lookup('%s_unsent' % table, True)
+                depths[table] = (len(messageids), self.store.tables[table][messageids[0]][1] if messageids else None)
+        return depths
+
+    def _getremotemessagessince(self, chatid, lastmessageid, limit=None):
+        """Return the (possibly empty) list of (messageid, message)
+        pairs queued for a chat after lastmessageid, oldest first, and
+        mark any unsent ones as sent"""
+        with self.transaction():
+            messageids = self.store.lookup('remotemessagequeue_chatid', chatid)
+            messageids = messageids[bisect.bisect_right(messageids, lastmessageid):]
+            if limit is not None:
+                messageids = messageids[:limit]
+            rows = [self.store.tables['remotemessagequeue'][messageid] for messageid in messageids]
+            sendtime = time.time()
+            for row in rows:
+                if row[2] is None:
+                    self._put('remotemessagequeue', row[0], row[:2] + (sendtime,) + row[3:])
+        return [(row[0], row[4]) for row in rows]
+
+    def _getunsentremotemessages(self, chatid, limit=None):
+        """Return the rows of the chat's undelivered remote messages,
+        oldest first"""
+        messageids = self.store.lookup('remotemessagequeue_chatid_unsent', chatid)
+        if limit is not None:
+            messageids = messageids[:limit]
+        return [self.store.tables['remotemessagequeue'][messageid] for messageid in messageids]
+
+    def _incrementalvacuum(self, pages):
+        """Do nothing, as there's no unused storage to release, and
+        return 0"""
+        return 0
+
+    def _isclaimable(self, chatid, workerid):
+        """Return True if no worker other than workerid has a current
+        claim on the chat"""
+        claim = self.store.tables['chatclaim'].get(chatid)
+        return claim is None or claim[1] == workerid or claim[2] < time.time()
+
+    def _markmessagessent(self, messageids):
+        """Record the time that all the given messages were sent, in
+        one transaction"""
+        sendtime = time.time()
+        with self.transaction():
+            for messageid in messageids:
+                row = self.store.tables['localmessagequeue'].get(messageid)
+                if row is not None:
+                    self._put('localmessagequeue', messageid, row[:2] + (sendtime,) + row[3:])
+
+    def _move(self, table, key):
+        """Move a row from a table to its archive"""
+        self._put('archive.%s' % table, key, self._put(table, key, None))
+
+    def _openchat(self, remoteuser, message=''):
+        """Issue a new chat request and return its chatid"""
+        with self.transaction():
+            chatid = self.store.nextid('chat')
+            self._put('chat', chatid, (chatid, None, remoteuser, time.time(), None, self.STATUS_WAITING, message))
+            self._queueremote(chatid, "Your chat request has been sent. Please wait while it is answered.")
+        return chatid
+
+    def _put(self, table, key, row):
+        """Store a row as part of the current transaction, and return
+        the row it replaced"""
+        oldrow = self.store.put(table, key, row)
+        self.undolog.append((table, key, oldrow))
+        return oldrow
+
+    def _queuelocal(self, chatid, message):
+        """Queue a message for delivery to a localuser"""
+        with self.transaction():
+            messageid = self.store.nextid('localmessagequeue')
+            self._put('localmessagequeue', messageid, (messageid, time.time(), None, chatid, message))
+
+    def _queueremote(self, chatid, message):
+        """Send a web message to the chat's remoteuser"""
+        with self.transaction():
+            messageid = self.store.nextid('remotemessagequeue')
+            self._put('remotemessagequeue', messageid, (messageid, time.time(), None, chatid, message))
+
+    def _releasechats(self, chatids, workerid):
+        """Give up workerid's claims on the chats"""
+        with self.transaction():
+            for chatid in chatids:
+                claim = self.store.tables['chatclaim'].get(chatid)
+                if claim is not None and claim[1] == workerid:
+                    self._put('chatclaim', chatid, None)
+
+    def _setavailability(self, availablelocalusers, waitingchats, workerid):
+        """Replace the Availability stored by workerid"""
+        with self.transaction():
+            row = self.store.tables['availability'].get(workerid)
+            generation = row[3] + 1 if row is not None else 1
+            self._put('availability', workerid, (workerid, availablelocalusers, waitingchats, generation, time.time()))
+
+    def _setchatstatus(self, chatid, status):
+        """Change the chat's status"""
+        with self.transaction():
+            row = self.store.tables['chat'].get(chatid)
+            if row is not None:
+                self._put('chat', chatid, row[:5] + (status,) + row[6:])
+
+    def _setonlinestatuses(self, statuses, workerid):
+        """Update (or store) whether each localuser is online from
+        each resource in a list of (localuser, resource, online)
+        changes seen by workerid, in one transaction"""
+        with self.transaction():
+            for localuser, resource, online in statuses:
+                self._put('onlinestatus', (workerid, localuser, resource), (workerid, localuser, resource, int(online)))
+
+    def _waitforchange(self, timeout, dataversion=None, chatid=None):
+        """Wait up to timeout seconds for another backend to commit a
+        change to the store since _getdataversion returned dataversion
+        (or since now, if it's None). Return True if one did, or False
+        if the timeout expired first."""
+        deadline = time.time() + timeout
+        with self.store.condition:
+            if dataversion is None:
+                dataversion = self.store.version
+            while self.store.version == dataversion:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.store.condition.wait(remaining)
+        return True
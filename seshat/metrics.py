@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright (c) 2011, Daycos
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#     * Neither the name of Daycos nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL
+# <COPYRIGHT HOLDER> BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+"""Counts and times what Seshat is doing
+
+A Metrics object collects counters, gauges, and latency histograms in
+memory and renders them in the Prometheus text format, to be written
+to a file or served over HTTP by a StatsServer. Wrapping a backend in
+an InstrumentedBackend times every call made to it."""
+
+from __future__ import with_statement
+
+import BaseHTTPServer
+import logging
+import os
+import tempfile
+import threading
+import time
+
+MODULELOG = logging.getLogger(__name__)
+
+# The upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+def _formatlabels(labels):
+    """Return the Prometheus representation of a sorted tuple of
+    (name, value) label pairs"""
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels)
+
+class Histogram(object):
+    """The distribution of a series of timings"""
+    def __init__(self):
+        """Create an empty histogram"""
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def copy(self):
+        """Return a copy of the histogram that won't change"""
+        histogram = Histogram()
+        histogram.buckets = self.buckets[:]
+        histogram.count = self.count
+        histogram.sum = self.sum
+        histogram.max = self.max
+        return histogram
+
+    def observe(self, value):
+        """Add a timing to the histogram"""
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, fraction):
+        """Return the upper bound of the bucket holding the given
+        fraction of the smallest timings, or the largest timing if it's
+        beyond the last bucket. Return None if the histogram is
+        empty."""
+        if not self.count:
+            return None
+        seen = 0
+        for index, bound in enumerate(BUCKETS):
+            seen += self.buckets[index]
+            if seen >= fraction * self.count:
+                return min(bound, self.max)
+        return self.max
+
+class Metrics(object):
+    """A thread-safe collection of counters, gauges, and histograms,
+    each identified by a name and optional labels"""
+    def __init__(self):
+        """Create an empty collection"""
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, amount=1, **labels):
+        """Add amount to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gethistograms(self, name):
+        """Return a dictionary mapping the labels of each of the named
+        histograms (as a dictionary's sorted items) to a copy of it"""
+        with self.lock:
+            return dict((labels, histogram.copy()) for (histogramname, labels), histogram in self.histograms.items()
+                        if histogramname == name)
+
+    def getvalue(self, name, **labels):
+        """Return the value of a counter or gauge, or 0 if it's never
+        been set"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            return self.counters.get(key, self.gauges.get(key, 0))
+
+    def observe(self, name, value, **labels):
+        """Add a timing (in seconds) to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def render(self):
+        """Return everything collected in the Prometheus text
+        format"""
+        lines = []
+        with self.lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                lastname = None
+                for (name, labels), value in sorted(values.items()):
+                    if name != lastname:
+                        lines.append('# TYPE %s %s' % (name, kind))
+                        lastname = name
+                    lines.append('%s%s %s' % (name, _formatlabels(labels), repr(value)))
+            lastname = None
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name != lastname:
+                    lines.append('# TYPE %s histogram' % name)
+                    lastname = name
+                seen = 0
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    seen += count
+                    lines.append('%s_bucket%s %d' % (name, _formatlabels(labels + (('le', repr(bound)),)), seen))
+                lines.append('%s_bucket%s %d' % (name, _formatlabels(labels + (('le', '+Inf'),)), histogram.count))
+                lines.append('%s_sum%s %s' % (name, _formatlabels(labels), repr(histogram.sum)))
+                lines.append('%s_count%s %d' % (name, _formatlabels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def setgauge(self, name, value, **labels):
+        """Set a gauge to value"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def writefile(self, path):
+        """Replace the file at path with everything collected, in the
+        Prometheus text format. Readers never see a partly written
+        file."""
+        handle, temppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.%s.' % os.path.basename(path))
+        try:
+            os.write(handle, self.render())
+        finally:
+            os.close(handle)
+        os.rename(temppath, path)
+
+class InstrumentedBackend(object):
+    """Passes everything through to a backend, recording how long each
+    of its internal methods takes in the seshat_backend_seconds
+    histogram and how often each fails in the
+    seshat_backend_errors_total counter"""
+    def __init__(self, backend, metrics):
+        """Wrap backend, recording into metrics"""
+        self.wrapped = backend
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        """Return the backend's attribute, timing it if it's an
+        internal method"""
+        value = getattr(self.wrapped, name)
+        if not name.startswith('_') or name.startswith('__') or not callable(value):
+            return value
+        def timed(*args, **kwargs):
+            """Call the backend's method and record how long it took"""
+            starttime = time.time()
+            try:
+                return value(*args, **kwargs)
+            except Exception:
+                self.metrics.increment('seshat_backend_errors_total', method=name)
+                raise
+            finally:
+                self.metrics.observe('seshat_backend_seconds', time.time() - starttime, method=name)
+        return timed
+
+class _StatsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers every GET request with the server's metrics"""
+    def do_GET(self):
+        """Send the metrics in the Prometheus text format"""
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Log requests through the logging module instead of to
+        stderr"""
+        MODULELOG.debug(format, *args)
+
+class StatsServer(BaseHTTPServer.HTTPServer):
+    """Serves metrics over HTTP from a background thread, for
+    Prometheus or anything else to scrape"""
+    def __init__(self, metrics, port, address='127.0.0.1'):
+        """Listen on the given port, which is only reachable from this
+        machine unless address says otherwise"""
+        BaseHTTPServer.HTTPServer.__init__(self, (address, int(port)), _StatsRequestHandler)
+        self.metrics = metrics
+
+    def start(self):
+        """Begin serving requests in a daemon thread"""
+        thread = threading.Thread(target=self.serve_forever, name='seshat-stats')
+        thread.setDaemon(True)
+        thread.start()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright (c) 2011, Daycos
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#     * Neither the name of Daycos nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL
+# <COPYRIGHT HOLDER> BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+"""Lets clients wake the broker bot as soon as they've queued work
+
+Clients send an empty datagram to a Unix socket after they write to
+the database, and the broker bot waits on that socket alongside its
+Jabber connection instead of polling the database. Notifications are
+only hints: the broker bot still checks the database every so often in
+case one is lost.
+
+When several broker bots share a database, each listens at its own
+socket named after the shared path and its workerid (for example,
+"/tmp/seshat.db.notify.host:1234"), and clients signal all of them."""
+
+import errno
+import logging
+import os
+import socket
+import time
+
+MODULELOG = logging.getLogger(__name__)
+
+# How often (in seconds) a Notifier looks for broker bots that have
+# started or stopped listening
+LISTENERREFRESH = 5
+
+def getnotifypath(sqlitedb):
+    """Return the default notification socket path for a database, or
+    None if this platform doesn't support Unix sockets"""
+    if not hasattr(socket, 'AF_UNIX') or sqlitedb == ':memory:':
+        return None
+    return os.path.abspath(sqlitedb) + '.notify'
+
+def getlistenerpaths(path):
+    """Return the sockets that broker bots may be listening at for
+    path: path itself and every broker bot's socket named after it"""
+    directory, name = os.path.split(path)
+    try:
+        names = os.listdir(directory or os.curdir)
+    except OSError:
+        return []
+    return [os.path.join(directory, entry) for entry in sorted(names) if entry == name or entry.startswith(name + '.')]
+
+def getworkerpath(path, workerid):
+    """Return the socket that the broker bot named workerid listens at
+    for path"""
+    return '%s.%s' % (path, workerid.replace(os.sep, '_'))
+
+def removedeadlisteners(path):
+    """Remove the sockets named after path that nobody is listening
+    at any more, so that clients stop signaling them"""
+    for listenerpath in getlistenerpaths(path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.connect(listenerpath)
+        except socket.error, error:
+            if error.errno == errno.ECONNREFUSED:
+                try:
+                    os.unlink(listenerpath)
+                except OSError:
+                    pass
+                else:
+                    MODULELOG.info('Removed the abandoned notification socket %s', listenerpath)
+        finally:
+            sock.close()
+
+class Notifier(object):
+    """The client's end of the notification socket"""
+    def __init__(self, path):
+        """Prepare to signal the broker bots listening at path"""
+        self.path = path
+        self.sock = None
+        self.listenerpaths = []
+        self.nextrefreshtime = 0
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.setblocking(0)
+
+    def notify(self):
+        """Tell the broker bots that there's new work in the database.
+        This never blocks and silently does nothing if no broker bot
+        is listening."""
+        if self.sock is None:
+            return
+        if time.time() >= self.nextrefreshtime:
+            self.listenerpaths = getlistenerpaths(self.path)
+            self.nextrefreshtime = time.time() + LISTENERREFRESH
+        for listenerpath in self.listenerpaths:
+            try:
+                self.sock.sendto('', listenerpath)
+            except socket.error:
+                # Either nobody's listening or the broker bot already
+                # has a backlog of notifications waiting for it.
+                # Either way, it'll find the work soon enough.
+                pass
+
+    def close(self):
+        """Release the socket"""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+class NotificationListener(object):
+    """The broker bot's end of the notification socket"""
+    def __init__(self, path, workerid=None):
+        """Listen for notifications at path, or at the socket named
+        after it for the broker bot called workerid, if given.
+        Sockets left behind there (and beside it, by other broker bots
+        that have stopped) are replaced or removed."""
+        if workerid is not None:
+            removedeadlisteners(path)
+            path = getworkerpath(path, workerid)
+        self.path = path
+        try:
+            os.unlink(path)
+        except OSError, error:
+            if error.errno != errno.ENOENT:
+                raise
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        # Web applications often run as a different user than the
+        # broker bot
+        os.chmod(path, 0666)
+        self.sock.setblocking(0)
+        MODULELOG.info('Listening for client notifications at %s', path)
+
+    def fileno(self):
+        """Let the listener be passed directly to select.select"""
+        return self.sock.fileno()
+
+    def drain(self):
+        """Discard every waiting notification and return how many there
+        were"""
+        count = 0
+        while True:
+            try:
+                self.sock.recv(1)
+            except socket.error:
+                return count
+            count += 1
+
+    def close(self):
+        """Stop listening and remove the socket"""
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright (c) 2011, Daycos
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#     * Neither the name of Daycos nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL
+# <COPYRIGHT HOLDER> BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+"""Moves delivered messages and finished chats out of the live tables
+
+Nothing in the rest of Seshat ever deletes a row, so without this the
+queues and chat table grow forever. An Archiver moves everything older
+than a given age to a separate archive database in small batches, each
+in its own short transaction, so live chats never wait long for the
+write lock. It can be driven a step at a time by the broker bot or run
+to completion from the command line:
+
+    $ ./retention.py sample.ini Seshat"""
+
+import logging
+import time
+
+import backend
+
+MODULELOG = logging.getLogger(__name__)
+
+# How many free pages to return to the filesystem per step
+VACUUMPAGES = 1000
+
+# The archive's path, given the database's, unless the "archivedb"
+# setting says otherwise
+ARCHIVEPATH = '%s.archive'
+
+def getarchivedb(storage, archivedb=None):
+    """Return archivedb, or if it's None, the default archive for the
+    Backend: ':memory:' if it keeps its data in memory, or else its
+    location with ".archive" appended. Raise ValueError if the backend
+    has no location to name the archive after."""
+    if archivedb is not None:
+        return archivedb
+    if storage.inmemory:
+        return ':memory:'
+    if storage.location is None:
+        raise ValueError('The Seshat backend has no location to name its archive after. Set "archivedb" to choose one.')
+    return ARCHIVEPATH % storage.location
+
+class Archiver(object):
+    """Archives a backend's old messages and chats in bounded steps"""
+
+    def __init__(self, backend, archivedb, maxage, batchsize=500):
+        """Prepare to move rows more than maxage seconds old from the
+        backend's database into archivedb, at most batchsize rows per
+        table per step"""
+        self.backend = backend
+        self.archivedb = archivedb
+        self.maxage = maxage
+        self.batchsize = batchsize
+        self.cutoff = None
+        self.phase = None
+        self.freepages = None
+
+    def step(self):
+        """Do one bounded batch of work. Return True if there is more
+        to do in the current pass, or False once the pass is finished.
+        The first call after a finished pass starts a new one."""
+        if self.phase is None:
+            self.backend._attacharchive(self.archivedb)
+            self.cutoff = time.time() - self.maxage
+            self.phase = 'messages'
+            MODULELOG.info('Archiving messages and chats older than %s', time.ctime(self.cutoff))
+        if self.phase == 'messages':
+            moved = self.backend._archivemessages(self.cutoff, self.batchsize)
+            MODULELOG.debug('Archived %d messages', moved)
+            if moved < self.batchsize:
+                self.phase = 'chats'
+            return True
+        if self.phase == 'chats':
+            moved = self.backend._archivechats(self.cutoff, self.batchsize)
+            MODULELOG.debug('Archived %d chats', moved)
+            if moved < self.batchsize:
+                self.phase = 'vacuum'
+                self.freepages = None
+            return True
+        # Stop once everything's returned, or if a step returns nothing
+        freepages = self.backend._incrementalvacuum(VACUUMPAGES)
+        if freepages and (self.freepages is None or freepages < self.freepages):
+            self.freepages = freepages
+            return True
+        MODULELOG.info('Finished archiving')
+        self.phase = None
+        return False
+
+    def run(self, pause=0.1):
+        """Archive everything that's due, sleeping pause seconds
+        between steps to let other clients at the database"""
+        while self.step():
+            time.sleep(pause)
+
+def main(configfile, section):
+    """Archive the database named in the configuration (.ini) file,
+    in the specified section"""
+    import ConfigParser
+
+    logging.basicConfig()
+    logging.getLogger('').setLevel(logging.INFO)
+    config = ConfigParser.ConfigParser()
+    config.read(configfile)
+    settings = dict(config.items(section))
+    retentiondays = backend.getsetting(settings, 'retentiondays')
+    if retentiondays is None:
+        raise ConfigParser.NoOptionError('retentiondays', section)
+    storage = backend.getbackend(settings)
+    archivedb = getarchivedb(storage, backend.getsetting(settings, 'archivedb'))
+    Archiver(storage, archivedb, float(retentiondays) * 86400).run()
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3:
+        print "You must give a config file and section name"
+        sys.exit()
+    main(sys.argv[1], sys.argv[2])
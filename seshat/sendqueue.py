@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""Paces the broker bot's messages to localusers
+
+Jabber servers throttle or disconnect clients that send too much, too
+fast. An Outbox holds the broker bot's outgoing messages and releases
+them to each localuser no faster than a token bucket allows: up to
+burst messages at once, then rate messages per second. Messages to a
+localuser that pile up while they wait, or that are queued within
+coalesce seconds of each other, are sent together as one stanza."""
+
+from __future__ import with_statement
+
+import threading
+import time
+
+import backend
+
+# How many stanzas per second each localuser may be sent after the
+# first burst, and how big that burst may be. A rate of 0 means no
+# limit.
+RATE = 5
+BURST = 10
+
+# How long (in seconds) to hold a message for others to the same
+# localuser to join it
+COALESCE = 0
+
+# The longest (in characters) that merged messages may grow
+MAXLENGTH = 4000
+
+class Outbox(object):
+    """Holds each localuser's outgoing messages until their token
+    bucket allows them to be sent. It's safe to use from several
+    threads."""
+
+    def __init__(self, rate=RATE, burst=BURST, coalesce=COALESCE):
+        """Prepare to send up to burst stanzas at once to each
+        localuser, and rate stanzas per second after that"""
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.coalesce = float(coalesce)
+        self.condition = threading.Condition(threading.Lock())
+        # localuser -> [tokens left, time the tokens were counted]
+        self.buckets = {}
+        # localuser -> list of [time first queued, list of messages,
+        # total length, list of their messageids], oldest first
+        self.pending = {}
+        self.depth = 0
+
+    def __len__(self):
+        """Return the number of messages waiting to be sent"""
+        with self.condition:
+            return self.depth
+
+    def get(self, timeout=None):
+        """Return the (possibly empty) list of (localuser, messages,
+        messageids) tuples that may be sent now, each list of messages
+        to be sent as one stanza. messageids lists the ids given to
+        put for those messages. If there aren't any, wait up to
+        timeout seconds (or forever if None) for some."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                now = time.time()
+                ready, delay = self._takeready(now)
+                if ready:
+                    return ready
+                if deadline is not None:
+                    if now >= deadline:
+                        return []
+                    delay = deadline - now if delay is None else min(delay, deadline - now)
+                self.condition.wait(delay)
+
+    def nextready(self):
+        """Return how many seconds until another message may be sent,
+        0 if one may be sent now, or None if nothing is waiting"""
+        now = time.time()
+        nextready = None
+        with self.condition:
+            for localuser, batches in self.pending.items():
+                delay = self._getdelay(localuser, batches[0], now)
+                if nextready is None or delay < nextready:
+                    nextready = delay
+        return nextready
+
+    def put(self, localuser, message, messageid=None):
+        """Queue a message to the localuser, adding it to the stanza
+        they're already waiting on if there's room. messageid, if
+        given, is handed back by get with the message, so that queued
+        messages can be marked sent once they really are."""
+        with self.condition:
+            batches = self.pending.setdefault(localuser, [])
+            if batches and batches[-1][2] + 1 + len(message) <= MAXLENGTH:
+                batches[-1][1].append(message)
+                batches[-1][2] += 1 + len(message)
+            else:
+                batches.append([time.time(), [message], len(message), []])
+            if messageid is not None:
+                batches[-1][3].append(messageid)
+            self.depth += 1
+            self.condition.notifyAll()
+
+    def _getdelay(self, localuser, batch, now):
+        """Return how many seconds until the batch of messages may be
+        sent to the localuser"""
+        delay = batch[0] + self.coalesce - now
+        if self.rate:
+            tokens = self._gettokens(localuser, now)
+            if tokens < 1:
+                delay = max(delay, (1 - tokens) / self.rate)
+        return max(delay, 0)
+
+    def _gettokens(self, localuser, now):
+        """Return how many stanzas the localuser may be sent now"""
+        tokens, counted = self.buckets.get(localuser, (self.burst, now))
+        return min(self.burst, tokens + (now - counted) * self.rate)
+
+    def _takeready(self, now):
+        """Remove and return the list of (localuser, messages,
+        messageids) tuples that may be sent now, and how many seconds
+        until the next may be sent (or None if nothing else is
+        waiting)"""
+        ready = []
+        nextready = None
+        for localuser, batches in self.pending.items():
+            while batches:
+                delay = self._getdelay(localuser, batches[0], now)
+                if delay > 0:
+                    if nextready is None or delay < nextready:
+                        nextready = delay
+                    break
+                batch = batches.pop(0)
+                ready.append((localuser, batch[1], batch[3]))
+                self.depth -= len(batch[1])
+                if self.rate:
+                    self.buckets[localuser] = (self._gettokens(localuser, now) - 1, now)
+            if not batches:
+                del self.pending[localuser]
+        return ready, nextready
+
+def fromsettings(settings):
+    """Return an Outbox configured by the "sendrate", "sendburst", and
+    "sendcoalesce" settings (see: backend.getsetting)"""
+    options = {}
+    for key, option in (('sendrate', 'rate'), ('sendburst', 'burst'), ('sendcoalesce', 'coalesce')):
+        value = backend.getsetting(settings, key)
+        if value is not None:
+            options[option] = value
+    return Outbox(**options)
@@ -22,22 +22,64 @@
 It handles chat requests and relays conversations between web visitors
 and defined Jabber accounts."""
 
+from __future__ import with_statement
+
 import logging
+import os
 import re
+import select
+import socket
+import threading
 import time
 import xmpp
 
+import backend
+import dispatch
+import metrics
+import notify
+import retention
+import sendqueue
 import sqlitebackend
 
 MODULELOG = logging.getLogger(__name__)
 
+# How often (in seconds) to check the database for work even if no
+# client has sent a notification, in case one was lost
+IDLEPOLLINTERVAL = 5
+
+# How often (in seconds) to archive old messages and chats, if
+# retention is configured
+RETENTIONINTERVAL = 3600
+
+# How long (in seconds) other broker bots leave a chat alone after this
+# one claims it. Claims are normally released as soon as the work is
+# done, so this only matters if a broker bot dies holding one.
+LEASETIME = 60
+
+# The least time (in seconds) between writes of localusers' online
+# statuses to the database. Changes in between are written together.
+PRESENCEINTERVAL = 0.25
+
+# How often (in seconds) to publish the localusers' availability even
+# if it hasn't changed, so that clients can tell the broker bot is
+# still running (see: client.AVAILABILITYSTALE)
+AVAILABILITYINTERVAL = 30
+
+# How often (in seconds) to refresh the queue depths and other gauges
+# and rewrite the stats file, if stats are exported
+STATSINTERVAL = 15
+
+# When localusers can handle several chats at once, messages starting
+# with "#n " go to chat #n
+ROUTEPATTERN = re.compile(r'^#(\d+)\s+(.*)$', re.DOTALL)
+
 # This stores the list of methods decorated by _handlecommand
 COMMANDPATTERNS = []
 
 class CommandDefinition(object):
     """Describes a function that implements a chat command"""
     def __init__(self, function, pattern, helptext):
-        """See: sqlitebackend.ChatInfo.__init__.__doc__"""
+        """See: backend.ChatInfo.__init__.__doc__"""
         self.function = function
         self.pattern = pattern
         self.helptext = helptext
@@ -54,33 +96,130 @@ def _handlecommand(pattern, helptext):
         return function
     return register
 
-class SeshatServer(sqlitebackend.SqliteBackend):
+class SeshatServer(backend.ChatStatuses):
     """The broker bot acts as an intermediary between a web chat and a
     Jabber session. It passes messages both ways and handles all
     bookkeeping."""
     
     #### Public methods
 
-    def __init__(self, username, password, localusers, sqlitedb):
+    def __init__(self, username, password, localusers, backend, notifysocket=None, archivedb=None, retentiondays=None, workerid=None,
+                 xmppclient=None, scheduler=None, statsfile=None, statsport=None, outbox=None):
         """Establish a connection to a Jabber server and prepare to
-        manage it"""
-        super(SeshatServer, self).__init__(sqlitedb)
+        manage it, storing everything through the given Backend (or,
+        for compatibility with older versions, in the SQLite database
+        at the given path). Clients wake the server through
+        notifysocket, or the backend's default notification socket if
+        None (see: seshat.notify). If retentiondays is given, messages
+        and chats older than that are moved to archivedb every
+        RETENTIONINTERVAL seconds (see: seshat.retention).
+
+        Several broker bots may share a backend, each logged in as its
+        own Jabber account or resource (as in "bot@example.com/two").
+        They claim chats by workerid before working on them, which
+        defaults to a name unique to this process.
+
+        xmppclient replaces the xmpp.Client that would otherwise
+        connect to the Jabber server, such as with a
+        fakexmpp.FakeClient for testing. scheduler is the
+        dispatch.Scheduler that decides who is offered each chat,
+        which by default offers every chat to every free localuser
+        and lets each handle one chat at a time. outbox is the
+        sendqueue.Outbox that paces and merges messages to localusers.
+
+        Every backend call and pass through the main loop is counted
+        and timed (see: seshat.metrics). Every STATSINTERVAL seconds
+        the totals are written to statsfile, if given, and they can be
+        fetched over HTTP from statsport on localhost, if given.
+        Localusers can see a summary with !STATS."""
+        if isinstance(backend, basestring):
+            backend = sqlitebackend.SqliteBackend(backend)
+        self.metrics = metrics.Metrics()
+        self.backend = metrics.InstrumentedBackend(backend, self.metrics)
         
         self.localusers = localusers
         self.password = password
         self.jid = xmpp.protocol.JID(username)
         self.xmppserver = self.jid.getDomain()
 
-        # Set all users to offline. Their real status will be updated
-        # by _presencehandler as soon as we connect and send our
-        # presence.
-        self._clearonlineusers()
+        if workerid is None:
+            workerid = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.workerid = workerid
+
+        # Set all users to offline, as far as this bot knows. Their
+        # real status will be updated by _presencehandler as soon as
+        # we connect and send our presence.
+        self.backend._clearonlineusers(self.workerid)
         self.onlineresource = {}
         for localuser in self.localusers:
             self.onlineresource[localuser] = {}
+
+        # Online status changes waiting to be written, and what's
+        # already in the database, as (localuser, resource) -> online.
+        # Anyone missing from the database is offline.
+        self.presencelock = threading.Lock()
+        self.pendingpresence = {}
+        self.savedpresence = {}
+        self.nextpresencetime = 0
+
+        # The (available localusers, waiting chats) counts last
+        # published for clients
+        self.publishedavailability = None
+        self.nextavailabilitytime = 0
+
+        # An in-memory index of the localusers who are online from at
+        # least one resource. The database is only a mirror of it. It's
+        # replaced rather than changed, under presencelock, so any
+        # thread can safely iterate over the copy it has. The
+        # scheduler keeps track of who is handling which chats.
+        self.onlineusers = frozenset()
+        if scheduler is None:
+            scheduler = dispatch.Scheduler()
+        self.scheduler = scheduler
+        self._refreshopenchats()
+        if outbox is None:
+            outbox = sendqueue.Outbox()
+        self.outbox = outbox
+
+        # The claimed messages waiting in the outbox, by messageid.
+        # They're only marked sent, and their chats released, once
+        # they've really been sent.
+        self.outgoinglock = threading.Lock()
+        self.outgoing = {}
+
+        # Set while the Jabber connection is up
+        self.connected = threading.Event()
+
+        # Let clients wake us as soon as they queue something. Without
+        # this, fall back to checking the database every second.
+        self.listener = None
+        if notifysocket is None:
+            notifysocket = backend.notifypath
+        if notifysocket is not None:
+            try:
+                self.listener = notify.NotificationListener(notifysocket, self.workerid)
+            except (socket.error, OSError):
+                MODULELOG.exception("Unable to listen for client notifications at %s. Polling the database instead." % notifysocket)
+
+        # Archive a batch at a time between other work so that live
+        # chats aren't held up
+        self.archiver = None
+        self.archiving = False
+        self.nextarchivetime = time.time()
+        if retentiondays is not None:
+            self.archiver = retention.Archiver(self.backend, retention.getarchivedb(backend, archivedb), float(retentiondays) * 86400)
+
+        self.statsfile = statsfile
+        self.statsserver = None
+        if statsport is not None:
+            self.statsserver = metrics.StatsServer(self.metrics, statsport)
+            self.statsserver.start()
+        self.nextstatstime = time.time()
         
         # Establish a Jabber connection
-        self.client = xmpp.Client(self.xmppserver, debug=[])
+        if xmppclient is None:
+            xmppclient = xmpp.Client(self.xmppserver, debug=[])
+        self.client = xmppclient
         self._connect()
         self.client.RegisterHandler('message', self._messagehandler)
         self.client.RegisterHandler('presence', self._presencehandler)
@@ -88,34 +227,60 @@ class SeshatServer(sqlitebackend.SqliteBackend):
     def run(self):
         """Continually handle events until an error occurs"""
         while True:
-            # Look for new chat requests and notify all online
-            # localusers of each one
-            for chat in self._getchatswithstatus(self.STATUS_WAITING):
-                availableusers = self._getavailablelocalusers()
-                if availableusers:
-                    message = "Remote user '%s' wants to start a conversation." % chat.remoteuser
-                    if chat.startmessage:
-                        message += " The starting message is: '%s'" % chat.startmessage
-                    message += " To accept this request, reply with the message '!ACCEPT %d'." % chat.chatid
-                    for localuser in availableusers:
-                        basemessage = message
-                        if len(availableusers) > 1:
-                            message += " Requests were also sent to: %s." % ', '.join(user for user in availableusers if user != localuser)
-                        self._localsend(localuser, message)
-                        MODULELOG.info("A chat request from %s was sent to %s" % (chat.remoteuser, localuser))
-                        message = basemessage
-                    self._setchatstatus(chat.chatid, self.STATUS_NOTIFIED)
-                else:
-                    self._queueremote(chat.chatid, "No one is available to answer your chat request right now.")
-                    self._setchatstatus(chat.chatid, self.STATUS_FAILED)
+            starttime = time.time()
+
+            # Visitors can close chats without telling us, so catch up
+            # before deciding who's free or telling clients
+            self._refreshopenchats()
+
+            # Offer new chat requests, and requests whose last offer
+            # went unanswered, to the localusers chosen by the
+            # scheduler
+            if self.scheduler.waiting():
+                # Offers can be accepted by another broker bot or given
+                # up on by their visitors, so stop tracking them
+                self.scheduler.prune([chat.chatid for status in (self.STATUS_WAITING, self.STATUS_NOTIFIED)
+                                      for chat in self.backend._getchatswithstatus(status)])
+            waitingchats = self.backend._claimchatswithstatus(self.STATUS_WAITING, self.workerid, LEASETIME)
+            expiredchatids = self.scheduler.expiredoffers()
+            held = 0
+            for chatid in expiredchatids:
+                chat = self.backend._getchatinfo(chatid)
+                if chat is None or chat.status != self.STATUS_NOTIFIED:
+                    self.scheduler.forget(chatid)
+                elif not self._offerchat(chat) and self._holdchat(chat, held):
+                    held += 1
+            for chat in waitingchats:
+                if not self._offerchat(chat) and self._holdchat(chat, held):
+                    held += 1
+            if waitingchats:
+                self.backend._releasechats([chat.chatid for chat in waitingchats], self.workerid)
 
             # Look for new queued messages for localusers and send them
-            for message in self._getallqueuedlocalmessages():
-                self._localsend(message.localuser, message.message)
-                MODULELOG.info("%s said to %s in chat #%d: '%s'", message.remoteuser, message.localuser, message.chatid, message.message)
-                self._markmessagesent(message.messageid)
+            self._sendqueuedlocalmessages()
+
+            self._savepresence()
+            self._publishavailability()
+
+            if self.archiver is not None and (self.archiving or time.time() >= self.nextarchivetime):
+                self.archiving = self.archiver.step()
+                if not self.archiving:
+                    self.nextarchivetime = time.time() + RETENTIONINTERVAL
+
+            if (self.statsfile is not None or self.statsserver is not None) and time.time() >= self.nextstatstime:
+                self._updatestats()
+                if self.statsfile is not None:
+                    try:
+                        self.metrics.writefile(self.statsfile)
+                    except (IOError, OSError):
+                        MODULELOG.exception("Unable to write the stats file %s" % self.statsfile)
+                self.nextstatstime = time.time() + STATSINTERVAL
+            self._flushoutbox()
+            self.metrics.observe('seshat_loop_seconds', time.time() - starttime)
             
-            if self.client.Process(1) == 0:
+            # Don't sleep while there's more archiving to do
+            if self._waitforevents(0 if self.archiving else IDLEPOLLINTERVAL) == 0:
+                self.connected.clear()
                 MODULELOG.info("Disconnected from the server. Reconnecting soon.")
                 time.sleep(20)
                 self._connect()
@@ -126,17 +291,237 @@ class SeshatServer(sqlitebackend.SqliteBackend):
     def _connect(self):
         """Connect to the Jabber server"""
         self.client.connect()
-        self.client.auth(self.jid.getNode(), self.password)
+        self.client.auth(self.jid.getNode(), self.password, self.jid.getResource())
         self.client.sendInitPresence()
+        self.connected.set()
+
+    def _flushoutbox(self):
+        """Send every message the outbox will release now, unless the
+        bot is disconnected"""
+        if not self.connected.isSet():
+            return
+        for localuser, messages, messageids in self.outbox.get(0):
+            self._sendbatch(localuser, messages, messageids)
+
+    def _forgetoutgoing(self, messageids):
+        """Stop tracking the messages without marking them sent, so
+        that they're fetched and queued again"""
+        with self.outgoinglock:
+            for messageid in messageids:
+                self.outgoing.pop(messageid, None)
+
+    def _getavailablelocalusers(self):
+        """Return a sorted list of localusers who are currently online
+        from at least one place and can take another chat. Unlike
+        SqliteBackend._getavailablelocalusers, this doesn't touch the
+        database."""
+        return self.scheduler.available(self.onlineusers)
+
+    def _getcurrentchat(self, localuser):
+        """Return the ChatInfo for the open chat that the localuser's
+        messages go to, or None if they aren't in a chat. That's the
+        one they last accepted or addressed, or else their newest."""
+        chats = self.backend._getlocaluserchats(localuser)
+        if not chats:
+            return None
+        currentchatid = self.scheduler.currentchat(localuser)
+        for chat in chats:
+            if chat.chatid == currentchatid:
+                return chat
+        return chats[-1]
+
+    def _offerchat(self, chat):
+        """Send a chat request to the localusers chosen by the
+        scheduler. Return True if anyone was offered it."""
+        offerto = self.scheduler.choose(chat.chatid, self.onlineusers)
+        if not offerto:
+            return False
+        # Record the offer before sending it, or an answer handled by
+        # another thread could be overwritten
+        if chat.status == self.STATUS_WAITING:
+            self.backend._setchatstatus(chat.chatid, self.STATUS_NOTIFIED)
+        message = "Remote user '%s' wants to start a conversation." % chat.remoteuser
+        if chat.startmessage:
+            message += " The starting message is: '%s'" % chat.startmessage
+        message += " To accept this request, reply with the message '!ACCEPT %d'." % chat.chatid
+        for localuser in offerto:
+            basemessage = message
+            if len(offerto) > 1:
+                message += " Requests were also sent to: %s." % ', '.join(user for user in offerto if user != localuser)
+            self._localsend(localuser, message)
+            MODULELOG.info("A chat request from %s was sent to %s" % (chat.remoteuser, localuser))
+            message = basemessage
+        self.metrics.increment('seshat_chat_offers_total', len(offerto))
+        return True
+
+    def _publishavailability(self):
+        """Store how many localusers can take a chat and how many chats
+        are waiting, for clients to read, if that's changed or hasn't
+        been stored for AVAILABILITYINTERVAL seconds"""
+        availability = (len(self._getavailablelocalusers()), self.scheduler.waiting())
+        if availability != self.publishedavailability or time.time() >= self.nextavailabilitytime:
+            self.backend._setavailability(availability[0], availability[1], self.workerid)
+            self.publishedavailability = availability
+            self.nextavailabilitytime = time.time() + AVAILABILITYINTERVAL
+
+    def _refreshopenchats(self):
+        """Reload the record of which localusers are handling which
+        chats from the database"""
+        self.scheduler.refresh(self.backend._getchatswithstatus(self.STATUS_OPEN))
 
     def _replywithhelp(self, localuser, message):
         """Append a help text to the end of the message, then send
         it"""
         self._localsend(localuser, message + " Send '!HELP' for more options.")
 
-    def _localsend(self, localuser, message):
-        """Send a Jabber message to the localuser"""
-        self.client.send(xmpp.protocol.Message(localuser, message, typ='chat'))
+    def _holdchat(self, chat, position):
+        """Keep a chat request that nobody can take now waiting, if
+        there's room in the queue and someone to eventually take it,
+        or else fail it. position is how many requests are being held
+        ahead of it. Return True if it's being held."""
+        hold = self.scheduler.hold(chat.chatid, position) if self.onlineusers else 'fail'
+        if hold == 'fail':
+            with self.backend.transaction():
+                self.backend._queueremote(chat.chatid, "No one is available to answer your chat request right now.")
+                self.backend._setchatstatus(chat.chatid, self.STATUS_FAILED)
+            self.scheduler.forget(chat.chatid)
+            return False
+        if hold == 'wait':
+            self.backend._queueremote(chat.chatid, "Everyone is busy right now. Your chat will start as soon as someone is free.")
+        return True
+
+    def _localsend(self, localuser, message, messageid=None):
+        """Queue a Jabber message to the localuser, to be sent as soon
+        as the outbox allows. messageid is the id of the queued local
+        message it delivers, if any (see: _markdelivered)."""
+        self.outbox.put(localuser, message, messageid)
+
+    def _markdelivered(self, messageids):
+        """Mark the claimed messages sent, now that they have been,
+        and release the chats that have no others still waiting in the
+        outbox, all at once. They're tracked as outgoing until that's
+        committed, or another thread could claim and queue them
+        again."""
+        if not messageids:
+            return
+        with self.outgoinglock:
+            messages = [self.outgoing[messageid] for messageid in messageids if messageid in self.outgoing]
+            delivered = set(message.messageid for message in messages)
+            busychatids = set(message.chatid for message in self.outgoing.itervalues() if message.messageid not in delivered)
+        now = time.time()
+        for message in messages:
+            if message.posttime is not None:
+                self.metrics.observe('seshat_message_wait_seconds', now - message.posttime, queue='localmessagequeue')
+        self.metrics.increment('seshat_messages_total', len(messages), queue='localmessagequeue')
+        try:
+            with self.backend.transaction():
+                self.backend._markmessagessent(sorted(delivered))
+                self.backend._releasechats(set(message.chatid for message in messages) - busychatids, self.workerid)
+        finally:
+            self._forgetoutgoing(delivered)
+
+    def _sendbatch(self, localuser, messages, messageids):
+        """Send a batch released by the outbox, then mark the queued
+        local messages in it sent. If it can't be sent, they're left
+        unsent to be fetched again."""
+        try:
+            self._sendstanza(localuser, messages)
+        except:
+            self._forgetoutgoing(messageids)
+            raise
+        self._markdelivered(messageids)
+
+    def _sendqueuedlocalmessages(self):
+        """Queue the messages waiting for localusers in chats no other
+        broker bot is working on to be sent. Claiming them renews the
+        claims on chats whose messages are still in the outbox, which
+        are released as they're sent (see: _markdelivered)."""
+        messages = self.backend._claimqueuedlocalmessages(self.workerid, LEASETIME)
+        if not messages:
+            return
+        with self.outgoinglock:
+            messages = [message for message in messages if message.messageid not in self.outgoing]
+            for message in messages:
+                self.outgoing[message.messageid] = message
+        for index, message in enumerate(messages):
+            try:
+                if self.scheduler.maxchats > 1:
+                    # Tell the localuser which chat it's from
+                    self._localsend(message.localuser, '#%d %s: %s' % (message.chatid, message.remoteuser, message.message), message.messageid)
+                else:
+                    self._localsend(message.localuser, message.message, message.messageid)
+            except:
+                self._forgetoutgoing([unqueued.messageid for unqueued in messages[index:]])
+                raise
+            MODULELOG.info("%s said to %s in chat #%d: '%s'", message.remoteuser, message.localuser, message.chatid, message.message)
+
+    def _savepresence(self):
+        """Write the online statuses that changed since they were last
+        written, all at once, unless that was less than
+        PRESENCEINTERVAL seconds ago. Statuses that changed and then
+        changed back aren't written at all."""
+        with self.presencelock:
+            now = time.time()
+            if not self.pendingpresence or now < self.nextpresencetime:
+                return
+            changes = [(localuser, resource, online) for (localuser, resource), online in sorted(self.pendingpresence.items())
+                       if self.savedpresence.get((localuser, resource), False) != online]
+            self.pendingpresence = {}
+            self.nextpresencetime = now + PRESENCEINTERVAL
+            if not changes:
+                return
+            try:
+                self.backend._setonlinestatuses(changes, self.workerid)
+            except Exception:
+                # Try again later, unless they've changed since
+                for localuser, resource, online in changes:
+                    self.pendingpresence.setdefault((localuser, resource), online)
+                raise
+            for localuser, resource, online in changes:
+                self.savedpresence[(localuser, resource)] = online
+
+    def _sendstanza(self, localuser, messages):
+        """Send the messages to the localuser as one Jabber
+        message"""
+        self.client.send(xmpp.protocol.Message(localuser, '\n'.join(messages), typ='chat'))
+        self.metrics.increment('seshat_stanzas_total')
+        self.metrics.increment('seshat_messages_coalesced_total', len(messages) - 1)
+
+    def _updatestats(self):
+        """Refresh the gauges that describe the database and the
+        localusers"""
+        now = time.time()
+        for queue, (count, oldest) in self.backend._getqueuedepths().items():
+            self.metrics.setgauge('seshat_queue_depth', count, queue=queue)
+            self.metrics.setgauge('seshat_queue_oldest_seconds', now - oldest if oldest is not None else 0, queue=queue)
+        for status, name in ((self.STATUS_WAITING, 'waiting'), (self.STATUS_NOTIFIED, 'offered'), (self.STATUS_OPEN, 'open')):
+            self.metrics.setgauge('seshat_chats', len(self.backend._getchatswithstatus(status)), status=name)
+        self.metrics.setgauge('seshat_localusers_online', len(self.onlineusers))
+        self.metrics.setgauge('seshat_outbox_depth', len(self.outbox))
+
+    def _waitforevents(self, timeout):
+        """Sleep until the Jabber server sends something, a client
+        queues work, or timeout seconds pass, then process any incoming
+        stanzas. Wake up sooner if the outbox will release messages
+        or online statuses are due to be written before then. Return
+        the result of client.Process."""
+        nextsend = self.outbox.nextready()
+        if nextsend is not None:
+            timeout = min(timeout, nextsend)
+        # Online statuses that change before nextpresencetime are
+        # written then
+        presencedelay = self.nextpresencetime - time.time()
+        if presencedelay > 0:
+            timeout = min(timeout, presencedelay)
+        if self.listener is None:
+            return self.client.Process(min(timeout, 1))
+        # Data already buffered by the Jabber connection (such as
+        # decrypted TLS records) won't wake select, so don't sleep if
+        # there's any
+        if not self.client.Connection.pending_data(0):
+            select.select([self.client.Connection._sock, self.listener], [], [], timeout)
+        self.listener.drain()
+        return self.client.Process(0)
 
 
     #### Event handlers
@@ -154,11 +539,21 @@ class SeshatServer(sqlitebackend.SqliteBackend):
             if matchresult is not None:
                 pattern.function(self, localuser, *matchresult.groups())
                 return
-        currentchat = self._getlocaluserchat(localuser)
-        if currentchat is None:
-            self._localsend(localuser, "You are not currently in a chat. Send '!WAITING' to see a list of available chats, or '!HELP' for other options.")
-            return
-        self._queueremote(currentchat.chatid, message)
+        match = ROUTEPATTERN.match(message) if self.scheduler.maxchats > 1 else None
+        if match is not None:
+            chatid, message = int(match.group(1)), match.group(2)
+            currentchat = self.backend._getchatinfo(chatid)
+            if currentchat is None or currentchat.localuser != localuser or currentchat.status != self.STATUS_OPEN:
+                self._replywithhelp(localuser, "You are not handling chat #%d." % chatid)
+                return
+            self.scheduler.route(localuser, chatid)
+        else:
+            currentchat = self._getcurrentchat(localuser)
+            if currentchat is None:
+                self._localsend(localuser, "You are not currently in a chat. Send '!WAITING' to see a list of available chats, or '!HELP' for other options.")
+                return
+        self.backend._queueremote(currentchat.chatid, message)
+        self.metrics.increment('seshat_messages_total', queue='remotemessagequeue')
         MODULELOG.info("%s said to %s in chat #%d: '%s'", localuser, currentchat.remoteuser, currentchat.chatid, message)
 
     def _presencehandler(self, con, presence):
@@ -169,13 +564,23 @@ class SeshatServer(sqlitebackend.SqliteBackend):
             return
         resource = user.getResource()
         online = presence.getType() != 'unavailable' and presence.getShow() is None
-        self.onlineresource[localuser][resource] = online
-        currentcount = sum(self.onlineresource[localuser].values())
+        # Presence may be handled by several threads at once
+        with self.presencelock:
+            self.onlineresource[localuser][resource] = online
+            currentcount = sum(self.onlineresource[localuser].values())
+            if currentcount:
+                self.onlineusers = self.onlineusers.union([localuser])
+            else:
+                self.onlineusers = self.onlineusers.difference([localuser])
         MODULELOG.debug("%s/%s changed status to '%s' (online count: %d)" % (localuser,
                                                                              resource,
                                                                              'online' if online else 'offline',
                                                                              currentcount))
-        self._setonlinestatus(localuser, resource, online)
+        # Write it now if nothing else was written recently, or else
+        # with any others that come in by then
+        with self.presencelock:
+            self.pendingpresence[(localuser, resource)] = online
+        self._savepresence()
 
     #### Command handlers - these act on commands from localusers
 
@@ -184,13 +589,16 @@ class SeshatServer(sqlitebackend.SqliteBackend):
         """!ACCEPT n - Accept chat request #n"""
         chatid = int(chatid)
 
-        # Don't let users accept more than one chat
-        currentchat = self._getlocaluserchat(localuser)
-        if currentchat is not None:
-            self._replywithhelp(localuser, "You are already handling chat #%d with %s." % (currentchat.chatid, currentchat.remoteuser))
+        # Don't let users accept more chats than the scheduler allows
+        currentchats = self.backend._getlocaluserchats(localuser)
+        if len(currentchats) >= self.scheduler.maxchats:
+            if len(currentchats) == 1:
+                self._replywithhelp(localuser, "You are already handling chat #%d with %s." % (currentchats[0].chatid, currentchats[0].remoteuser))
+            else:
+                self._replywithhelp(localuser, "You are already handling %d chats." % len(currentchats))
             return
         
-        chatinfo = self._getchatinfo(chatid)
+        chatinfo = self.backend._getchatinfo(chatid)
         if chatinfo is None:
             self._replywithhelp(localuser, "Chat #%d does not exist." % chatid)
             return
@@ -203,16 +611,30 @@ class SeshatServer(sqlitebackend.SqliteBackend):
         if chatinfo.status == self.STATUS_CLOSED:
             self._replywithhelp(localuser, "Chat #%d is already finished." % chatid)
             return
-        self._acceptchat(chatid, localuser)
-        self._localsend(localuser, "You are now handling chat #%d. Send '!FINISH' when you are done." % chatid)
-        self._queueremote(chatid, "Your chat has started.")
+        with self.backend.transaction():
+            accepted = self.backend._acceptchat(chatid, localuser)
+            if accepted:
+                self.backend._queueremote(chatid, "Your chat has started.")
+        if not accepted:
+            # Someone else accepted or canceled it first
+            chatinfo = self.backend._getchatinfo(chatid)
+            if chatinfo.status == self.STATUS_OPEN:
+                self._replywithhelp(localuser, "Chat #%d is already handled by %s." % (chatid, chatinfo.localuser))
+            else:
+                self._replywithhelp(localuser, "Chat #%d is already finished." % chatid)
+            return
+        self.scheduler.accepted(localuser, chatid)
+        if self.scheduler.maxchats > 1:
+            self._localsend(localuser, "You are now handling chat #%d. Your messages go to it unless they start with '#n ' for another chat. Send '!FINISH %d' when you are done." % (chatid, chatid))
+        else:
+            self._localsend(localuser, "You are now handling chat #%d. Send '!FINISH' when you are done." % chatid)
         MODULELOG.info("%s accepted chat #%d with %s" % (localuser, chatinfo.chatid, chatinfo.remoteuser))
 
     @_handlecommand('CANCEL (\d+)', '!CANCEL n - Cancel chat request #n')
     def _command_cancel(self, localuser, chatid):
         """!CANCEL n - Cancel chat request #n"""
         chatid = int(chatid)
-        chatinfo = self._getchatinfo(chatid)
+        chatinfo = self.backend._getchatinfo(chatid)
         if chatinfo is None:
             self._replywithhelp(localuser, "Chat #%d does not exist." % chatid)
             return
@@ -225,21 +647,34 @@ class SeshatServer(sqlitebackend.SqliteBackend):
         if chatinfo.status == self.STATUS_CLOSED:
             self._replywithhelp(localuser, "Chat #%d is already closed." % chatid)
             return
-        self._closechat(chatid, self.STATUS_CANCELEDLOCALLY)
+        with self.backend.transaction():
+            self.backend._closechat(chatid, self.STATUS_CANCELEDLOCALLY)
+            self.backend._queueremote(chatid, "Your chat was canceled.")
+        self.scheduler.forget(chatid)
         self._localsend(localuser, "You canceled chat #%d." % chatid)
-        self._queueremote(chatid, "Your chat was canceled.")
         MODULELOG.info("%s canceled chat #%d" % (localuser, chatid))
         
-    @_handlecommand('FINISH', '!FINISH - Close your current chat')
-    def _command_finish(self, localuser):
-        """!FINISH - Close your current chat"""
-        currentchat = self._getlocaluserchat(localuser)
-        if currentchat is None:
-            self._replywithhelp(localuser, "You are not currently active in a chat.")
-            return
-        self._closechat(currentchat.chatid, self.STATUS_CLOSED)
-        self._localsend(localuser, "The chat is now closed.")
-        self._queueremote(currentchat.chatid, "The chat is now closed.")
+    @_handlecommand('FINISH(?:\s+(\d+))?', '!FINISH [n] - Close your current chat, or chat #n')
+    def _command_finish(self, localuser, chatid=None):
+        """!FINISH [n] - Close your current chat, or chat #n"""
+        if chatid is None:
+            currentchat = self._getcurrentchat(localuser)
+            if currentchat is None:
+                self._replywithhelp(localuser, "You are not currently active in a chat.")
+                return
+        else:
+            currentchat = self.backend._getchatinfo(int(chatid))
+            if currentchat is None or currentchat.localuser != localuser or currentchat.status != self.STATUS_OPEN:
+                self._replywithhelp(localuser, "You are not handling chat #%d." % int(chatid))
+                return
+        with self.backend.transaction():
+            self.backend._closechat(currentchat.chatid, self.STATUS_CLOSED)
+            self.backend._queueremote(currentchat.chatid, "The chat is now closed.")
+        self.scheduler.closed(localuser, currentchat.chatid)
+        if self.scheduler.maxchats > 1:
+            self._localsend(localuser, "Chat #%d is now closed." % currentchat.chatid)
+        else:
+            self._localsend(localuser, "The chat is now closed.")
 
     @_handlecommand('HELP', '!HELP - Show available commands')
     def _command_help(self, localuser):
@@ -247,20 +682,52 @@ class SeshatServer(sqlitebackend.SqliteBackend):
         self._localsend(localuser,
                         "Available options:\n" + '\n'.join(sorted(pattern.helptext for pattern in COMMANDPATTERNS)))
 
+    @_handlecommand('STATS', '!STATS - Show how busy the broker bot is')
+    def _command_stats(self, localuser):
+        """!STATS - Show how busy the broker bot is"""
+        self._updatestats()
+        lines = []
+        for queue, description in (('localmessagequeue', 'for localusers'), ('remotemessagequeue', 'for visitors')):
+            lines.append("Messages queued %s: %d (oldest %ds), %d handled" % (
+                    description, self.metrics.getvalue('seshat_queue_depth', queue=queue),
+                    self.metrics.getvalue('seshat_queue_oldest_seconds', queue=queue),
+                    self.metrics.getvalue('seshat_messages_total', queue=queue)))
+        lines.append("Chats: %d waiting, %d offered, %d open" % tuple(
+                self.metrics.getvalue('seshat_chats', status=status) for status in ('waiting', 'offered', 'open')))
+        lines.append("Localusers online: %d" % self.metrics.getvalue('seshat_localusers_online'))
+        lines.append("Jabber messages: %d sent, %d merged into others, %d waiting" % (
+                self.metrics.getvalue('seshat_stanzas_total'), self.metrics.getvalue('seshat_messages_coalesced_total'),
+                self.metrics.getvalue('seshat_outbox_depth')))
+        for name, description in (('seshat_message_wait_seconds', 'Delivery wait'), ('seshat_loop_seconds', 'Main loop')):
+            for labels, histogram in self.metrics.gethistograms(name).items():
+                lines.append("%s: %d times, %.1fms average, 95%% under %.1fms, %.1fms max" % (
+                        description, histogram.count, 1000 * histogram.sum / histogram.count,
+                        1000 * histogram.quantile(0.95), 1000 * histogram.max))
+        slowest = sorted(((histogram.sum / histogram.count, dict(labels)['method'])
+                          for labels, histogram in self.metrics.gethistograms('seshat_backend_seconds').items()), reverse=True)[:3]
+        if slowest:
+            lines.append("Slowest backend calls: %s" % ', '.join('%s %.2fms average' % (method, 1000 * average) for average, method in slowest))
+        self._localsend(localuser, '\n'.join(lines))
+        MODULELOG.info("%s asked for stats" % localuser)
+
     @_handlecommand('STATUS', '!STATUS - Show your current chat status')
     def _command_status(self, localuser):
         """!STATUS - Show your current chat status"""
-        currentchat = self._getlocaluserchat(localuser)
-        if currentchat is None:
+        currentchats = self.backend._getlocaluserchats(localuser)
+        if not currentchats:
             self._replywithhelp(localuser, "You are not in a chat.")
-        else:
+        elif len(currentchats) == 1:
             self._localsend(localuser, "You are in chat #%d with %s. Send '!FINISH' when you are done." % (
-                    currentchat.chatid, currentchat.remoteuser))
+                    currentchats[0].chatid, currentchats[0].remoteuser))
+        else:
+            currentchat = self._getcurrentchat(localuser)
+            self._localsend(localuser, "You are in chats %s. Your messages go to chat #%d unless they start with '#n ' for another chat." % (
+                    ', '.join('#%d with %s' % (chat.chatid, chat.remoteuser) for chat in currentchats), currentchat.chatid))
         
     @_handlecommand('WAITING', '!WAITING - Show all open chat requests')
     def _command_waiting(self, localuser):
         """!WAITING - Show all open chat requests"""
-        waitingchats = self._getchatswithstatus(self.STATUS_WAITING) + self._getchatswithstatus(self.STATUS_NOTIFIED)
+        waitingchats = self.backend._getchatswithstatus(self.STATUS_WAITING) + self.backend._getchatswithstatus(self.STATUS_NOTIFIED)
         if not waitingchats:
             self._localsend(localuser, "There aren't any open chat requests.""")
         else:
@@ -282,19 +749,34 @@ def main(configfile, section):
     logging.getLogger('').setLevel(logging.DEBUG)
     config = ConfigParser.ConfigParser()
     config.read(configfile)
+    settings = dict(config.items(section))
     setting = {}
 
-    # Prefer keys named like "seshat_username", but fall back to
-    # "username" if they don't exist. This is so that Seshat settings
-    # can be embedded in Pyramid config files with little risk of
-    # conflicts.
-    for key in ('username', 'password', 'localusers', 'sqlitedb'):
-        try:
-            setting[key] = config.get(section, 'seshat_%s' % key)
-        except ConfigParser.NoOptionError:
-            setting[key] = config.get(section, '%s' % key)
+    # See: backend.getsetting
+    for key in ('username', 'password', 'localusers'):
+        setting[key] = backend.getsetting(settings, key)
+        if setting[key] is None:
+            raise ConfigParser.NoOptionError(key, section)
+    # These are optional
+    for key in ('notifysocket', 'archivedb', 'retentiondays', 'workerid', 'statsfile', 'statsport'):
+        setting[key] = backend.getsetting(settings, key)
+    scheduler = dispatch.fromsettings(settings)
+    outbox = sendqueue.fromsettings(settings)
     setting['localusers'] = [localuser.strip() for localuser in setting['localusers'].split(',')]
-    SeshatServer(setting['username'], setting['password'], setting['localusers'], setting['sqlitedb']).run()
+    engine = backend.getsetting(settings, 'engine', 'simple')
+    if engine == 'simple':
+        SeshatServer(setting['username'], setting['password'], setting['localusers'], backend.getbackend(settings), setting['notifysocket'],
+                     setting['archivedb'], setting['retentiondays'], setting['workerid'], scheduler=scheduler,
+                     statsfile=setting['statsfile'], statsport=setting['statsport'], outbox=outbox).run()
+    elif engine == 'threaded':
+        import threadedserver
+        threadedserver.ThreadedSeshatServer(setting['username'], setting['password'], setting['localusers'], lambda: backend.getbackend(settings),
+                                            backend.getsetting(settings, 'workers', threadedserver.DEFAULTWORKERS),
+                                            notifysocket=setting['notifysocket'], archivedb=setting['archivedb'],
+                                            retentiondays=setting['retentiondays'], workerid=setting['workerid'], scheduler=scheduler,
+                                            statsfile=setting['statsfile'], statsport=setting['statsport'], outbox=outbox).run()
+    else:
+        raise ValueError('Unknown broker bot engine: %s' % engine)
         
 if __name__ == '__main__':
     import sys
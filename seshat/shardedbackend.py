@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright (c) 2011, Daycos
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#     * Neither the name of Daycos nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL
+# <COPYRIGHT HOLDER> BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+
+"""Implements Seshat's client-server API across several SQLite databases
+
+Every write to a single SQLite database waits for the same lock, so a
+busy site's web workers and broker bot spend much of their time waiting
+on each other. The sharded backend spreads chats and their message
+queues across several databases ("shards"), chosen by chatid, so that
+only clients working on chats in the same shard compete for a lock. A
+small directory database hands out chatids and holds the localusers'
+online status.
+
+The shards are named after the directory database, so with "sqlitedb =
+/tmp/seshat.db" and "shards = 4" the files are /tmp/seshat.db and
+/tmp/seshat.db.shard0 through /tmp/seshat.db.shard3. The number of
+shards can't be changed once the databases have been created.
+
+Message ids are only unique within a shard, so the ids this backend
+returns encode the shard too. They still increase within each chat,
+which is all that clients rely on."""
+
+from __future__ import with_statement
+
+import contextlib
+import logging
+import sys
+import threading
+import time
+
+import backend
+import sqlitebackend
+
+MODULELOG = logging.getLogger(__name__)
+
+# The number of shards to use if the "shards" setting isn't given
+DEFAULTSHARDS = 4
+
+# The path of each shard, given the directory database's path and the
+# shard number
+SHARDPATH = '%s.shard%d'
+
+# The directory database only shares the SQLite backend's onlinestatus
+# and availability tables, so it's created with just those. Versions
+# up to 8 copied the whole schema, and 9 drops the chat and queue
+# tables they never used.
+DIRECTORYVERSION = 9
+DIRECTORYCREATEQUERIES = [
+    "CREATE TABLE onlinestatus (workerid TEXT, localuser TEXT, resource TEXT, online INTEGER, PRIMARY KEY (workerid, localuser, resource))",
+    "CREATE TABLE availability (workerid TEXT PRIMARY KEY, availablelocalusers INTEGER, waitingchats INTEGER, generation INTEGER, updatetime INTEGER)",
+    "CREATE TABLE dbversion (versionid INTEGER PRIMARY KEY, version INTEGER)",
+    "INSERT INTO dbversion (versionid, version) VALUES (1, %d)" % DIRECTORYVERSION,
+    ]
+DIRECTORYMIGRATIONS = dict(sqlitebackend.MIGRATIONS)
+DIRECTORYMIGRATIONS[DIRECTORYVERSION] = [
+    "DROP TABLE IF EXISTS chat",
+    "DROP TABLE IF EXISTS localmessagequeue",
+    "DROP TABLE IF EXISTS remotemessagequeue",
+    ]
+
+# Tables kept in the directory database in addition to those
+DIRECTORYQUERIES = [
+    "CREATE TABLE IF NOT EXISTS chatdirectory (chatid INTEGER PRIMARY KEY, remoteuser TEXT, starttime INTEGER)",
+    "CREATE TABLE IF NOT EXISTS sharding (versionid INTEGER PRIMARY KEY, shards INTEGER)",
+    ]
+
+# The directory databases whose sharding has already been checked by
+# this process
+CHECKEDDIRECTORIES = set()
+CHECKEDDIRECTORIESLOCK = threading.Lock()
+
+class DirectoryBackend(sqlitebackend.SqliteBackend):
+    """The SQLite database holding a ShardedBackend's chatids and
+    localusers, which has no chats or queues of its own"""
+
+    CREATEQUERIES = DIRECTORYCREATEQUERIES
+    MIGRATIONS = DIRECTORYMIGRATIONS
+    CURRENTDBVERSION = DIRECTORYVERSION
+
+class ShardedBackend(backend.Backend):
+    """An implementation of the Seshat backend API that partitions
+    chats across several SQLite databases"""
+
+    LOCATIONSETTING = 'sqlitedb'
+
+    def __init__(self, sqlitedb, shards=DEFAULTSHARDS, crossthread=False, pragmas=None):
+        """Connect to the directory database and each of its shards,
+        creating them if necessary. See:
+        sqlitebackend.SqliteBackend.__init__.__doc__"""
+        shards = int(shards)
+        if shards < 1:
+            raise ValueError('There must be at least one shard, not %d' % shards)
+        self.directory = DirectoryBackend(sqlitedb, crossthread=crossthread, pragmas=pragmas)
+        if sqlitedb == ':memory:':
+            shardpaths = [sqlitedb] * shards
+        else:
+            shardpaths = [SHARDPATH % (sqlitedb, shard) for shard in range(shards)]
+        self.shards = [sqlitebackend.SqliteBackend(shardpath, crossthread=crossthread, pragmas=pragmas) for shardpath in shardpaths]
+        self.backends = [self.directory] + self.shards
+        self.transactiondepth = 0
+        self.immediate = False
+        # The (database, transaction) pairs taking part in the
+        # unfinished transaction, in the order they joined it
+        self.enlisted = []
+        self.location = self.directory.location
+        self.inmemory = self.directory.inmemory
+        self.notifypath = self.directory.notifypath
+        with CHECKEDDIRECTORIESLOCK:
+            if self.location is None or self.location not in CHECKEDDIRECTORIES:
+                self._checksharding()
+                CHECKEDDIRECTORIES.add(self.location)
+
+    @classmethod
+    def fromsettings(cls, settings, **options):
+        """Return a connection to the databases named by the "sqlitedb"
+        setting, split into the number of shards given by the "shards"
+        setting, with the PRAGMAS found in the settings applied"""
+        options.setdefault('pragmas', sqlitebackend.getpragmas(settings))
+        return cls(backend.getsetting(settings, 'sqlitedb'), backend.getsetting(settings, 'shards', DEFAULTSHARDS), **options)
+
+    @contextlib.contextmanager
+    def transaction(self, immediate=False):
+        """Group everything done inside the "with" block into one
+        transaction on each database it uses, committed when the block
+        finishes or rolled back if it raises an exception. A database
+        joins the transaction the first time it's used inside the
+        block, so a block that works on one chat only touches that
+        chat's shard (and the directory, if it needs it). Each database
+        commits separately, in the order they joined, so a transaction
+        is only atomic if it works on a single chat. If immediate is
+        True, each database's write lock is taken when it joins."""
+        if not self.transactiondepth:
+            self.immediate = immediate
+        self.transactiondepth += 1
+        try:
+            yield
+        except:
+            self.transactiondepth -= 1
+            if not self.transactiondepth:
+                self._finishtransaction(sys.exc_info())
+            raise
+        self.transactiondepth -= 1
+        if not self.transactiondepth:
+            self._finishtransaction()
+
+    def _abort(self):
+        """Discard any unfinished transactions"""
+        for database in self.backends:
+            database._abort()
+
+    def _enlist(self, database):
+        """Return database, after making it part of the unfinished
+        transaction (if any) when this is its first use in it"""
+        if self.transactiondepth and database not in [enlisted for enlisted, transaction in self.enlisted]:
+            transaction = database.transaction(self.immediate)
+            transaction.__enter__()
+            self.enlisted.append((database, transaction))
+        return database
+
+    def _finishtransaction(self, excinfo=None):
+        """Commit each database's part of the finished transaction, or
+        roll them all back if excinfo is the (type, value, traceback)
+        of the exception that ended it. If a commit fails, the parts
+        that haven't committed yet are rolled back and the error is
+        raised."""
+        enlisted, self.enlisted = self.enlisted, []
+        failure = None
+        for database, transaction in enlisted:
+            if excinfo is None:
+                try:
+                    transaction.__exit__(None, None, None)
+                except:
+                    excinfo = failure = sys.exc_info()
+            else:
+                transaction.__exit__(*excinfo)
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
+
+    def _getshards(self):
+        """Return every shard, for work that spans all of them"""
+        return [self._enlist(shard) for shard in self.shards]
+
+    def _acceptchat(self, chatid, localuser):
+        """Open a chat and set its localuser to the given value, if
+        it's still waiting to be accepted. Return True if it was."""
+        return self._getshard(chatid)._acceptchat(chatid, localuser)
+
+    def _archivechats(self, cutoff, batchsize):
+        """Archive up to batchsize chats from each shard, and return
+        the total number archived. Their chatids are removed from the
+        directory too, except for the newest chatid, which SQLite would
+        otherwise hand out again. See:
+        sqlitebackend.SqliteBackend._archivechats.__doc__"""
+        chatids = []
+        with self.transaction():
+            for shard in self._getshards():
+                chatids.extend(shard._archivechatids(cutoff, batchsize))
+            if chatids:
+                self._enlist(self.directory).dbconn.executemany("DELETE FROM chatdirectory WHERE chatid = ? AND chatid < (SELECT max(chatid) FROM chatdirectory)",
+                                                                [(chatid,) for chatid in chatids])
+        return len(chatids)
+
+    def _archivemessages(self, cutoff, batchsize):
+        """Archive up to batchsize messages from each shard's queues,
+        and return the total number archived. See:
+        sqlitebackend.SqliteBackend._archivemessages.__doc__"""
+        return sum([shard._archivemessages(cutoff, batchsize) for shard in self._getshards()])
+
+    def _attacharchive(self, archivedb):
+        """Attach a separate archive database to each shard, named
+        after archivedb like the shards are named after the directory
+        database, or in memory if archivedb is ':memory:'"""
+        for shardnumber, shard in enumerate(self.shards):
+            if archivedb == ':memory:':
+                shard._attacharchive(archivedb)
+            else:
+                shard._attacharchive(SHARDPATH % (archivedb, shardnumber))
+
+    def _checksharding(self):
+        """Create the directory's tables if they don't exist, and make
+        sure the databases were created with the same number of
+        shards"""
+        with self.directory.transaction():
+            for query in DIRECTORYQUERIES:
+                self.directory.dbconn.execute(query)
+            row = self.directory.dbconn.execute("SELECT shards FROM sharding WHERE versionid = 1").fetchone()
+            if row is None:
+                self.directory.dbconn.execute("INSERT INTO sharding (versionid, shards) VALUES (1, ?)", (len(self.shards),))
+            elif row[0] != len(self.shards):
+                raise ValueError('The Seshat database (%s) has %d shards, not %d' % (self.location, row[0], len(self.shards)))
+
+    def _claimchatswithstatus(self, status, workerid, leasetime):
+        """Claim the chats with the given status from every shard. See:
+        sqlitebackend.SqliteBackend._claimchatswithstatus.__doc__"""
+        chats = []
+        for shard in self._getshards():
+            chats.extend(shard._claimchatswithstatus(status, workerid, leasetime))
+        chats.sort(key=lambda chat: chat.chatid)
+        return chats
+
+    def _claimqueuedlocalmessages(self, workerid, leasetime):
+        """Claim the chats with messages queued for localusers from
+        every shard, and return the messages. See:
+        sqlitebackend.SqliteBackend._claimqueuedlocalmessages.__doc__"""
+        messages = []
+        for shardnumber, shard in enumerate(self._getshards()):
+            for message in shard._claimqueuedlocalmessages(workerid, leasetime):
+                message.messageid = self._encodemessageid(shardnumber, message.messageid)
+                messages.append(message)
+        return messages
+
+    def _clearonlineusers(self, workerid):
+        """Remove the cache of online user information kept by
+        workerid"""
+        self._enlist(self.directory)._clearonlineusers(workerid)
+
+    def _close(self):
+        """Close every database connection"""
+        for database in self.backends:
+            database._close()
+
+    def _closechat(self, chatid, status):
+        """Mark the chat as closed with the given status code"""
+        self._getshard(chatid)._closechat(chatid, status)
+
+    def _countunsentlocalmessages(self, chatid):
+        """Return the number of the chat's messages still waiting to be
+        delivered to its localuser"""
+        return self._getshard(chatid)._countunsentlocalmessages(chatid)
+
+    def _decodemessageid(self, messageid):
+        """Return the shard number and shard-local messageid encoded in
+        a messageid returned by this backend"""
+        return messageid % len(self.shards), messageid // len(self.shards)
+
+    def _encodemessageid(self, shardnumber, messageid):
+        """Return a messageid unique across all shards"""
+        return messageid * len(self.shards) + shardnumber
+
+    def _getallqueuedremotemessages(self, chatid, limit=None):
+        """Return the (possibly empty) list of messages queued for a
+        chat, oldest first, and mark them all sent in one transaction"""
+        return self._getshard(chatid)._getallqueuedremotemessages(chatid, limit)
+
+    def _getavailabilities(self):
+        """Return the Availabilities stored in the directory database"""
+        return self._enlist(self.directory)._getavailabilities()
+
+    def _getavailablelocalusers(self):
+        """Return a list of localusers who are currently online from
+        at least one place, but not involved in a chat"""
+        chattingusers = set(chat.localuser for chat in self._getchatswithstatus(self.STATUS_OPEN))
+        return [localuser for localuser in self._enlist(self.directory)._getavailablelocalusers() if localuser not in chattingusers]
+
+    def _getchatinfo(self, chatid):
+        """Return all the stored information about a chat"""
+        return self._getshard(chatid)._getchatinfo(chatid)
+
+    def _getchatssince(self, lastchatid, limit, startedafter=None, startedbefore=None):
+        """Return the (possibly empty) list of up to limit ChatInfos
+        for the chats after lastchatid, from every shard, in chatid
+        order"""
+        chats = []
+        for shard in self._getshards():
+            chats.extend(shard._getchatssince(lastchatid, limit, startedafter, startedbefore))
+        chats.sort(key=lambda chat: chat.chatid)
+        return chats[:limit]
+
+    def _getchatswithstatus(self, status):
+        """Return the (possibly empty) list of chats with the given
+        status, from every shard"""
+        chats = []
+        for shard in self._getshards():
+            chats.extend(shard._getchatswithstatus(status))
+        chats.sort(key=lambda chat: chat.chatid)
+        return chats
+
+    def _getdataversion(self, chatid=None):
+        """Return a list of numbers, one of which changes every time
+        another connection commits a change to any of the databases, or
+        only to the chat's shard if chatid is given"""
+        if chatid is not None:
+            return [self._getshard(chatid)._getdataversion()]
+        return [database._getdataversion() for database in self.backends]
+
+    def _getfirstqueuedremotemessage(self, chatid):
+        """Return the oldest queued message for a chat"""
+        return self._getshard(chatid)._getfirstqueuedremotemessage(chatid)
+
+    def _getlocaluserchat(self, localuser):
+        """Return information about the localuser's current open chat,
+        if any (otherwise None)"""
+        for shard in self._getshards():
+            chatinfo = shard._getlocaluserchat(localuser)
+            if chatinfo is not None:
+                return chatinfo
+        return None
+
+    def _getlocaluserchats(self, localuser):
+        """Return the (possibly empty) list of the localuser's open
+        chats from every shard, oldest first"""
+        chats = []
+        for shard in self._getshards():
+            chats.extend(shard._getlocaluserchats(localuser))
+        chats.sort(key=lambda chat: chat.chatid)
+        return chats
+
+    def _getmessagessince(self, chatid, queue, lastmessageid, limit):
+        """Return the (possibly empty) list of up to limit (messageid,
+        posttime, message) tuples for the chat's messages in queue
+        after lastmessageid, oldest first"""
+        shardnumber = chatid % len(self.shards)
+        lastmessageid = self._decodemessageid(lastmessageid)[1]
+        return [(self._encodemessageid(shardnumber, messageid), posttime, message)
+                for messageid, posttime, message in self._getshard(chatid)._getmessagessince(chatid, queue, lastmessageid, limit)]
+
+    def _getqueuedepths(self):
+        """Return a dictionary mapping each message queue to the number
+        of messages waiting in it across every shard and the posttime
+        of the oldest"""
+        depths = {}
+        for shard in self._getshards():
+            for table, (count, oldest) in shard._getqueuedepths().items():
+                total, totaloldest = depths.get(table, (0, None))
+                if totaloldest is None or (oldest is not None and oldest < totaloldest):
+                    totaloldest = oldest
+                depths[table] = (total + count, totaloldest)
+        return depths
+
+    def _getremotemessagessince(self, chatid, lastmessageid, limit=None):
+        """Return the (possibly empty) list of (messageid, message)
+        pairs queued for a chat after lastmessageid, oldest first"""
+        shardnumber = chatid % len(self.shards)
+        lastmessageid = self._decodemessageid(lastmessageid)[1]
+        return [(self._encodemessageid(shardnumber, messageid), message)
+                for messageid, message in self._getshard(chatid)._getremotemessagessince(chatid, lastmessageid, limit)]
+
+    def _getshard(self, chatid):
+        """Return the shard holding a chat"""
+        return self._enlist(self.shards[chatid % len(self.shards)])
+
+    def _incrementalvacuum(self, pages):
+        """Return up to the given number of free pages from each shard
+        to the filesystem, and return how many free pages remain in
+        all of them"""
+        return sum([shard._incrementalvacuum(pages) for shard in self._getshards()])
+
+    def _markmessagessent(self, messageids):
+        """Record the time that all the given messages were sent, in
+        one transaction per shard"""
+        byshard = {}
+        for messageid in messageids:
+            shardnumber, messageid = self._decodemessageid(messageid)
+            byshard.setdefault(shardnumber, []).append(messageid)
+        for shardnumber, shardmessageids in byshard.items():
+            self._enlist(self.shards[shardnumber])._markmessagessent(shardmessageids)
+
+    def _openchat(self, remoteuser, message=''):
+        """Allocate a chatid from the directory, then issue a new chat
+        request in its shard and return the chatid. The directory
+        commits first, so that no other chat can be given the same id.
+        If the shard fails to store the chat, its chatid is handed back
+        to the directory. One that can't be handed back is harmless:
+        chatdirectory is only read to allocate chatids, so it just
+        leaves a gap."""
+        with self.transaction():
+            chatid = self._enlist(self.directory).dbconn.execute("INSERT INTO chatdirectory (remoteuser, starttime) VALUES (?, ?)",
+                                                                 (remoteuser, time.time())).lastrowid
+        try:
+            return self._getshard(chatid)._openchat(remoteuser, message, chatid)
+        except:
+            excinfo = sys.exc_info()
+            try:
+                with self.transaction():
+                    self._enlist(self.directory).dbconn.execute("DELETE FROM chatdirectory WHERE chatid = ?", (chatid,))
+            except Exception:
+                MODULELOG.exception("Couldn't give back the chatid of unopened chat #%d" % chatid)
+            raise excinfo[0], excinfo[1], excinfo[2]
+
+    def _queuelocal(self, chatid, message):
+        """Queue a message for delivery to a localuser"""
+        self._getshard(chatid)._queuelocal(chatid, message)
+
+    def _queueremote(self, chatid, message):
+        """Send a web message to the chat's remoteuser"""
+        self._getshard(chatid)._queueremote(chatid, message)
+
+    def _releasechats(self, chatids, workerid):
+        """Give up workerid's claims on the chats, in one transaction
+        per shard"""
+        byshard = {}
+        for chatid in chatids:
+            byshard.setdefault(chatid % len(self.shards), []).append(chatid)
+        for shardnumber, shardchatids in byshard.items():
+            self._enlist(self.shards[shardnumber])._releasechats(shardchatids, workerid)
+
+    def _setavailability(self, availablelocalusers, waitingchats, workerid):
+        """Replace workerid's Availability stored in the directory
+        database"""
+        self._enlist(self.directory)._setavailability(availablelocalusers, waitingchats, workerid)
+
+    def _setchatstatus(self, chatid, status):
+        """Change the chat's status"""
+        self._getshard(chatid)._setchatstatus(chatid, status)
+
+    def _setonlinestatuses(self, statuses, workerid):
+        """Update (or store) whether each localuser is online from
+        each resource seen by workerid, in the directory database"""
+        self._enlist(self.directory)._setonlinestatuses(statuses, workerid)
+
+    def _waitforchange(self, timeout, dataversion=None, chatid=None):
+        """Wait up to timeout seconds for another connection to commit
+        a change to any of the databases (or only to the chat's shard,
+        if chatid is given) since _getdataversion returned dataversion
+        (or since now, if it's None). Return True if one did, or False
+        if the timeout expired first."""
+        if dataversion is None:
+            dataversion = self._getdataversion(chatid)
+        return sqlitebackend.waitforchange(lambda: self._getdataversion(chatid), timeout, dataversion)
@@ -31,141 +31,396 @@
 
 """Implements Seshat's client-server API using an SQLite database
 
-Although this particular implementation uses SQLite, it makes no
-assumptions about the underlying data storage."""
+This is the default backend (see: seshat.backend)."""
 
+from __future__ import with_statement
+
+import contextlib
 import logging
+import os
 import sqlite3
 import sys
+import threading
 import time
 
-CURRENTDBVERSION = 1
-    
+import backend
+import notify
+# These used to be defined here
+from backend import Availability, ChatInfo, QueuedMessage
+
+CURRENTDBVERSION = 8
+
+# How soon (in seconds) _waitforchange first checks whether another
+# connection has written to the database. The interval doubles each
+# time nothing has changed, up to MAXCHANGEPOLLINTERVAL, so that idle
+# long polls cost little however many of them are waiting.
+CHANGEPOLLINTERVAL = 0.05
+MAXCHANGEPOLLINTERVAL = 1
+
 MODULELOG = logging.getLogger(__name__)
 
+# These create a version 1 database, which MIGRATIONS then brings up
+# to CURRENTDBVERSION
 CREATEQUERIES = [
     "CREATE TABLE chat (chatid INTEGER PRIMARY KEY, localuser TEXT, remoteuser TEXT, starttime INTEGER, endtime INTEGER, status INTEGER, startmessage TEXT)",
     "CREATE TABLE localmessagequeue (messageid INTEGER PRIMARY KEY, posttime INTEGER, sendtime INTEGER, chatid INTEGER, message TEXT)",
     "CREATE TABLE onlinestatus (localuser TEXT, resource TEXT, online INTEGER, PRIMARY KEY (localuser, resource))",
     "CREATE TABLE remotemessagequeue (messageid INTEGER PRIMARY KEY, posttime INTEGER, sendtime INTEGER, chatid INTEGER, message TEXT)",
     "CREATE TABLE dbversion (versionid INTEGER PRIMARY KEY, version INTEGER)",
-    "INSERT INTO dbversion (versionid, version) VALUES (1, %d)" % CURRENTDBVERSION,
+    "INSERT INTO dbversion (versionid, version) VALUES (1, 1)",
     ]
 
-class ChatInfo(object):
-    """A chat's parameters"""
-    def __init__(self, chatid, localuser, remoteuser, starttime, endtime, status, startmessage):
-        """This would be a namedtuple, but those aren't available in
-        all the versions of Python that Pyramid supports and I'd hate
-        to leave someone out over something so trivial."""
-        self.chatid = chatid
-        self.localuser = localuser
-        self.remoteuser = remoteuser
-        self.starttime = starttime
-        self.endtime = endtime
-        self.status = status
-        self.startmessage = startmessage
-
-class QueuedMessage(object):
-    """Everything needed to represent a message that's been stored for
-    delivery to a localuser"""
-    def __init__(self, chatid, localuser, remoteuser, messageid, message):
-        """See: ChatInfo.__init__.__doc__"""
-        self.chatid = chatid
-        self.localuser = localuser
-        self.remoteuser = remoteuser
-        self.messageid = messageid
-        self.message = message
-        
-class SqliteBackend(object):
+# MIGRATIONS[n] holds the queries that upgrade a version n-1 database
+# to version n. Each migration runs in its own transaction, so a
+# failure leaves the database at the last version that succeeded and
+# never touches the queued messages or open chats.
+MIGRATIONS = {
+    # Indexes for the queries that run on every polling pass
+    2: [
+        "CREATE INDEX IF NOT EXISTS localmessagequeue_unsent ON localmessagequeue (messageid) WHERE sendtime IS NULL",
+        "CREATE INDEX IF NOT EXISTS remotemessagequeue_chatid_sendtime ON remotemessagequeue (chatid, sendtime)",
+        "CREATE INDEX IF NOT EXISTS chat_status ON chat (status)",
+        "CREATE INDEX IF NOT EXISTS chat_localuser_status ON chat (localuser, status)",
+        ],
+    # Lets visitors read their messages by messageid without locking
+    3: [
+        "CREATE INDEX IF NOT EXISTS remotemessagequeue_chatid_messageid ON remotemessagequeue (chatid, messageid)",
+        ],
+    # Lets retention.Archiver find old messages and the messages in
+    # finished chats without scanning the queues
+    4: [
+        "CREATE INDEX IF NOT EXISTS localmessagequeue_chatid_messageid ON localmessagequeue (chatid, messageid)",
+        "CREATE INDEX IF NOT EXISTS localmessagequeue_sent ON localmessagequeue (sendtime) WHERE sendtime IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS remotemessagequeue_sent ON remotemessagequeue (sendtime) WHERE sendtime IS NOT NULL",
+        ],
+    # Lets several broker bots share the work by claiming chats
+    5: [
+        "ALTER TABLE chat ADD COLUMN claimworker TEXT",
+        "ALTER TABLE chat ADD COLUMN claimexpires INTEGER",
+        ],
+    # Lets clients check whether anyone can take a chat by reading one
+    # row the broker bot keeps up to date
+    6: [
+        "CREATE TABLE IF NOT EXISTS availability (availabilityid INTEGER PRIMARY KEY, availablelocalusers INTEGER, waitingchats INTEGER, generation INTEGER, updatetime INTEGER)",
+        ],
+    # Keeps each broker bot's view of the localusers apart, so that
+    # bots sharing the database don't overwrite or clear each other's.
+    # Both tables are caches the bots rebuild as they run, so they're
+    # recreated instead of converted.
+    7: [
+        "DROP TABLE onlinestatus",
+        "CREATE TABLE onlinestatus (workerid TEXT, localuser TEXT, resource TEXT, online INTEGER, PRIMARY KEY (workerid, localuser, resource))",
+        "DROP TABLE availability",
+        "CREATE TABLE availability (workerid TEXT PRIMARY KEY, availablelocalusers INTEGER, waitingchats INTEGER, generation INTEGER, updatetime INTEGER)",
+        ],
+    # Lets transcript exports find the chats started in a date range
+    # without scanning them all
+    8: [
+        "CREATE INDEX IF NOT EXISTS chat_starttime ON chat (starttime)",
+        ],
+    }
+
+# These create the tables in an archive database attached by
+# _attacharchive. They mirror the live tables, minus the chat claims.
+ARCHIVEQUERIES = [
+    "CREATE TABLE IF NOT EXISTS archive.chat (chatid INTEGER PRIMARY KEY, localuser TEXT, remoteuser TEXT, starttime INTEGER, endtime INTEGER, status INTEGER, startmessage TEXT)",
+    "CREATE TABLE IF NOT EXISTS archive.localmessagequeue (messageid INTEGER PRIMARY KEY, posttime INTEGER, sendtime INTEGER, chatid INTEGER, message TEXT)",
+    "CREATE TABLE IF NOT EXISTS archive.remotemessagequeue (messageid INTEGER PRIMARY KEY, posttime INTEGER, sendtime INTEGER, chatid INTEGER, message TEXT)",
+    "CREATE INDEX IF NOT EXISTS archive.localmessagequeue_chatid_messageid ON localmessagequeue (chatid, messageid)",
+    "CREATE INDEX IF NOT EXISTS archive.remotemessagequeue_chatid_messageid ON remotemessagequeue (chatid, messageid)",
+    "CREATE INDEX IF NOT EXISTS archive.chat_starttime ON chat (starttime)",
+    ]
+
+# The PRAGMA settings that can be given to SqliteBackend, mapped to
+# either the list of values they accept or the function that converts
+# them to the right type
+PRAGMAS = {
+    'journal_mode': ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'),
+    'synchronous': ('OFF', 'NORMAL', 'FULL', 'EXTRA'),
+    'busy_timeout': int,
+    'cache_size': int,
+    'mmap_size': int,
+    }
+
+# The databases whose schemas have already been checked (and upgraded
+# if necessary) by this process
+CHECKEDDATABASES = set()
+CHECKEDDATABASESLOCK = threading.Lock()
+
+def waitforchange(getdataversion, timeout, dataversion):
+    """Call getdataversion every so often, starting every
+    CHANGEPOLLINTERVAL seconds and backing off to every
+    MAXCHANGEPOLLINTERVAL, until it returns something other than
+    dataversion or timeout seconds have passed. Return True if it did,
+    or False if the timeout expired first."""
+    deadline = time.time() + timeout
+    interval = CHANGEPOLLINTERVAL
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        if getdataversion() != dataversion:
+            return True
+        interval = min(interval * 2, MAXCHANGEPOLLINTERVAL)
+
+def getpragmas(settings):
+    """Return the PRAGMA settings found in a dictionary of
+    configuration values, such as the items in an .ini file section or
+    a Pyramid application's settings (see: backend.getsetting)."""
+    pragmas = {}
+    for pragma in PRAGMAS:
+        value = backend.getsetting(settings, pragma)
+        if value is not None:
+            pragmas[pragma] = value
+    return pragmas
+
+class SqliteBackend(backend.Backend):
     """An implementation of the Seshat backend API that stores
     everything in a SQLite database"""
 
-    STATUS_WAITING = 0
-    STATUS_NOTIFIED = 1
-    STATUS_OPEN = 2
-    STATUS_CLOSED = 3
-    STATUS_FAILED = 4
-    STATUS_CANCELEDLOCALLY = 5
+    LOCATIONSETTING = 'sqlitedb'
 
-    def __init__(self, sqlitedb):
+    # The schema that _checkschema creates and upgrades
+    CREATEQUERIES = CREATEQUERIES
+    MIGRATIONS = MIGRATIONS
+    CURRENTDBVERSION = CURRENTDBVERSION
+
+    def __init__(self, sqlitedb, crossthread=False, pragmas=None):
         """Establish a database connection and create the tables
-        necessary tables if they don't already exist"""
-        self.dbconn = sqlite3.connect(sqlitedb)
-        initdb = False
+        necessary tables if they don't already exist. The schema is
+        only checked the first time each process opens a database.
+
+        If crossthread is True, the connection may be handed from one
+        thread to another (but must still only be used by one thread
+        at a time), as SeshatClientPool does.
+
+        pragmas is an optional dictionary of the PRAGMAS settings to
+        apply to the connection, such as {'journal_mode': 'WAL'}."""
+        if sqlitedb is None:
+            raise ValueError('No SQLite database was given. Set "sqlitedb" to its path.')
+        self.dbconn = sqlite3.connect(sqlitedb, check_same_thread=not crossthread)
+        self.transactiondepth = 0
+        if sqlitedb == ':memory:':
+            # Every connection to ':memory:' gets its own database
+            self.inmemory = True
+            self._checkschema(sqlitedb, pragmas)
+            return
+        dbpath = os.path.abspath(sqlitedb)
+        self.location = dbpath
+        self.notifypath = notify.getnotifypath(dbpath)
+        with CHECKEDDATABASESLOCK:
+            if dbpath not in CHECKEDDATABASES:
+                self._checkschema(sqlitedb, pragmas)
+                CHECKEDDATABASES.add(dbpath)
+                return
+        if pragmas:
+            self._setpragmas(pragmas)
+
+    @classmethod
+    def fromsettings(cls, settings, **options):
+        """Return a connection to the database named by the "sqlitedb"
+        setting, with the PRAGMAS found in the settings applied"""
+        options.setdefault('pragmas', getpragmas(settings))
+        return cls(backend.getsetting(settings, 'sqlitedb'), **options)
+
+    @contextlib.contextmanager
+    def transaction(self, immediate=False):
+        """Group every statement executed inside the "with" block into
+        one transaction that's committed when the block finishes, or
+        rolled back if it raises an exception. Transactions nest, so
+        only the outermost block commits:
+
+            with backend.transaction():
+                backend._closechat(chatid, backend.STATUS_CLOSED)
+                backend._queueremote(chatid, "The chat is now closed.")
+
+        If immediate is True, the outermost block takes the database's
+        write lock right away instead of when it first writes."""
+        if not self.transactiondepth and immediate:
+            self.dbconn.execute("BEGIN IMMEDIATE TRANSACTION")
+        self.transactiondepth += 1
         try:
-            versionquery = self.dbconn.execute('SELECT version FROM dbversion WHERE versionid = 1')
-        except sqlite3.OperationalError:
-            # If the 'version' table doesn't exist, then this is a new
-            # database and needs to be initialized
-            MODULELOG.info('Unable to find the database version table')
-            initdb = True
-        else:
-            dbversionrow = versionquery.fetchone()
-            if dbversionrow is None:
-                MODULELOG.info('Unable to read the database version')
-                # A previous initialization didn't get as far as
-                # setting the database version. Wierd, but let's
-                # handle it rationally.
-                initdb = True
-            else:
-                dbversion = dbversionrow[0]
-                if dbversion < CURRENTDBVERSION:
-                    localqueuesize = self.dbconn.execute('SELECT count(1) FROM localmessagequeue WHERE sendtime IS NULL').fetchone()[0]
-                    remotequeuesize = self.dbconn.execute('SELECT count(1) FROM remotemessagequeue WHERE sendtime IS NULL').fetchone()[0]
-                    unclosedchatcount = self.dbconn.execute('SELECT count(1) FROM chat WHERE STATUS IN (?, ?, ?)',
-                                                            (self.STATUS_WAITING, self.STATUS_NOTIFIED, self.STATUS_OPEN)).fetchone()[0]
-                    message = 'The Seshat database (%s) is out of date. It has %d queued incoming message(s), %d queued outgoing message(s), and %s unclosed chats.' % (
-                        sqlitedb,
-                        localqueuesize,
-                        remotequeuesize,
-                        unclosedchatcount)
-                    if localqueuesize or remotequeuesize or unclosedchatcount:
-                        message += ' Only delete the database file if you are willing to lose the unsent messages and open chats.'
-                    else:
-                        message += ' You may safely delete the current database file. It will be created automatically the next time you launch the server.'
-                    MODULELOG.critical(message)
-                    sys.exit(-1)
-        if initdb:
+            yield
+        except:
+            self.transactiondepth -= 1
+            if not self.transactiondepth:
+                self.dbconn.rollback()
+            raise
+        self.transactiondepth -= 1
+        if not self.transactiondepth:
+            self.dbconn.commit()
+
+    def _abort(self):
+        """Discard any unfinished transaction"""
+        self.dbconn.rollback()
+
+    def _acceptchat(self, chatid, localuser):
+        """Open a chat and set its localuser to the given value, if
+        it's still waiting to be accepted. Return True if it was."""
+        with self.transaction():
+            cursor = self.dbconn.execute("UPDATE chat SET status = ?, localuser = ? WHERE chatid = ? AND status IN (?, ?)",
+                                         (self.STATUS_OPEN, localuser, chatid, self.STATUS_WAITING, self.STATUS_NOTIFIED))
+        return cursor.rowcount == 1
+            
+    def _archivechats(self, cutoff, batchsize):
+        """Move up to batchsize closed, failed, or canceled chats that
+        ended before cutoff, along with any of their messages that are
+        still in the queues, to the attached archive database. Return
+        the number of chats moved."""
+        return len(self._archivechatids(cutoff, batchsize))
+
+    def _archivechatids(self, cutoff, batchsize):
+        """Archive chats like _archivechats, but return the list of
+        their chatids"""
+        with self.transaction():
+            chatids = [(row[0],) for row in self.dbconn.execute("SELECT chatid FROM chat WHERE status IN (?, ?, ?) AND coalesce(endtime, starttime) < ? ORDER BY chatid LIMIT ?",
+                                                                (self.STATUS_CLOSED, self.STATUS_FAILED, self.STATUS_CANCELEDLOCALLY, cutoff, batchsize)).fetchall()]
+            for table in ('localmessagequeue', 'remotemessagequeue'):
+                self.dbconn.executemany("INSERT OR REPLACE INTO archive.%s SELECT * FROM main.%s WHERE chatid = ?" % (table, table), chatids)
+                self.dbconn.executemany("DELETE FROM main.%s WHERE chatid = ?" % table, chatids)
+            self.dbconn.executemany("INSERT OR REPLACE INTO archive.chat SELECT chatid, localuser, remoteuser, starttime, endtime, status, startmessage FROM main.chat WHERE chatid = ?", chatids)
+            self.dbconn.executemany("DELETE FROM main.chat WHERE chatid = ?", chatids)
+        return [chatid for chatid, in chatids]
+
+    def _archivemessages(self, cutoff, batchsize):
+        """Move up to batchsize messages from each queue that were
+        delivered before cutoff to the attached archive database.
+        Return the number of messages moved."""
+        moved = 0
+        with self.transaction():
+            for table in ('localmessagequeue', 'remotemessagequeue'):
+                messageids = [(row[0],) for row in self.dbconn.execute("SELECT messageid FROM main.%s WHERE sendtime IS NOT NULL AND sendtime < ? ORDER BY sendtime LIMIT ?" % table,
+                                                                       (cutoff, batchsize)).fetchall()]
+                self.dbconn.executemany("INSERT OR REPLACE INTO archive.%s SELECT * FROM main.%s WHERE messageid = ?" % (table, table), messageids)
+                self.dbconn.executemany("DELETE FROM main.%s WHERE messageid = ?" % table, messageids)
+                moved += len(messageids)
+        return moved
+
+    def _attacharchive(self, archivedb):
+        """Attach the archive database as 'archive', creating its
+        tables if needed"""
+        if 'archive' in [row[1] for row in self.dbconn.execute("PRAGMA database_list")]:
+            return
+        self.dbconn.execute("ATTACH DATABASE ? AS archive", (archivedb,))
+        for query in ARCHIVEQUERIES:
+            self.dbconn.execute(query)
+        self.dbconn.commit()
+
+    def _checkschema(self, sqlitedb, pragmas=None):
+        """Apply the PRAGMA settings, then create the database if it's
+        new, or upgrade it if it was made by an older version of
+        Seshat"""
+        # This lets retention.Archiver return freed space to the
+        # filesystem, but a new database only gets it if it's asked for
+        # before anything is written, and switching to WAL writes
+        self.dbconn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        if pragmas:
+            self._setpragmas(pragmas)
+        dbversion = self._getdbversion()
+        if dbversion is None:
             MODULELOG.info('Creating and populating the database')
-            for query in CREATEQUERIES:
+            for query in self.CREATEQUERIES:
                 try:
                     self.dbconn.execute(query)
                 except sqlite3.OperationalError:
                     pass
                 else:
                     MODULELOG.debug('Executed: %s', query)
+            self.dbconn.commit()
+            dbversion = 1
+        if dbversion > self.CURRENTDBVERSION:
+            MODULELOG.critical('The Seshat database (%s) is version %d, but this version of Seshat only understands versions up to %d. Upgrade Seshat before using this database.' % (
+                sqlitedb,
+                dbversion,
+                self.CURRENTDBVERSION))
+            sys.exit(-1)
+        if dbversion < self.CURRENTDBVERSION:
+            self._migrate(sqlitedb)
 
-    def _acceptchat(self, chatid, localuser):
-        """Open a chat and set its localuser to the given value"""
-        self.dbconn.execute("UPDATE chat SET status = ?, localuser = ? WHERE chatid = ?",
-                            (self.STATUS_OPEN, localuser, chatid))
-        self.dbconn.commit()
-            
-    def _clearonlineusers(self):
-        """Remove the cache of online user information"""
-        self.dbconn.execute("DELETE from onlinestatus")
-        self.dbconn.commit()
+    def _claimchats(self, chatids, workerid, leasetime):
+        """Claim the chats for workerid until leasetime seconds from
+        now"""
+        claimexpires = time.time() + leasetime
+        self.dbconn.executemany("UPDATE chat SET claimworker = ?, claimexpires = ? WHERE chatid = ?",
+                                [(workerid, claimexpires, chatid) for chatid in chatids])
+
+    def _claimchatswithstatus(self, status, workerid, leasetime):
+        """Return the (possibly empty) list of chats with the given
+        status that no other worker has a current claim on, and claim
+        them for workerid for leasetime seconds"""
+        query = "SELECT chatid, localuser, remoteuser, starttime, endtime, status, startmessage FROM chat WHERE status = ? AND (claimworker = ? OR claimexpires IS NULL OR claimexpires < ?) ORDER BY chatid"
+        # Don't take the write lock unless there's something to claim
+        if self.dbconn.execute(query + " LIMIT 1", (status, workerid, time.time())).fetchone() is None:
+            return []
+        with self.transaction(immediate=True):
+            rows = self.dbconn.execute(query, (status, workerid, time.time())).fetchall()
+            self._claimchats([row[0] for row in rows], workerid, leasetime)
+        return [ChatInfo(*row) for row in rows]
+
+    def _claimqueuedlocalmessages(self, workerid, leasetime):
+        """Return the (possibly empty) list of messages queued for
+        delivery to localusers in chats that no other worker has a
+        current claim on, and claim those chats for workerid for
+        leasetime seconds"""
+        query = "SELECT chat.chatid, chat.localuser, chat.remoteuser, localmessagequeue.messageid, localmessagequeue.message, localmessagequeue.posttime FROM chat JOIN localmessagequeue ON chat.chatid = localmessagequeue.chatid WHERE localmessagequeue.sendtime IS NULL AND chat.localuser IS NOT NULL AND (chat.claimworker = ? OR chat.claimexpires IS NULL OR chat.claimexpires < ?) ORDER BY localmessagequeue.messageid"
+        # See: _claimchatswithstatus
+        if self.dbconn.execute(query + " LIMIT 1", (workerid, time.time())).fetchone() is None:
+            return []
+        with self.transaction(immediate=True):
+            rows = self.dbconn.execute(query, (workerid, time.time())).fetchall()
+            self._claimchats(set(row[0] for row in rows), workerid, leasetime)
+        return [QueuedMessage(*row) for row in rows]
+
+    def _clearonlineusers(self, workerid):
+        """Remove the cache of online user information kept by
+        workerid"""
+        with self.transaction():
+            self.dbconn.execute("DELETE FROM onlinestatus WHERE workerid = ?", (workerid,))
+
+    def _close(self):
+        """Close the database connection"""
+        self.dbconn.close()
 
     def _closechat(self, chatid, status):
         """Mark the chat as closed with the given status code"""
-        self.dbconn.execute("UPDATE chat SET status = ?, endtime = ? WHERE chatid = ?", (status, time.time(), chatid))
-        self.dbconn.commit()
+        with self.transaction():
+            self.dbconn.execute("UPDATE chat SET status = ?, endtime = ? WHERE chatid = ?", (status, time.time(), chatid))
         chatinfo = self._getchatinfo(chatid)
         MODULELOG.info("Chat #%d between %s and %s is closed." % (chatid, chatinfo.localuser, chatinfo.remoteuser))
 
-    def _getallqueuedlocalmessages(self):
-        """Return the (possibly empty) list of messages queued for
-        delivery to localusers"""
-        rows = self.dbconn.execute("SELECT chat.chatid, chat.localuser, chat.remoteuser, localmessagequeue.messageid, localmessagequeue.message FROM chat JOIN localmessagequeue ON chat.chatid = localmessagequeue.chatid WHERE localmessagequeue.sendtime IS NULL AND chat.localuser IS NOT NULL ORDER BY localmessagequeue.messageid").fetchall()
-        if rows is None:
+    def _countunsentlocalmessages(self, chatid):
+        """Return the number of the chat's messages still waiting to be
+        delivered to its localuser"""
+        return self.dbconn.execute("SELECT COUNT(*) FROM localmessagequeue WHERE chatid = ? AND sendtime IS NULL", (chatid,)).fetchone()[0]
+
+    def _getallqueuedremotemessages(self, chatid, limit=None):
+        """Return the (possibly empty) list of messages queued for a
+        chat, oldest first, and mark them all sent in one transaction"""
+        # See: _getfirstqueuedremotemessage
+        query = "SELECT messageid, message FROM remotemessagequeue WHERE chatid = ? AND sendtime IS NULL ORDER BY messageid"
+        if self.dbconn.execute(query + " LIMIT 1", (chatid,)).fetchone() is None:
             return []
-        return [QueuedMessage(*row) for row in rows]
-    
+        with self.transaction(immediate=True):
+            if limit is None:
+                rows = self.dbconn.execute(query, (chatid,)).fetchall()
+            else:
+                rows = self.dbconn.execute(query + " LIMIT ?", (chatid, limit)).fetchall()
+            sendtime = time.time()
+            self.dbconn.executemany("UPDATE remotemessagequeue SET sendtime = ? WHERE messageid = ?",
+                                    [(sendtime, messageid) for messageid, message in rows])
+        return [message for messageid, message in rows]
+
+    def _getavailabilities(self):
+        """Return the (possibly empty) list of the Availabilities last
+        stored by each broker bot"""
+        return [Availability(*row) for row in
+                self.dbconn.execute("SELECT availablelocalusers, waitingchats, generation, updatetime FROM availability ORDER BY workerid").fetchall()]
+
     def _getavailablelocalusers(self):
         """Return a list of localusers who are currently online from
         at least one place, but not involved in a chat"""
-        chattingusers = self._getchatswithstatus(self.STATUS_OPEN)
+        chattingusers = set(chat.localuser for chat in self._getchatswithstatus(self.STATUS_OPEN))
         return [row[0] for row in self.dbconn.execute("SELECT DISTINCT localuser FROM onlinestatus WHERE online = 1").fetchall()
                 if row[0] not in chattingusers]
 
@@ -177,6 +432,37 @@ class SqliteBackend(object):
             return None
         return ChatInfo(*row)
 
+    def _getchatssince(self, lastchatid, limit, startedafter=None, startedbefore=None):
+        """Return the (possibly empty) list of up to limit ChatInfos
+        for the chats after lastchatid, in chatid order, from the live
+        and (if it's attached) archive databases"""
+        dateconditions = []
+        dateparameters = []
+        if startedafter is not None:
+            dateconditions.append("starttime >= ?")
+            dateparameters.append(startedafter)
+        if startedbefore is not None:
+            dateconditions.append("starttime < ?")
+            dateparameters.append(startedbefore)
+        rows = []
+        for database in self._getdatabases():
+            conditions = ["chatid > ?"] + dateconditions
+            parameters = [lastchatid] + dateparameters
+            if dateconditions:
+                # Only look between the first and last chats started in
+                # the range, found with the chat_starttime index, instead
+                # of checking every chat after lastchatid
+                firstchatid, lastrangechatid = self.dbconn.execute("SELECT MIN(chatid), MAX(chatid) FROM %s.chat WHERE %s" %
+                                                                   (database, ' AND '.join(dateconditions)), dateparameters).fetchone()
+                if firstchatid is None:
+                    continue
+                conditions[0] = "chatid > ? AND chatid <= ?"
+                parameters[:1] = [max(lastchatid, firstchatid - 1), lastrangechatid]
+            rows.extend(self.dbconn.execute("SELECT chatid, localuser, remoteuser, starttime, endtime, status, startmessage FROM %s.chat WHERE %s ORDER BY chatid LIMIT ?" %
+                                            (database, ' AND '.join(conditions)), parameters + [limit]).fetchall())
+        rows.sort()
+        return [ChatInfo(*row) for row in rows[:limit]]
+
     def _getchatswithstatus(self, status):
         """Return the (possibly empty) list of chats with the given status"""
         rows = self.dbconn.execute("SELECT chatid, localuser, remoteuser, starttime, endtime, status, startmessage FROM chat WHERE status = ?", (status,)).fetchall()
@@ -184,19 +470,53 @@ class SqliteBackend(object):
             return []
         return [ChatInfo(*row) for row in rows]
 
+    def _getdataversion(self, chatid=None):
+        """Return a number that changes every time another connection
+        commits a change to the database. Every chat is in the same
+        database, so chatid makes no difference."""
+        return self.dbconn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _getdbversion(self):
+        """Return the database's schema version, or None if the
+        database hasn't been initialized"""
+        try:
+            versionquery = self.dbconn.execute('SELECT version FROM dbversion WHERE versionid = 1')
+        except sqlite3.OperationalError:
+            # If the 'version' table doesn't exist, then this is a new
+            # database and needs to be initialized
+            MODULELOG.info('Unable to find the database version table')
+            return None
+        dbversionrow = versionquery.fetchone()
+        if dbversionrow is None:
+            MODULELOG.info('Unable to read the database version')
+            # A previous initialization didn't get as far as setting
+            # the database version. Wierd, but let's handle it
+            # rationally.
+            return None
+        return dbversionrow[0]
+
+    def _getdatabases(self):
+        """Return the names of the databases holding chats and
+        messages: 'main', and 'archive' if it's attached"""
+        return [row[1] for row in self.dbconn.execute("PRAGMA database_list") if row[1] in ('main', 'archive')]
+
     def _getfirstqueuedremotemessage(self, chatid):
         """Return the oldest queued message for a chat"""
+        query = "SELECT messageid, message FROM remotemessagequeue WHERE chatid = ? AND sendtime IS NULL ORDER BY messageid LIMIT 1"
+        # Long-polling clients call this each time anything in the
+        # database changes, so don't take the write lock unless
+        # there's something to send
+        if self.dbconn.execute(query, (chatid,)).fetchone() is None:
+            return None
         # Lock the tables to prevent a race between two clients trying
         # to check messages at the same time. This guarantees that
         # each queued message will be emitted at most one time.
-        self.dbconn.execute("BEGIN IMMEDIATE TRANSACTION")
-        row = self.dbconn.execute("SELECT messageid, message FROM remotemessagequeue WHERE chatid = ? AND sendtime IS NULL", (chatid,)).fetchone()
-        if row is None:
-            self.dbconn.rollback()
-            return None
-        messageid, message = row
-        self.dbconn.execute("UPDATE remotemessagequeue SET sendtime = ? WHERE messageid = ?", (time.time(), messageid))
-        self.dbconn.commit()
+        with self.transaction(immediate=True):
+            row = self.dbconn.execute(query, (chatid,)).fetchone()
+            if row is None:
+                return None
+            messageid, message = row
+            self.dbconn.execute("UPDATE remotemessagequeue SET sendtime = ? WHERE messageid = ?", (time.time(), messageid))
         return message
 
     def _getlocaluserchat(self, localuser):
@@ -208,52 +528,174 @@ class SqliteBackend(object):
             return None
         return ChatInfo(*row)
     
-    def _getopenchatinfo(self, chatid):
-        """Like _getchatinfo, but only return information if the chat
-        is open"""
-        chatinfo = self._getchatinfo(chatid)
-        if chatinfo is not None and chatinfo.status == self.STATUS_OPEN:
-            return chatinfo
-        return None
-    
-    def _markmessagesent(self, messageid):
-        """Record the time that the given message was sent"""
-        self.dbconn.execute("UPDATE localmessagequeue SET sendtime = ? WHERE messageid = ?", (time.time(), messageid))
-        self.dbconn.commit()
+    def _getlocaluserchats(self, localuser):
+        """Return the (possibly empty) list of the localuser's open
+        chats, oldest first"""
+        rows = self.dbconn.execute("SELECT chatid, localuser, remoteuser, starttime, endtime, status, startmessage FROM chat WHERE localuser = ? AND status = ? ORDER BY chatid",
+                                   (localuser, self.STATUS_OPEN)).fetchall()
+        return [ChatInfo(*row) for row in rows]
+
+    def _getmessagessince(self, chatid, queue, lastmessageid, limit):
+        """Return the (possibly empty) list of up to limit (messageid,
+        posttime, message) tuples for the chat's messages in queue
+        after lastmessageid, oldest first, from the live and (if it's
+        attached) archive databases"""
+        if queue not in ('localmessagequeue', 'remotemessagequeue'):
+            raise ValueError('Unknown message queue: %s' % queue)
+        rows = []
+        for database in self._getdatabases():
+            rows.extend(self.dbconn.execute("SELECT messageid, posttime, message FROM %s.%s WHERE chatid = ? AND messageid > ? ORDER BY messageid LIMIT ?" % (database, queue),
+                                            (chatid, lastmessageid, limit)).fetchall())
+        rows.sort()
+        return rows[:limit]
+
+    def _getqueuedepths(self):
+        """Return a dictionary mapping each message queue to the number
+        of messages waiting in it and the posttime of the oldest"""
+        depths = {}
+        for table in ('localmessagequeue', 'remotemessagequeue'):
+            depths[table] = self.dbconn.execute("SELECT COUNT(*), MIN(posttime) FROM %s WHERE sendtime IS NULL" % table).fetchone()
+        return depths
+
+    def _getremotemessagessince(self, chatid, lastmessageid, limit=None):
+        """Return the (possibly empty) list of (messageid, message)
+        pairs queued for a chat after lastmessageid, oldest first.
+
+        This is a plain read, so unlike _getallqueuedremotemessages it
+        doesn't take a write lock unless it finds unsent messages to
+        mark as sent. Callers track the last messageid they've seen
+        instead of relying on sendtime to avoid duplicates."""
+        query = "SELECT messageid, message, sendtime FROM remotemessagequeue WHERE chatid = ? AND messageid > ? ORDER BY messageid"
+        if limit is None:
+            rows = self.dbconn.execute(query, (chatid, lastmessageid)).fetchall()
+        else:
+            rows = self.dbconn.execute(query + " LIMIT ?", (chatid, lastmessageid, limit)).fetchall()
+        now = time.time()
+        unsent = [(now, messageid) for messageid, message, sendtime in rows if sendtime is None]
+        if unsent:
+            with self.transaction():
+                self.dbconn.executemany("UPDATE remotemessagequeue SET sendtime = ? WHERE messageid = ? AND sendtime IS NULL", unsent)
+        return [(messageid, message) for messageid, message, sendtime in rows]
+
+    def _incrementalvacuum(self, pages):
+        """Return up to the given number of free pages to the
+        filesystem, and return how many free pages remain. Databases
+        that weren't created with auto_vacuum set to INCREMENTAL can't
+        return any, so this does nothing and returns 0 for them."""
+        if self.dbconn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        self.dbconn.execute("PRAGMA incremental_vacuum(%d)" % pages).fetchall()
+        return self.dbconn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def _markmessagessent(self, messageids):
+        """Record the time that all the given messages were sent, in
+        one transaction"""
+        sendtime = time.time()
+        with self.transaction():
+            self.dbconn.executemany("UPDATE localmessagequeue SET sendtime = ? WHERE messageid = ?",
+                                    [(sendtime, messageid) for messageid in messageids])
     
-    def _openchat(self, remoteuser, message=''):
-        """Issue a new chat request and return its chatid"""
-        self.dbconn.execute("INSERT INTO chat (remoteuser, starttime, status, startmessage) VALUES (?, ?, ?, ?)",
-                            (remoteuser, time.time(), self.STATUS_WAITING, message))
-        chatid = self.dbconn.execute("SELECT last_insert_rowid()").fetchone()[0]
-        self.dbconn.commit()
-        self._queueremote(chatid, "Your chat request has been sent. Please wait while it is answered.")
+    def _migrate(self, sqlitedb):
+        """Upgrade the database schema to CURRENTDBVERSION in place"""
+        # Manage the transactions by hand so that the sqlite3 module
+        # doesn't commit behind our backs before each CREATE statement
+        isolationlevel = self.dbconn.isolation_level
+        self.dbconn.isolation_level = None
+        try:
+            while True:
+                # Hold the write lock while reading the version so
+                # that two processes starting at the same time don't
+                # both try to apply the same migration
+                self.dbconn.execute("BEGIN IMMEDIATE TRANSACTION")
+                try:
+                    dbversion = self._getdbversion()
+                    if dbversion >= self.CURRENTDBVERSION:
+                        self.dbconn.execute("COMMIT")
+                        return
+                    MODULELOG.info('Upgrading the Seshat database (%s) from version %d to %d' % (sqlitedb, dbversion, dbversion + 1))
+                    for query in self.MIGRATIONS[dbversion + 1]:
+                        self.dbconn.execute(query)
+                        MODULELOG.debug('Executed: %s', query)
+                    self.dbconn.execute("UPDATE dbversion SET version = ? WHERE versionid = 1", (dbversion + 1,))
+                except:
+                    self.dbconn.execute("ROLLBACK")
+                    MODULELOG.critical('Unable to upgrade the Seshat database (%s) to version %d' % (sqlitedb, dbversion + 1))
+                    raise
+                self.dbconn.execute("COMMIT")
+        finally:
+            self.dbconn.isolation_level = isolationlevel
+
+    def _openchat(self, remoteuser, message='', chatid=None):
+        """Issue a new chat request and return its chatid. A chatid
+        allocated elsewhere may be given instead of letting the
+        database choose one (see: shardedbackend)."""
+        with self.transaction():
+            chatid = self.dbconn.execute("INSERT INTO chat (chatid, remoteuser, starttime, status, startmessage) VALUES (?, ?, ?, ?, ?)",
+                                         (chatid, remoteuser, time.time(), self.STATUS_WAITING, message)).lastrowid
+            self._queueremote(chatid, "Your chat request has been sent. Please wait while it is answered.")
         return chatid
     
     def _queuelocal(self, chatid, message):
         """Queue a message for delivery to a localuser"""
-        self.dbconn.execute("INSERT INTO localmessagequeue (posttime, chatid, message) VALUES (?, ?, ?)",
-                            (time.time(), chatid, message))
-        self.dbconn.commit()
+        with self.transaction():
+            self.dbconn.execute("INSERT INTO localmessagequeue (posttime, chatid, message) VALUES (?, ?, ?)",
+                                (time.time(), chatid, message))
         
     def _queueremote(self, chatid, message):
         """Send a web message to the chat's remoteuser"""
-        self.dbconn.execute("INSERT INTO remotemessagequeue (posttime, chatid, message) VALUES (?, ?, ?)",
-                            (time.time(), chatid, message))
-        self.dbconn.commit()
+        with self.transaction():
+            self.dbconn.execute("INSERT INTO remotemessagequeue (posttime, chatid, message) VALUES (?, ?, ?)",
+                                (time.time(), chatid, message))
+
+    def _releasechats(self, chatids, workerid):
+        """Give up workerid's claims on the chats"""
+        with self.transaction():
+            self.dbconn.executemany("UPDATE chat SET claimworker = NULL, claimexpires = NULL WHERE chatid = ? AND claimworker = ?",
+                                    [(chatid, workerid) for chatid in chatids])
+
+    def _setavailability(self, availablelocalusers, waitingchats, workerid):
+        """Replace the Availability stored by workerid"""
+        with self.transaction():
+            self.dbconn.execute("INSERT OR REPLACE INTO availability (workerid, availablelocalusers, waitingchats, generation, updatetime) "
+                                "VALUES (?, ?, ?, COALESCE((SELECT generation FROM availability WHERE workerid = ?), 0) + 1, ?)",
+                                (workerid, availablelocalusers, waitingchats, workerid, time.time()))
 
     def _setchatstatus(self, chatid, status):
         """Change the chat's status"""
-        self.dbconn.execute("UPDATE chat SET status = ? WHERE chatid = ?", (status, chatid))
-        self.dbconn.commit()
+        with self.transaction():
+            self.dbconn.execute("UPDATE chat SET status = ? WHERE chatid = ?", (status, chatid))
         
-    def _setonlinestatus(self, localuser, resource, online):
-        """Update (or store) the number of accounts where the
-        localuser is online. For example, they might be online with
-        both their desktop and laptop."""
-        online = int(online)
-        try:
-            self.dbconn.execute("INSERT INTO onlinestatus (localuser, resource, online) VALUES (?, ?, ?)", (localuser, resource, online))
-        except sqlite3.IntegrityError:
-            self.dbconn.execute("UPDATE onlinestatus SET online = ? WHERE localuser = ? AND resource = ?", (online, localuser, resource))
-        self.dbconn.commit()
+    def _setonlinestatuses(self, statuses, workerid):
+        """Update (or store) whether each localuser is online from
+        each resource in a list of (localuser, resource, online)
+        changes seen by workerid, in one transaction"""
+        with self.transaction():
+            self.dbconn.executemany("INSERT OR REPLACE INTO onlinestatus (workerid, localuser, resource, online) VALUES (?, ?, ?, ?)",
+                                    [(workerid, localuser, resource, int(online)) for localuser, resource, online in statuses])
+
+    def _setpragmas(self, pragmas):
+        """Apply the given PRAGMA settings to the connection"""
+        for pragma, value in sorted(pragmas.items()):
+            try:
+                allowed = PRAGMAS[pragma]
+            except KeyError:
+                raise ValueError('Unknown SQLite setting: %s' % pragma)
+            if isinstance(allowed, tuple):
+                value = str(value).strip().upper()
+                if value not in allowed:
+                    raise ValueError('%s must be one of %s, not %s' % (pragma, ', '.join(allowed), value))
+            else:
+                value = allowed(value)
+            result = self.dbconn.execute("PRAGMA %s = %s" % (pragma, value)).fetchone()
+            MODULELOG.debug('Set %s to %s (SQLite reports: %s)', pragma, value, result)
+
+    def _waitforchange(self, timeout, dataversion=None, chatid=None):
+        """Wait up to timeout seconds for another connection to commit
+        a change to the database since _getdataversion returned
+        dataversion (or since now, if it's None). Return True if one
+        did, or False if the timeout expired first."""
+        # Checking data_version doesn't read any tables, so this is
+        # far cheaper than repeating the caller's query
+        if dataversion is None:
+            dataversion = self._getdataversion()
+        return waitforchange(self._getdataversion, timeout, dataversion)
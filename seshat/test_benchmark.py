@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Tests for the benchmark harness:
+
+    $ cd seshat && python -m unittest test_benchmark"""
+
+import json
+import unittest
+
+import benchmark
+import memorybackend
+
+class BenchmarkTest(unittest.TestCase):
+    """Runs a small benchmark in memory"""
+
+    def test_percentiles(self):
+        """Percentiles are taken by the nearest-rank method"""
+        self.assertEqual(benchmark.percentiles([]), None)
+        self.assertEqual(benchmark.percentiles(range(100, 0, -1)), {'count': 100, 'p50': 50, 'p95': 95, 'p99': 99, 'max': 100})
+        self.assertEqual(benchmark.percentiles([7]), {'count': 1, 'p50': 7, 'p95': 7, 'p99': 7, 'max': 7})
+
+    def test_run(self):
+        """Every visitor's chat is accepted and every message echoed,
+        and the results can be written as JSON"""
+        settings = {'backend': 'memory', 'memorystore': self.id()}
+        try:
+            results = benchmark.Benchmark(settings, visitors=3, agents=2, messages=2, rate=50).run()
+        finally:
+            memorybackend.STORES.pop(self.id(), None)
+        self.assertEqual(results['chats'], {'started': 3, 'accepted': 3, 'failed': 0})
+        self.assertEqual((results['messages']['sent'], results['messages']['echoed']), (6, 6))
+        self.assertEqual(results['roundtrip']['count'], 6)
+        self.assertEqual(results['errors'], {'locked': 0, 'throttled': 0, 'other': 0})
+        self.assertTrue(results['relay']['local']['count'] >= 6)
+        self.assertEqual(json.loads(json.dumps(results))['maxchats'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
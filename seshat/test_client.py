@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Tests for the client library, run against an in-memory backend:
+
+    $ cd seshat && python -m unittest test_client"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import backend
+import client
+import memorybackend
+
+class SeshatClientTest(unittest.TestCase):
+    """Plays a visitor chatting through a SeshatClient, with the
+    backend standing in for the broker bot"""
+
+    def setUp(self):
+        """Start a chat in a store of the test's own, and skip the
+        greeting queued with it"""
+        self.seshatclient = client.SeshatClient(memorybackend.MemoryBackend(self.id()))
+        self.backend = self.seshatclient.backend
+        self.chatid = self.seshatclient.startchat('visitor', 'hello')
+        self.seshatclient.getmessages(self.chatid, 'visitor')
+
+    def tearDown(self):
+        """Forget the store and its cached chats"""
+        memorybackend.STORES.pop(self.id(), None)
+        client.CHATINFOCACHES.pop(self.backend.location, None)
+        client.AVAILABILITIES.pop(self.backend.location, None)
+
+    def test_getmessages(self):
+        """getmessages drains the chat's queue at once, or up to limit
+        messages of it, and only for the chat's own visitor"""
+        for number in range(3):
+            self.backend._queueremote(self.chatid, 'message %d' % number)
+        self.assertEqual(self.seshatclient.getmessages(self.chatid, 'someone else'), [])
+        self.assertEqual(self.seshatclient.getmessages(self.chatid, 'visitor', limit=2), ['message 0', 'message 1'])
+        self.assertEqual(self.seshatclient.getmessages(self.chatid, 'visitor'), ['message 2'])
+        self.assertEqual(self.seshatclient.getmessages(self.chatid, 'visitor'), [])
+
+    def test_getmessagessince(self):
+        """getmessagessince returns the messages after a cursor, which
+        can be read again from the same cursor, and marks them sent"""
+        for number in range(3):
+            self.backend._queueremote(self.chatid, 'message %d' % number)
+        messages = self.seshatclient.getmessagessince(self.chatid, 'visitor')
+        self.assertEqual([message for messageid, message in messages][-3:], ['message 0', 'message 1', 'message 2'])
+        cursor = messages[-3][0]
+        self.assertEqual(self.seshatclient.getmessagessince(self.chatid, 'visitor', cursor), messages[-2:])
+        self.assertEqual(self.seshatclient.getmessagessince(self.chatid, 'visitor', cursor, limit=1), messages[-2:-1])
+        self.assertEqual(self.seshatclient.getmessagessince(self.chatid, 'visitor', messages[-1][0]), [])
+        self.assertEqual(self.seshatclient.getmessages(self.chatid, 'visitor'), [])
+        self.assertEqual(self.seshatclient.getmessagessince(self.chatid, 'someone else'), [])
+
+    def test_cachedstatus(self):
+        """A chat closed by the broker bot is noticed once its cached
+        copy is old enough, and one the visitor ended right away"""
+        self.backend._acceptchat(self.chatid, 'joe@example.com')
+        self.backend._closechat(self.chatid, self.seshatclient.STATUS_CLOSED)
+        self.assertFalse(self.seshatclient.isfinished(self.chatid))
+        self.seshatclient.chatinfocache.entries[self.chatid][1] -= client.CHATINFOMAXAGE + 1
+        self.assertTrue(self.seshatclient.isfinished(self.chatid))
+        otherchatid = self.seshatclient.startchat('visitor')
+        self.backend._acceptchat(otherchatid, 'joe@example.com')
+        self.seshatclient.endchat(otherchatid)
+        self.assertTrue(self.seshatclient.isfinished(otherchatid))
+
+    def test_acceptedwhilecached(self):
+        """Messages sent to a chat accepted since it was cached are
+        queued without telling the visitor to wait"""
+        self.backend._acceptchat(self.chatid, 'joe@example.com')
+        self.assertTrue(self.seshatclient.sendmessage(self.chatid, 'visitor', 'hi'))
+        self.assertEqual(self.seshatclient.getmessages(self.chatid, 'visitor'), [])
+        self.assertEqual(self.backend._countunsentlocalmessages(self.chatid), 1)
+
+    def test_isavailable(self):
+        """isavailable reads the broker bot's snapshot, reusing it for
+        a moment, and says no one is available once it's stale"""
+        self.assertFalse(self.seshatclient.isavailable())
+        self.backend._setavailability(1, 0, 'worker')
+        self.assertFalse(self.seshatclient.isavailable())
+        self.assertEqual(self.seshatclient.getavailability(maxage=0).availablelocalusers, 1)
+        self.assertTrue(self.seshatclient.isavailable())
+        self.backend._setavailability(0, 1, 'worker')
+        self.assertTrue(self.seshatclient.isavailable())
+        self.assertEqual(self.seshatclient.getavailability(maxage=0).waitingchats, 1)
+        self.assertFalse(self.seshatclient.isavailable())
+        stale = backend.Availability(1, 0, 3, time.time() - client.AVAILABILITYSTALE - 1)
+        client.AVAILABILITIES[self.backend.location] = (stale, time.time())
+        self.assertFalse(self.seshatclient.isavailable())
+
+class ChatInfoCacheTest(unittest.TestCase):
+    """Checks when cached chats go stale and which are evicted"""
+
+    def chatinfo(self, chatid, status=client.SeshatClient.STATUS_OPEN):
+        """Return a ChatInfo for a chat with the given status"""
+        return backend.ChatInfo(chatid, 'joe@example.com', 'visitor', 0, None, status, '')
+
+    def test_maxage(self):
+        """Chats cached more than maxage seconds ago aren't returned,
+        unless they've finished and can't change again"""
+        cache = client.ChatInfoCache()
+        cache.put(self.chatinfo(1))
+        cache.put(self.chatinfo(2, client.SeshatClient.STATUS_CLOSED))
+        for entry in cache.entries.values():
+            entry[1] -= 10
+        self.assertEqual(cache.get(1, 5), None)
+        self.assertEqual(cache.get(1, None).chatid, 1)
+        self.assertEqual(cache.get(2, 5).chatid, 2)
+        self.assertEqual(cache.get(3), None)
+
+    def test_eviction(self):
+        """The least recently used chats are forgotten when the cache
+        is full"""
+        cache = client.ChatInfoCache(maxsize=10)
+        for chatid in range(10):
+            cache.put(self.chatinfo(chatid))
+        cache.get(0)
+        cache.put(self.chatinfo(10))
+        self.assertEqual(len(cache.entries), 10)
+        self.assertEqual(cache.get(1), None)
+        for chatid in [0] + range(2, 11):
+            self.assertEqual(cache.get(chatid).chatid, chatid)
+
+class AdmissionControlTest(unittest.TestCase):
+    """Plays visitors who chat faster than the site allows"""
+
+    def setUp(self):
+        """Prepare a client with a store of the test's own"""
+        self.storage = memorybackend.MemoryBackend(self.id())
+
+    def tearDown(self):
+        """Forget the store and what was read from it"""
+        memorybackend.STORES.pop(self.id(), None)
+        client.CHATINFOCACHES.pop(self.storage.location, None)
+        client.AVAILABILITIES.pop(self.storage.location, None)
+
+    def getclient(self, **limits):
+        """Return a SeshatClient held to the given limits"""
+        return client.SeshatClient(self.storage, admission=client.AdmissionControl(**limits))
+
+    def test_chatburst(self):
+        """Each visitor may start a burst of chats, and is then told
+        when to try again"""
+        seshatclient = self.getclient(chatrate=0.5, chatburst=2)
+        seshatclient.startchat('visitor')
+        seshatclient.startchat('visitor')
+        try:
+            seshatclient.startchat('visitor')
+        except client.AdmissionError, error:
+            self.assertTrue(0 < error.retryafter <= 2)
+        else:
+            self.fail('The third chat was admitted')
+        seshatclient.startchat('visitor', admissionkey='10.0.0.2')
+
+    def test_messageburst(self):
+        """Each visitor may send a burst of messages, and no limit
+        applies when the rate is 0"""
+        seshatclient = self.getclient(messagerate=1, messageburst=3)
+        chatid = seshatclient.startchat('visitor')
+        for message in range(3):
+            self.assertTrue(seshatclient.sendmessage(chatid, 'visitor', 'hi'))
+        self.assertRaises(client.AdmissionError, seshatclient.sendmessage, chatid, 'visitor', 'hi')
+        unlimited = self.getclient(messagerate=0, maxpendingmessages=0)
+        for message in range(100):
+            self.assertTrue(unlimited.sendmessage(chatid, 'visitor', 'hi'))
+
+    def test_maxpendingmessages(self):
+        """Visitors can't queue more messages than the chat's localuser
+        has yet to receive"""
+        seshatclient = self.getclient(messagerate=0, maxpendingmessages=2)
+        chatid = seshatclient.startchat('visitor')
+        self.storage._acceptchat(chatid, 'joe@example.com')
+        seshatclient.sendmessage(chatid, 'visitor', 'one')
+        seshatclient.sendmessage(chatid, 'visitor', 'two')
+        self.assertRaises(client.AdmissionError, seshatclient.sendmessage, chatid, 'visitor', 'three')
+        self.storage._markmessagessent([message.messageid for message in self.storage._claimqueuedlocalmessages('worker', 60)])
+        self.assertTrue(seshatclient.sendmessage(chatid, 'visitor', 'three'))
+
+    def test_maxwaitingchats(self):
+        """No more chats are started once too many are waiting across
+        the site, as counted by the broker bot if it says"""
+        seshatclient = self.getclient(chatrate=0, maxwaitingchats=2)
+        seshatclient.startchat('first')
+        seshatclient.startchat('second')
+        self.assertRaises(client.AdmissionError, seshatclient.startchat, 'third')
+        self.storage._setavailability(1, 1, 'worker')
+        self.assertEqual(seshatclient.getavailability(maxage=0).waitingchats, 1)
+        seshatclient.startchat('third')
+
+    def test_getadmissioncontrol(self):
+        """The limits are read from the settings"""
+        admission = client.getadmissioncontrol({'seshat_chatrate': '0', 'messageburst': '7', 'seshat_maxwaitingchats': '3'})
+        self.assertEqual((admission.chatbuckets.rate, admission.chatbuckets.burst), (0, client.CHATBURST))
+        self.assertEqual((admission.messagebuckets.rate, admission.messagebuckets.burst), (client.MESSAGERATE, 7))
+        self.assertEqual((admission.maxpendingmessages, admission.maxwaitingchats), (client.MAXPENDINGMESSAGES, 3))
+
+class CombineAvailabilitiesTest(unittest.TestCase):
+    """Checks how the snapshots of several broker bots are combined"""
+
+    def test_fresh(self):
+        """Running bots share localusers but not waiting chats"""
+        now = time.time()
+        combined = client.combineavailabilities([backend.Availability(2, 1, 5, now - 1), backend.Availability(3, 4, 7, now)])
+        self.assertEqual((combined.availablelocalusers, combined.waitingchats, combined.generation, combined.updatetime), (3, 5, 12, now))
+
+    def test_stale(self):
+        """Stopped bots are left out unless none are running"""
+        now = time.time()
+        stale = backend.Availability(5, 5, 1, now - client.AVAILABILITYSTALE - 1)
+        older = backend.Availability(9, 9, 1, now - client.AVAILABILITYSTALE - 2)
+        combined = client.combineavailabilities([stale, backend.Availability(1, 0, 2, now)])
+        self.assertEqual((combined.availablelocalusers, combined.waitingchats), (1, 0))
+        self.assertTrue(client.combineavailabilities([older, stale]) is stale)
+        self.assertEqual(client.combineavailabilities([]), None)
+
+class SeshatClientPoolTest(unittest.TestCase):
+    """Checks that pooled clients are shared and reused"""
+
+    def setUp(self):
+        """Describe a backend of the test's own"""
+        self.settings = {'seshat_backend': 'memory', 'seshat_memorystore': self.id()}
+
+    def test_sharedpool(self):
+        """Settings naming the same backend share one pool"""
+        pool = client.getpool(self.settings)
+        self.assertTrue(client.getpool(dict(self.settings)) is pool)
+        self.assertFalse(client.getpool({'seshat_backend': 'memory', 'seshat_memorystore': self.id() + 'other'}) is pool)
+
+    def test_reuse(self):
+        """Released clients are handed out again, up to maxidle of
+        them"""
+        pool = client.SeshatClientPool(self.settings, maxidle=1)
+        first, second = pool.get(), pool.get()
+        self.assertFalse(first is second)
+        pool.release(first)
+        pool.release(second)
+        self.assertTrue(pool.get() is first)
+        self.assertFalse(pool.get() is second)
+
+    def test_releaseaborts(self):
+        """A client's uncommitted changes are undone when it's
+        released"""
+        tempdir = tempfile.mkdtemp()
+        try:
+            pool = client.SeshatClientPool({'seshat_sqlitedb': os.path.join(tempdir, 'seshat.db')})
+            seshatclient = pool.get()
+            chatid = seshatclient.startchat('visitor')
+            seshatclient.backend.dbconn.execute("UPDATE chat SET status = ?", (seshatclient.STATUS_FAILED,))
+            pool.release(seshatclient)
+            self.assertEqual(pool.get().backend._getchatinfo(chatid).status, seshatclient.STATUS_WAITING)
+        finally:
+            shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    unittest.main()
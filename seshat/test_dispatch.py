@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Tests for the dispatch scheduler:
+
+    $ cd seshat && python -m unittest test_dispatch"""
+
+import unittest
+
+import dispatch
+
+USERS = frozenset(['amy@example.com', 'bob@example.com', 'joe@example.com'])
+
+class OpenChat(object):
+    """Stands in for the ChatInfo of an open chat"""
+
+    def __init__(self, chatid, localuser):
+        """Record who's handling the chat"""
+        self.chatid = chatid
+        self.localuser = localuser
+
+class SchedulerTest(unittest.TestCase):
+    """Checks who each policy offers chats to, and what happens when
+    offers go unanswered"""
+
+    def expire(self, scheduler, chatid):
+        """Make the chat's latest offer look older than offertimeout"""
+        scheduler.offers[chatid][0] -= scheduler.offertimeout + 1
+
+    def test_broadcast(self):
+        """Every free localuser is offered every chat, and the offers
+        never expire"""
+        scheduler = dispatch.Scheduler()
+        self.assertEqual(scheduler.choose(1, USERS), sorted(USERS))
+        self.expire(scheduler, 1)
+        self.assertEqual(scheduler.expiredoffers(), [])
+        scheduler.accepted('bob@example.com', 1)
+        self.assertEqual(scheduler.available(USERS), ['amy@example.com', 'joe@example.com'])
+        self.assertEqual(scheduler.waiting(), 0)
+
+    def test_roundrobin(self):
+        """Localusers take turns, and an unanswered offer moves on to
+        someone who hasn't been offered the chat"""
+        scheduler = dispatch.Scheduler('roundrobin')
+        self.assertEqual(scheduler.choose(1, USERS), ['amy@example.com'])
+        self.assertEqual(scheduler.choose(2, USERS), ['bob@example.com'])
+        self.assertEqual(scheduler.expiredoffers(), [])
+        self.expire(scheduler, 1)
+        self.assertEqual(scheduler.expiredoffers(), [1])
+        self.assertEqual(scheduler.choose(1, USERS), ['joe@example.com'])
+
+    def test_leastloaded(self):
+        """Whoever has the fewest open chats is offered the next one"""
+        scheduler = dispatch.Scheduler('leastloaded', maxchats=3)
+        scheduler.refresh([OpenChat(1, 'amy@example.com'), OpenChat(2, 'amy@example.com'), OpenChat(3, 'bob@example.com')])
+        self.assertEqual(scheduler.choose(4, USERS), ['joe@example.com'])
+        self.assertEqual(scheduler.choose(5, USERS), ['bob@example.com'])
+
+    def test_maxchats(self):
+        """Localusers handling maxchats chats, or alone offered enough
+        to fill up, aren't offered more"""
+        scheduler = dispatch.Scheduler('roundrobin', maxchats=2)
+        scheduler.accepted('amy@example.com', 1)
+        scheduler.accepted('amy@example.com', 2)
+        self.assertEqual(scheduler.available(USERS), ['bob@example.com', 'joe@example.com'])
+        scheduler.choose(3, ['bob@example.com'])
+        scheduler.choose(4, ['bob@example.com'])
+        self.assertEqual(scheduler.choose(5, ['bob@example.com']), [])
+        scheduler.closed('amy@example.com', 1)
+        self.assertEqual(scheduler.available(USERS), ['amy@example.com', 'joe@example.com'])
+
+    def test_escalation(self):
+        """Once everyone free has let a chat go unanswered, it's offered
+        to all of them, and later to whoever has freed up since"""
+        scheduler = dispatch.Scheduler('roundrobin', maxchats=2)
+        scheduler.accepted('joe@example.com', 1)
+        scheduler.accepted('joe@example.com', 2)
+        self.assertEqual(scheduler.choose(3, USERS), ['amy@example.com'])
+        self.expire(scheduler, 3)
+        self.assertEqual(scheduler.choose(3, USERS), ['bob@example.com'])
+        self.expire(scheduler, 3)
+        self.assertEqual(scheduler.choose(3, USERS), ['amy@example.com', 'bob@example.com'])
+        scheduler.closed('joe@example.com', 1)
+        self.expire(scheduler, 3)
+        self.assertEqual(scheduler.expiredoffers(), [3])
+        self.assertEqual(scheduler.choose(3, USERS), ['joe@example.com'])
+        self.expire(scheduler, 3)
+        self.assertEqual(scheduler.choose(3, USERS), sorted(USERS))
+
+    def test_nobodyfree(self):
+        """A chat nobody is free to take after its offers expire is
+        tried again later, from scratch"""
+        scheduler = dispatch.Scheduler('roundrobin')
+        self.assertEqual(scheduler.choose(1, ['amy@example.com']), ['amy@example.com'])
+        self.expire(scheduler, 1)
+        self.assertEqual(scheduler.choose(1, []), [])
+        self.assertEqual(scheduler.waiting(), 1)
+        self.expire(scheduler, 1)
+        self.assertEqual(scheduler.expiredoffers(), [1])
+        self.assertEqual(scheduler.choose(1, ['amy@example.com']), ['amy@example.com'])
+
+    def test_hold(self):
+        """Up to maxwaiting chats are held, and their remoteusers are
+        only told to wait once"""
+        scheduler = dispatch.Scheduler(maxwaiting=1)
+        self.assertEqual(scheduler.hold(1, 0), 'wait')
+        self.assertEqual(scheduler.hold(1, 0), 'waiting')
+        self.assertEqual(scheduler.hold(2, 1), 'fail')
+        self.assertEqual(scheduler.waiting(), 1)
+        scheduler.prune([])
+        self.assertEqual(scheduler.waiting(), 0)
+
+    def test_badpolicy(self):
+        """Unknown policies are rejected"""
+        self.assertRaises(ValueError, dispatch.Scheduler, 'random')
+
+if __name__ == '__main__':
+    unittest.main()
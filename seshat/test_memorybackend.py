@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Tests for the in-memory backend:
+
+    $ cd seshat && python -m unittest test_memorybackend"""
+
+import time
+import unittest
+
+import memorybackend
+
+class MemoryBackendTest(unittest.TestCase):
+    """Runs a MemoryBackend with a store of its own"""
+
+    def setUp(self):
+        """Connect to a new store"""
+        self.storage = memorybackend.MemoryBackend(self.id())
+
+    def tearDown(self):
+        """Forget the store"""
+        memorybackend.STORES.pop(self.id(), None)
+
+    def checkindexes(self):
+        """Check that every index matches a scan of its table"""
+        store = self.storage.store
+        for name, index in memorybackend.INDEXES.items():
+            table, keyfunction, orderfunction = (index + (None,))[:3]
+            expected = {}
+            for key, row in store.tables[table].items():
+                indexkey = keyfunction(row)
+                if indexkey is not None:
+                    expected.setdefault(indexkey, []).append(key if orderfunction is None else (orderfunction(row), key))
+            for entries in expected.values():
+                entries.sort()
+            self.assertEqual(store.indexes[name], expected, name)
+
+    def test_indexes(self):
+        """The indexes follow every change to the tables"""
+        chatids = [self.storage._openchat('visitor') for number in range(3)]
+        self.storage._acceptchat(chatids[0], 'joe@example.com')
+        self.storage._queuelocal(chatids[0], 'hi')
+        self.storage._queueremote(chatids[0], 'hello')
+        self.storage._getallqueuedremotemessages(chatids[0])
+        self.storage._closechat(chatids[1], self.storage.STATUS_CLOSED)
+        self.checkindexes()
+        self.assertEqual([chat.chatid for chat in self.storage._getlocaluserchats('joe@example.com')], chatids[:1])
+        self.assertEqual([chat.chatid for chat in self.storage._getchatswithstatus(self.storage.STATUS_WAITING)], chatids[2:])
+        self.assertEqual(self.storage._countunsentlocalmessages(chatids[0]), 1)
+
+    def test_rollback(self):
+        """A transaction that raises is undone, indexes and all"""
+        chatid = self.storage._openchat('visitor')
+        try:
+            with self.storage.transaction():
+                self.storage._acceptchat(chatid, 'joe@example.com')
+                self.storage._queuelocal(chatid, 'hi')
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(self.storage._getchatinfo(chatid).status, self.storage.STATUS_WAITING)
+        self.assertEqual(self.storage._countunsentlocalmessages(chatid), 0)
+        self.checkindexes()
+
+    def test_archivemessages(self):
+        """Only messages sent before the cutoff are archived, oldest
+        first, a batch at a time, and they can still be read"""
+        chatid = self.storage._openchat('visitor')
+        for number in range(4):
+            self.storage._queueremote(chatid, 'message %d' % number)
+        messages = self.storage._getallqueuedremotemessages(chatid)
+        cutoff = time.time() + 60
+        self.storage._queueremote(chatid, 'unsent')
+        self.assertEqual(self.storage._archivemessages(cutoff, 3), 3)
+        self.assertEqual(self.storage._archivemessages(cutoff, 3), 2)
+        self.assertEqual(self.storage._archivemessages(cutoff, 3), 0)
+        self.assertEqual(self.storage._archivemessages(0, 3), 0)
+        self.assertEqual([message for messageid, posttime, message in self.storage._getmessagessince(chatid, 'remotemessagequeue', 0, 100)], messages + ['unsent'])
+        self.checkindexes()
+
+    def test_archivechats(self):
+        """Only chats that finished before the cutoff are archived,
+        along with their messages"""
+        chatids = [self.storage._openchat('visitor') for number in range(3)]
+        self.storage._closechat(chatids[0], self.storage.STATUS_CLOSED)
+        self.storage._setchatstatus(chatids[1], self.storage.STATUS_FAILED)
+        self.assertEqual(self.storage._archivechats(0, 10), 0)
+        self.assertEqual(self.storage._archivechats(time.time() + 60, 10), 2)
+        self.assertEqual(sorted(self.storage.store.tables['chat']), chatids[2:])
+        self.assertEqual(sorted(self.storage.store.tables['archive.chat']), chatids[:2])
+        self.assertEqual(self.storage.store.tables['archive.chat'][chatids[0]][5], self.storage.STATUS_CLOSED)
+        self.assertEqual(len(self.storage._getmessagessince(chatids[0], 'remotemessagequeue', 0, 100)), 1)
+        self.checkindexes()
+
+    def test_claims(self):
+        """A claimed chat's messages are only handed to the worker
+        that claimed it until the claim is released"""
+        chatid = self.storage._openchat('visitor')
+        self.storage._acceptchat(chatid, 'joe@example.com')
+        self.storage._queuelocal(chatid, 'hi')
+        self.assertEqual([message.message for message in self.storage._claimqueuedlocalmessages('one', 60)], ['hi'])
+        self.assertEqual(self.storage._claimqueuedlocalmessages('two', 60), [])
+        self.storage._releasechats([chatid], 'one')
+        self.assertEqual([message.message for message in self.storage._claimqueuedlocalmessages('two', 60)], ['hi'])
+
+    def test_sharedstore(self):
+        """Backends with the same store name see each other's changes"""
+        chatid = self.storage._openchat('visitor')
+        other = memorybackend.MemoryBackend(self.id())
+        self.assertEqual(other._getchatinfo(chatid).remoteuser, 'visitor')
+
+if __name__ == '__main__':
+    unittest.main()
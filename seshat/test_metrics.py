@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Tests for the broker bot's instrumentation:
+
+    $ cd seshat && python -m unittest test_metrics"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import metrics
+
+class Storage(object):
+    """Stands in for a backend"""
+
+    location = 'nowhere'
+
+    def _getchatinfo(self, chatid):
+        """Return the chatid, or fail for chat 0"""
+        if not chatid:
+            raise ValueError('No such chat')
+        return chatid
+
+class MetricsTest(unittest.TestCase):
+    """Checks what's collected and how it's rendered"""
+
+    def test_counters(self):
+        """Counters add up and gauges are replaced, separately for each
+        set of labels"""
+        collected = metrics.Metrics()
+        collected.increment('seshat_messages_total', queue='localmessagequeue')
+        collected.increment('seshat_messages_total', 2, queue='localmessagequeue')
+        collected.increment('seshat_messages_total', queue='remotemessagequeue')
+        collected.setgauge('seshat_outbox_depth', 5)
+        collected.setgauge('seshat_outbox_depth', 3)
+        self.assertEqual(collected.getvalue('seshat_messages_total', queue='localmessagequeue'), 3)
+        self.assertEqual(collected.getvalue('seshat_messages_total', queue='remotemessagequeue'), 1)
+        self.assertEqual(collected.getvalue('seshat_outbox_depth'), 3)
+        self.assertEqual(collected.getvalue('seshat_unknown'), 0)
+
+    def test_histogram(self):
+        """Quantiles are the bounds of the buckets they fall in, but
+        never more than the largest timing"""
+        histogram = metrics.Histogram()
+        self.assertEqual(histogram.quantile(0.5), None)
+        for value in (0.002, 0.002, 0.002, 0.3):
+            histogram.observe(value)
+        self.assertEqual(histogram.quantile(0.5), 0.0025)
+        self.assertEqual(histogram.quantile(1), 0.3)
+        histogram.observe(1000)
+        self.assertEqual(histogram.quantile(1), 1000)
+        self.assertEqual((histogram.count, histogram.max), (5, 1000))
+
+    def test_render(self):
+        """Everything is rendered in the Prometheus text format, with
+        cumulative buckets"""
+        collected = metrics.Metrics()
+        collected.increment('seshat_messages_total', queue='local"queue')
+        collected.observe('seshat_loop_seconds', 0.004)
+        collected.observe('seshat_loop_seconds', 1000)
+        lines = collected.render().splitlines()
+        self.assertTrue('# TYPE seshat_messages_total counter' in lines)
+        self.assertTrue('seshat_messages_total{queue="local\\"queue"} 1' in lines)
+        self.assertTrue('# TYPE seshat_loop_seconds histogram' in lines)
+        self.assertTrue('seshat_loop_seconds_bucket{le="0.0025"} 0' in lines)
+        self.assertTrue('seshat_loop_seconds_bucket{le="0.005"} 1' in lines)
+        self.assertTrue('seshat_loop_seconds_bucket{le="300"} 1' in lines)
+        self.assertTrue('seshat_loop_seconds_bucket{le="+Inf"} 2' in lines)
+        self.assertTrue('seshat_loop_seconds_count 2' in lines)
+
+    def test_writefile(self):
+        """The stats file is replaced with what's been collected"""
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'stats')
+            collected = metrics.Metrics()
+            collected.writefile(path)
+            collected.setgauge('seshat_outbox_depth', 1)
+            collected.writefile(path)
+            self.assertEqual(open(path).read(), collected.render())
+            self.assertEqual(os.listdir(tempdir), ['stats'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_instrumentedbackend(self):
+        """Internal backend methods are timed and their failures
+        counted, and everything else is passed through"""
+        collected = metrics.Metrics()
+        storage = metrics.InstrumentedBackend(Storage(), collected)
+        self.assertEqual(storage.location, 'nowhere')
+        self.assertEqual(storage._getchatinfo(1), 1)
+        self.assertRaises(ValueError, storage._getchatinfo, 0)
+        histograms = collected.gethistograms('seshat_backend_seconds')
+        self.assertEqual(histograms.keys(), [(('method', '_getchatinfo'),)])
+        self.assertEqual(histograms.values()[0].count, 2)
+        self.assertEqual(collected.getvalue('seshat_backend_errors_total', method='_getchatinfo'), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Tests for the notification sockets between clients and broker bots:
+
+    $ cd seshat && python -m unittest test_notify"""
+
+import os
+import select
+import shutil
+import socket
+import tempfile
+import unittest
+
+import notify
+
+class NotifyTest(unittest.TestCase):
+    """Signals broker bots listening beside a database in a temporary
+    directory"""
+
+    def setUp(self):
+        """Name a notification socket in an empty directory"""
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'seshat.db.notify')
+        self.listeners = []
+
+    def tearDown(self):
+        """Stop listening and remove the directory"""
+        for listener in self.listeners:
+            listener.close()
+        shutil.rmtree(self.tempdir)
+
+    def listen(self, workerid=None):
+        """Return a NotificationListener that's closed after the
+        test"""
+        listener = notify.NotificationListener(self.path, workerid)
+        self.listeners.append(listener)
+        return listener
+
+    def test_getnotifypath(self):
+        """The socket is named after the database, and in-memory
+        databases don't have one"""
+        self.assertEqual(notify.getnotifypath('/tmp/seshat.db'), '/tmp/seshat.db.notify')
+        self.assertEqual(notify.getnotifypath(':memory:'), None)
+
+    def test_notify(self):
+        """A notification wakes the listener, and draining it consumes
+        every waiting notification"""
+        listener = self.listen()
+        notifier = notify.Notifier(self.path)
+        try:
+            self.assertEqual(select.select([listener], [], [], 0)[0], [])
+            notifier.notify()
+            notifier.notify()
+            self.assertEqual(select.select([listener], [], [], 1)[0], [listener])
+            self.assertEqual(listener.drain(), 2)
+            self.assertEqual(listener.drain(), 0)
+        finally:
+            notifier.close()
+
+    def test_nolistener(self):
+        """Notifying when nobody is listening, or without a path at all,
+        does nothing"""
+        for path in (self.path, None):
+            notifier = notify.Notifier(path)
+            notifier.notify()
+            notifier.close()
+
+    def test_workers(self):
+        """Each worker listens at its own socket, and clients signal all
+        of them"""
+        first = self.listen('host:1')
+        second = self.listen('host:2')
+        self.assertEqual(first.path, self.path + '.host:1')
+        self.assertEqual(notify.getlistenerpaths(self.path), [first.path, second.path])
+        notifier = notify.Notifier(self.path)
+        try:
+            notifier.notify()
+        finally:
+            notifier.close()
+        self.assertEqual(first.drain(), 1)
+        self.assertEqual(second.drain(), 1)
+
+    def test_workerpath(self):
+        """Workerids can't name a socket in another directory"""
+        self.assertEqual(notify.getworkerpath(self.path, 'a/b'), self.path + '.a_b')
+
+    def test_unrelatedfiles(self):
+        """Only files named after the socket are taken for listeners"""
+        for name in ('seshat.db', 'seshat.db.notifyother', 'other.notify'):
+            open(os.path.join(self.tempdir, name), 'w').close()
+        listener = self.listen('host:1')
+        self.assertEqual(notify.getlistenerpaths(self.path), [listener.path])
+
+    def test_removedeadlisteners(self):
+        """Sockets left behind by stopped broker bots are removed when
+        another starts, and live ones are kept"""
+        live = self.listen('host:1')
+        dead = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        deadpath = notify.getworkerpath(self.path, 'host:2')
+        dead.bind(deadpath)
+        dead.close()
+        self.assertTrue(os.path.exists(deadpath))
+        restarted = self.listen('host:3')
+        self.assertFalse(os.path.exists(deadpath))
+        self.assertEqual(notify.getlistenerpaths(self.path), [live.path, restarted.path])
+
+    def test_close(self):
+        """Closing a listener removes its socket"""
+        listener = notify.NotificationListener(self.path)
+        self.assertTrue(os.path.exists(self.path))
+        listener.close()
+        self.assertFalse(os.path.exists(self.path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Tests for archiving old messages and chats:
+
+    $ cd seshat && python -m unittest test_retention"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import memorybackend
+import retention
+import sqlitebackend
+
+class ArchiverTest(unittest.TestCase):
+    """Archives a SQLite database in a temporary directory"""
+
+    def setUp(self):
+        """Create a database with a finished chat and an open one, each
+        with delivered messages"""
+        self.tempdir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tempdir, 'seshat.db')
+        sqlitebackend.CHECKEDDATABASES.discard(self.dbpath)
+        self.storage = sqlitebackend.SqliteBackend(self.dbpath)
+        self.archivepath = retention.getarchivedb(self.storage)
+        self.finished = self.startchat()
+        self.storage._closechat(self.finished, self.storage.STATUS_CLOSED)
+        self.open = self.startchat()
+        self.storage._queuelocal(self.open, 'not yet delivered')
+        # Leave the archiver's cutoff after everything that was sent
+        time.sleep(0.01)
+
+    def tearDown(self):
+        """Remove the databases"""
+        self.storage._close()
+        shutil.rmtree(self.tempdir)
+
+    def startchat(self):
+        """Start and accept a chat, and deliver three messages each
+        way in it. Return its chatid."""
+        chatid = self.storage._openchat('visitor', 'hello')
+        self.storage._acceptchat(chatid, 'joe@example.com')
+        for number in range(3):
+            self.storage._queuelocal(chatid, 'to joe %d' % number)
+            self.storage._queueremote(chatid, 'to visitor %d' % number)
+        self.storage._markmessagessent([message.messageid for message in self.storage._claimqueuedlocalmessages('worker', 60)])
+        self.storage._getallqueuedremotemessages(chatid)
+        return chatid
+
+    def count(self, dbpath, table, chatid):
+        """Return how many of the chat's rows the table in the database
+        holds"""
+        dbconn = sqlite3.connect(dbpath)
+        try:
+            return dbconn.execute("SELECT COUNT(*) FROM %s WHERE chatid = ?" % table, (chatid,)).fetchone()[0]
+        finally:
+            dbconn.close()
+
+    def test_getarchivedb(self):
+        """The archive is named after the database unless it's given,
+        and in-memory backends archive in memory"""
+        self.assertEqual(self.archivepath, self.dbpath + '.archive')
+        self.assertEqual(retention.getarchivedb(self.storage, '/elsewhere.db'), '/elsewhere.db')
+        storename = self.id()
+        try:
+            self.assertEqual(retention.getarchivedb(memorybackend.MemoryBackend(storename)), ':memory:')
+        finally:
+            memorybackend.STORES.pop(storename, None)
+
+    def test_run(self):
+        """Delivered messages and finished chats move to the archive a
+        batch at a time, and everything else stays"""
+        retention.Archiver(self.storage, self.archivepath, 0, batchsize=2).run(pause=0)
+        self.assertEqual(self.storage._getchatinfo(self.finished), None)
+        for table in ('chat', 'localmessagequeue', 'remotemessagequeue'):
+            self.assertEqual(self.count(self.dbpath, table, self.finished), 0)
+        self.assertEqual(self.count(self.archivepath, 'chat', self.finished), 1)
+        self.assertEqual(self.count(self.archivepath, 'localmessagequeue', self.finished), 3)
+        self.assertEqual(self.count(self.archivepath, 'remotemessagequeue', self.finished), 4)
+        self.assertEqual(self.storage._getchatinfo(self.open).status, self.storage.STATUS_OPEN)
+        self.assertEqual(self.count(self.dbpath, 'localmessagequeue', self.open), 1)
+        self.assertEqual(self.count(self.dbpath, 'remotemessagequeue', self.open), 0)
+        self.assertEqual(self.count(self.archivepath, 'localmessagequeue', self.open), 3)
+        self.assertEqual(self.storage._countunsentlocalmessages(self.open), 1)
+        # Archived messages can still be read back
+        self.assertEqual([message for messageid, posttime, message in self.storage._getmessagessince(self.finished, 'localmessagequeue', 0, 100)],
+                         ['to joe 0', 'to joe 1', 'to joe 2'])
+
+    def test_steps(self):
+        """Each pass ends by returning False, and the next call starts
+        another"""
+        archiver = retention.Archiver(self.storage, self.archivepath, 0, batchsize=2)
+        steps = 1
+        while archiver.step():
+            steps += 1
+        # At least two batches of messages and one of chats
+        self.assertTrue(steps >= 3)
+        self.assertEqual(archiver.phase, None)
+        self.assertTrue(archiver.step())
+        self.assertNotEqual(archiver.phase, None)
+
+    def test_maxage(self):
+        """Nothing newer than maxage is archived"""
+        retention.Archiver(self.storage, self.archivepath, 3600).run(pause=0)
+        self.assertEqual(self.storage._getchatinfo(self.finished).status, self.storage.STATUS_CLOSED)
+        self.assertEqual(self.count(self.dbpath, 'localmessagequeue', self.finished), 3)
+        self.assertEqual(self.count(self.archivepath, 'chat', self.finished), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Tests for the outbox that paces messages to localusers:
+
+    $ cd seshat && python -m unittest test_sendqueue"""
+
+import time
+import unittest
+
+import sendqueue
+
+class OutboxTest(unittest.TestCase):
+    """Checks how an Outbox merges and paces messages"""
+
+    def test_burst(self):
+        """Up to burst stanzas go out at once, then the rest wait for
+        tokens"""
+        outbox = sendqueue.Outbox(rate=1, burst=2)
+        for number in range(3):
+            outbox.put('joe@example.com', 'message %d' % number)
+            self.assertEqual(len(outbox.get(timeout=0)), 1 if number < 2 else 0)
+        self.assertEqual(len(outbox), 1)
+        self.assertTrue(0 < outbox.nextready() <= 1)
+
+    def test_rate(self):
+        """A localuser out of tokens gets another after 1/rate
+        seconds, and other localusers aren't held up"""
+        outbox = sendqueue.Outbox(rate=20, burst=1)
+        outbox.put('joe@example.com', 'one')
+        outbox.get(timeout=0)
+        outbox.put('joe@example.com', 'two')
+        outbox.put('amy@example.com', 'three')
+        self.assertEqual(outbox.get(timeout=0), [('amy@example.com', ['three'], [])])
+        starttime = time.time()
+        self.assertEqual(outbox.get(timeout=5), [('joe@example.com', ['two'], [])])
+        self.assertTrue(time.time() - starttime >= 0.04)
+        self.assertEqual(outbox.nextready(), None)
+
+    def test_unlimited(self):
+        """A rate of 0 sends everything right away"""
+        outbox = sendqueue.Outbox(rate=0, burst=0)
+        outbox.put('joe@example.com', 'one')
+        self.assertEqual(outbox.get(timeout=0), [('joe@example.com', ['one'], [])])
+        outbox.put('joe@example.com', 'two')
+        self.assertEqual(outbox.get(timeout=0), [('joe@example.com', ['two'], [])])
+
+    def test_coalesce(self):
+        """Messages queued while a localuser waits go out as one
+        stanza, with their messageids"""
+        outbox = sendqueue.Outbox(rate=20, coalesce=0.05)
+        outbox.put('joe@example.com', 'one', 1)
+        outbox.put('joe@example.com', 'two')
+        outbox.put('joe@example.com', 'three', 3)
+        self.assertEqual(outbox.get(timeout=0), [])
+        self.assertEqual(outbox.get(timeout=5), [('joe@example.com', ['one', 'two', 'three'], [1, 3])])
+        self.assertEqual(len(outbox), 0)
+
+    def test_maxlength(self):
+        """Merged stanzas don't grow past MAXLENGTH"""
+        outbox = sendqueue.Outbox(rate=0, coalesce=5)
+        message = 'x' * (sendqueue.MAXLENGTH // 2)
+        for number in range(3):
+            outbox.put('joe@example.com', message, number)
+        self.assertEqual([len(batch[1]) for batch in outbox.pending['joe@example.com']], [1, 1, 1])
+        outbox = sendqueue.Outbox(rate=0, coalesce=5)
+        for number in range(3):
+            outbox.put('joe@example.com', 'x' * (sendqueue.MAXLENGTH // 3 - 1), number)
+        self.assertEqual([batch[3] for batch in outbox.pending['joe@example.com']], [[0, 1, 2]])
+
+    def test_fromsettings(self):
+        """Settings configure the outbox"""
+        outbox = sendqueue.fromsettings({'seshat_sendrate': '2', 'sendburst': '3', 'sendcoalesce': '0.5'})
+        self.assertEqual((outbox.rate, outbox.burst, outbox.coalesce), (2, 3, 0.5))
+
+if __name__ == '__main__':
+    unittest.main()
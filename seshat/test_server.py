@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Tests for the broker bots, run against a fake Jabber server:
+
+    $ cd seshat && python -m unittest test_server"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import client
+import fakexmpp
+import memorybackend
+import server
+import sqlitebackend
+import threadedserver
+
+class StopServer(Exception):
+    """Raised to end SeshatServer.run after a set number of passes"""
+
+class SeshatServerTest(unittest.TestCase):
+    """Drives a SeshatServer through its main loop, playing both the
+    localusers and the visitors"""
+
+    def setUp(self):
+        """Start a broker bot with one localuser, who is online"""
+        storename = self.id()
+        self.fakeclient = fakexmpp.FakeClient()
+        self.server = server.SeshatServer('bot@example.com', 'password', ['joe@example.com'], memorybackend.MemoryBackend(storename),
+                                          xmppclient=self.fakeclient)
+        self.client = client.SeshatClient(memorybackend.MemoryBackend(storename))
+        self.fakeclient.presence('joe@example.com/desk')
+        self.runpasses()
+
+    def tearDown(self):
+        """Stop listening for notifications"""
+        if self.server.listener is not None:
+            self.server.listener.close()
+
+    def runpasses(self, passes=2):
+        """Run the broker bot's main loop for the given number of
+        passes, handling incoming stanzas without waiting for more"""
+        remaining = [passes]
+        waitforevents = self.server._waitforevents
+        def countpass(timeout):
+            result = waitforevents(0)
+            remaining[0] -= 1
+            if not remaining[0]:
+                raise StopServer()
+            return result
+        self.server._waitforevents = countpass
+        try:
+            self.server.run()
+        except StopServer:
+            pass
+        finally:
+            self.server._waitforevents = waitforevents
+
+    def test_visitorendingchatfreeslocaluser(self):
+        """A chat closed by its visitor frees its localuser for the
+        next one"""
+        chatid = self.client.startchat('visitor', 'hello')
+        self.runpasses()
+        self.fakeclient.message('joe@example.com/desk', '!ACCEPT %d' % chatid)
+        self.runpasses()
+        self.assertEqual(self.client.getavailability(maxage=0).availablelocalusers, 0)
+        self.client.endchat(chatid)
+        self.runpasses()
+        self.assertEqual(self.client.getavailability(maxage=0).availablelocalusers, 1)
+        self.assertTrue(self.client.isavailable())
+
+    def test_presence(self):
+        """A localuser is online while any of their resources is, and
+        only localusers are tracked"""
+        self.assertEqual(self.server.onlineusers, frozenset(['joe@example.com']))
+        self.fakeclient.presence('joe@example.com/laptop')
+        self.fakeclient.presence('joe@example.com/desk', typ='unavailable')
+        self.fakeclient.presence('stranger@example.com/home')
+        self.runpasses()
+        self.assertEqual(self.server.onlineusers, frozenset(['joe@example.com']))
+        self.fakeclient.presence('joe@example.com/laptop', show='away')
+        self.runpasses()
+        self.assertEqual(self.server.onlineusers, frozenset())
+        self.assertEqual(self.server._getavailablelocalusers(), [])
+
+    def test_presencebatched(self):
+        """Online statuses that change quickly are written together,
+        leaving out any that changed back"""
+        written = []
+        setonlinestatuses = self.server.backend._setonlinestatuses
+        def recordwrites(statuses, workerid):
+            written.append(list(statuses))
+            return setonlinestatuses(statuses, workerid)
+        self.server.backend._setonlinestatuses = recordwrites
+        self.server.nextpresencetime = time.time() + 60
+        self.fakeclient.presence('joe@example.com/laptop')
+        self.fakeclient.presence('joe@example.com/desk', show='away')
+        self.fakeclient.presence('joe@example.com/desk')
+        self.fakeclient.presence('joe@example.com/phone', show='away')
+        self.runpasses()
+        self.assertEqual(written, [])
+        self.server.nextpresencetime = 0
+        self.runpasses()
+        self.assertEqual(written, [[('joe@example.com', 'laptop', True)]])
+        self.assertEqual(self.server.pendingpresence, {})
+
+    def test_busylocaluser(self):
+        """A localuser in a chat isn't available until they finish
+        it"""
+        self.assertEqual(self.server._getavailablelocalusers(), ['joe@example.com'])
+        chatid = self.client.startchat('visitor', 'hello')
+        self.runpasses()
+        self.fakeclient.message('joe@example.com/desk', '!ACCEPT %d' % chatid)
+        self.runpasses()
+        self.assertEqual(self.server._getavailablelocalusers(), [])
+        self.fakeclient.message('joe@example.com/desk', '!FINISH')
+        self.runpasses()
+        self.assertEqual(self.server._getavailablelocalusers(), ['joe@example.com'])
+
+    def test_stats(self):
+        """!STATS summarizes the queues, chats, and timings"""
+        chatid = self.client.startchat('visitor', 'hello')
+        self.runpasses()
+        self.fakeclient.message('joe@example.com/desk', '!STATS')
+        self.runpasses()
+        stats = self.fakeclient.sentto('joe@example.com')[-1].split('\n')
+        self.assertTrue('Chats: 0 waiting, 1 offered, 0 open' in stats)
+        self.assertTrue('Localusers online: 1' in stats)
+        self.assertTrue([line for line in stats if line.startswith('Main loop: ')])
+        self.assertTrue([line for line in stats if line.startswith('Slowest backend calls: ')])
+        self.assertEqual(self.server.backend._getchatinfo(chatid).status, self.client.STATUS_NOTIFIED)
+
+    def test_queuedmessagesdelivered(self):
+        """Queued visitor messages are delivered in order, marked sent
+        together, and never delivered again"""
+        chatid = self.client.startchat('visitor', 'hello')
+        self.runpasses()
+        self.fakeclient.message('joe@example.com/desk', '!ACCEPT %d' % chatid)
+        self.runpasses()
+        sent = ['message %d' % number for number in range(5)]
+        for message in sent:
+            self.client.sendmessage(chatid, 'visitor', message)
+        marked = []
+        markmessagessent = self.server.backend._markmessagessent
+        def recordmarks(messageids):
+            marked.append(list(messageids))
+            return markmessagessent(messageids)
+        self.server.backend._markmessagessent = recordmarks
+        self.runpasses(4)
+        def received():
+            return [line for body in self.fakeclient.sentto('joe@example.com') for line in body.split('\n') if line.startswith('message ')]
+        self.assertEqual(received(), sent)
+        self.assertEqual(len(marked), 1)
+        self.assertEqual(len(marked[0]), len(sent))
+        self.assertEqual(self.server.backend._countunsentlocalmessages(chatid), 0)
+        self.assertEqual(self.server.outgoing, {})
+        self.runpasses(4)
+        self.assertEqual(received(), sent)
+
+class ThreadedSeshatServerTest(unittest.TestCase):
+    """Drives a ThreadedSeshatServer on a SQLite database from a
+    background thread"""
+
+    def setUp(self):
+        """Start a threaded broker bot with one localuser, who is
+        online"""
+        self.tempdir = tempfile.mkdtemp()
+        dbpath = os.path.join(self.tempdir, 'seshat.db')
+        self.fakeclient = fakexmpp.FakeClient()
+        self.server = threadedserver.ThreadedSeshatServer('bot@example.com', 'password', ['joe@example.com'],
+                                                          lambda: sqlitebackend.SqliteBackend(dbpath), xmppclient=self.fakeclient)
+        self.client = client.SeshatClient(sqlitebackend.SqliteBackend(dbpath))
+        self.stopping = False
+        waitforevents = self.server._waitforevents
+        def stoppable(timeout):
+            if self.stopping:
+                raise StopServer()
+            return waitforevents(min(timeout, 0.1))
+        self.server._waitforevents = stoppable
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.fakeclient.presence('joe@example.com/desk')
+
+    def tearDown(self):
+        """Stop the thread calling run, and remove the database"""
+        self.stopping = True
+        self.thread.join(5)
+        if self.server.listener is not None:
+            self.server.listener.close()
+        shutil.rmtree(self.tempdir)
+
+    def _run(self):
+        """Run the broker bot until the test is over"""
+        try:
+            self.server.run()
+        except StopServer:
+            pass
+
+    def waitfor(self, condition, timeout=5):
+        """Wait up to timeout seconds for condition() to be true.
+        Return True if it was."""
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def test_messagesdeliveredonce(self):
+        """Each visitor message reaches the localuser exactly once,
+        however the sender and the thread calling run interleave"""
+        chatid = self.client.startchat('visitor', 'hello')
+        self.assertTrue(self.waitfor(lambda: any('!ACCEPT %d' % chatid in body for body in self.fakeclient.sentto('joe@example.com'))))
+        self.fakeclient.message('joe@example.com/desk', '!ACCEPT %d' % chatid)
+        self.assertTrue(self.waitfor(lambda: self.client.backend._getchatinfo(chatid).status == self.client.STATUS_OPEN))
+        sent = ['message %d' % number for number in range(20)]
+        for message in sent:
+            self.client.sendmessage(chatid, 'visitor', message)
+        def received():
+            return [line for body in self.fakeclient.sentto('joe@example.com') for line in body.split('\n') if line.startswith('message ')]
+        self.assertTrue(self.waitfor(lambda: len(received()) >= len(sent)))
+        # Give any duplicates time to arrive
+        time.sleep(1)
+        self.assertEqual(received(), sent)
+
+if __name__ == '__main__':
+    unittest.main()
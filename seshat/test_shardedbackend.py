@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Tests for the sharded SQLite backend:
+
+    $ cd seshat && python -m unittest test_shardedbackend"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import shardedbackend
+import sqlitebackend
+
+class ShardedBackendTest(unittest.TestCase):
+    """Runs a ShardedBackend with three shards in a temporary
+    directory"""
+
+    def setUp(self):
+        """Create the databases"""
+        self.tempdir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tempdir, 'seshat.db')
+        self.storage = shardedbackend.ShardedBackend(self.dbpath, shards=3)
+
+    def tearDown(self):
+        """Remove the databases"""
+        self.storage._close()
+        shutil.rmtree(self.tempdir)
+
+    def gettables(self, dbpath):
+        """Return the names of the tables in a database"""
+        dbconn = sqlite3.connect(dbpath)
+        try:
+            return set(row[0] for row in dbconn.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        finally:
+            dbconn.close()
+
+    def forgetchecks(self):
+        """Have the directory's schema and sharding checked again, as
+        a new process would"""
+        sqlitebackend.CHECKEDDATABASES.discard(os.path.abspath(self.dbpath))
+        shardedbackend.CHECKEDDIRECTORIES.discard(os.path.abspath(self.dbpath))
+
+    def test_schemas(self):
+        """The directory only has the tables it uses, and the shards
+        have the chats and queues"""
+        directorytables = self.gettables(self.dbpath)
+        self.assertEqual(directorytables, set(['chatdirectory', 'sharding', 'onlinestatus', 'availability', 'dbversion']))
+        self.assertTrue('chat' in self.gettables(shardedbackend.SHARDPATH % (self.dbpath, 0)))
+
+    def test_olddirectory(self):
+        """A directory made with the whole SQLite schema loses the
+        tables it never used"""
+        self.storage._close()
+        shutil.rmtree(self.tempdir)
+        os.mkdir(self.tempdir)
+        olddirectory = sqlitebackend.SqliteBackend(self.dbpath)
+        olddirectory._close()
+        self.forgetchecks()
+        self.storage = shardedbackend.ShardedBackend(self.dbpath, shards=3)
+        self.assertFalse('chat' in self.gettables(self.dbpath))
+        self.assertTrue('chatdirectory' in self.gettables(self.dbpath))
+        self.assertEqual(self.storage.directory._getdbversion(), shardedbackend.DIRECTORYVERSION)
+
+    def test_shardcount(self):
+        """The number of shards can't change once they're created"""
+        self.forgetchecks()
+        self.assertRaises(ValueError, shardedbackend.ShardedBackend, self.dbpath, shards=2)
+
+    def test_chatsacrossshards(self):
+        """Chats are spread across the shards, and each is found in
+        its own"""
+        chatids = [self.storage._openchat('visitor%d' % number, 'hello') for number in range(6)]
+        self.assertEqual(chatids, range(1, 7))
+        self.assertEqual(sorted(set(self.storage._getshard(chatid).location for chatid in chatids)),
+                         sorted(shard.location for shard in self.storage.shards))
+        for number, chatid in enumerate(chatids):
+            self.assertEqual(self.storage._getchatinfo(chatid).remoteuser, 'visitor%d' % number)
+        self.assertEqual([chat.chatid for chat in self.storage._getchatswithstatus(self.storage.STATUS_WAITING)], chatids)
+
+    def test_messageids(self):
+        """Messageids name their shard and increase within each chat"""
+        for shardnumber in range(3):
+            for messageid in (1, 2, 1000):
+                self.assertEqual(self.storage._decodemessageid(self.storage._encodemessageid(shardnumber, messageid)), (shardnumber, messageid))
+        chatids = [self.storage._openchat('visitor') for number in range(3)]
+        for chatid in chatids:
+            for number in range(3):
+                self.storage._queueremote(chatid, 'message %d' % number)
+        for chatid in chatids:
+            messages = self.storage._getremotemessagessince(chatid, 0)
+            messageids = [messageid for messageid, message in messages]
+            self.assertEqual(messageids, sorted(messageids))
+            self.assertEqual(self.storage._getremotemessagessince(chatid, messageids[1]), messages[2:])
+
+    def test_markmessagessent(self):
+        """Claimed local messages from every shard can be marked sent
+        at once"""
+        chatids = [self.storage._openchat('visitor') for number in range(3)]
+        for chatid in chatids:
+            self.storage._acceptchat(chatid, 'joe@example.com')
+            self.storage._queuelocal(chatid, 'hi')
+        messages = self.storage._claimqueuedlocalmessages('worker', 60)
+        self.assertEqual(sorted(message.chatid for message in messages), chatids)
+        self.storage._markmessagessent([message.messageid for message in messages])
+        self.assertEqual([self.storage._countunsentlocalmessages(chatid) for chatid in chatids], [0, 0, 0])
+
+    def test_rollback(self):
+        """A transaction that raises leaves every shard it touched
+        unchanged"""
+        chatids = [self.storage._openchat('visitor') for number in range(2)]
+        try:
+            with self.storage.transaction():
+                for chatid in chatids:
+                    self.storage._acceptchat(chatid, 'joe@example.com')
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual([self.storage._getchatinfo(chatid).status for chatid in chatids], [self.storage.STATUS_WAITING] * 2)
+
+    def test_archivechats(self):
+        """Archiving chats removes their chatids from the directory,
+        except the newest, so that it's never handed out again"""
+        self.storage._attacharchive(os.path.join(self.tempdir, 'seshat.archive'))
+        chatids = [self.storage._openchat('visitor') for number in range(4)]
+        for chatid in chatids:
+            self.storage._closechat(chatid, self.storage.STATUS_CLOSED)
+        self.assertEqual(self.storage._archivechats(time.time() + 60, 10), 4)
+        self.assertEqual([row[0] for row in self.storage.directory.dbconn.execute("SELECT chatid FROM chatdirectory")], [4])
+        self.assertEqual(self.storage._openchat('visitor'), 5)
+        self.assertEqual([chat.chatid for chat in self.storage._getchatssince(0, 10)], range(1, 6))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Tests for the SQLite backend:
+
+    $ cd seshat && python -m unittest test_sqlitebackend"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import sqlitebackend
+
+class SqliteBackendTest(unittest.TestCase):
+    """Runs a SqliteBackend on a database in a temporary directory"""
+
+    def setUp(self):
+        """Pick a path for the database"""
+        self.tempdir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tempdir, 'seshat.db')
+
+    def tearDown(self):
+        """Remove the database"""
+        shutil.rmtree(self.tempdir)
+
+    def open(self, backendclass=sqlitebackend.SqliteBackend, **options):
+        """Return a backend for the database, checking its schema as a
+        new process would"""
+        sqlitebackend.CHECKEDDATABASES.discard(os.path.abspath(self.dbpath))
+        return backendclass(self.dbpath, **options)
+
+    def createversion1(self):
+        """Create a version 1 database, as the first release of Seshat
+        did, with a chat and a message in each queue"""
+        dbconn = sqlite3.connect(self.dbpath)
+        for query in sqlitebackend.CREATEQUERIES:
+            dbconn.execute(query)
+        dbconn.execute("INSERT INTO chat (chatid, localuser, remoteuser, starttime, status, startmessage) VALUES (1, 'joe@example.com', 'visitor', 1, 2, 'hello')")
+        dbconn.execute("INSERT INTO localmessagequeue (posttime, chatid, message) VALUES (1, 1, 'to joe')")
+        dbconn.execute("INSERT INTO remotemessagequeue (posttime, chatid, message) VALUES (1, 1, 'to visitor')")
+        dbconn.commit()
+        dbconn.close()
+
+    def getindexes(self, storage):
+        """Return the names of the database's indexes"""
+        return set(row[0] for row in storage.dbconn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"))
+
+    def test_newdatabase(self):
+        """A new database is created at the current version"""
+        storage = self.open()
+        self.assertEqual(storage._getdbversion(), sqlitebackend.CURRENTDBVERSION)
+
+    def test_migrations(self):
+        """An old database is upgraded in place, keeping its chats and
+        messages"""
+        self.createversion1()
+        storage = self.open()
+        self.assertEqual(storage._getdbversion(), sqlitebackend.CURRENTDBVERSION)
+        self.assertTrue(set(['localmessagequeue_unsent', 'remotemessagequeue_chatid_messageid', 'chat_status', 'chat_starttime']) <= self.getindexes(storage))
+        self.assertEqual(storage._getchatinfo(1).remoteuser, 'visitor')
+        self.assertEqual([message.message for message in storage._claimqueuedlocalmessages('worker', 60)], ['to joe'])
+        self.assertEqual(storage._getallqueuedremotemessages(1), ['to visitor'])
+
+    def test_failedmigration(self):
+        """A migration that fails leaves the database at the last
+        version that succeeded"""
+        class BrokenBackend(sqlitebackend.SqliteBackend):
+            MIGRATIONS = dict(sqlitebackend.MIGRATIONS)
+            MIGRATIONS[3] = ["CREATE INDEX nonsense ON nosuchtable (nosuchcolumn)"]
+        self.createversion1()
+        self.assertRaises(sqlite3.OperationalError, self.open, BrokenBackend)
+        dbconn = sqlite3.connect(self.dbpath)
+        self.assertEqual(dbconn.execute("SELECT version FROM dbversion").fetchone()[0], 2)
+        dbconn.close()
+        storage = self.open()
+        self.assertEqual(storage._getdbversion(), sqlitebackend.CURRENTDBVERSION)
+
+    def test_migrationsarecomplete(self):
+        """There's a migration for every version"""
+        self.assertEqual(sorted(sqlitebackend.MIGRATIONS), range(2, sqlitebackend.CURRENTDBVERSION + 1))
+
+    def test_idlepollwithoutlock(self):
+        """Polling for new messages when there aren't any doesn't wait
+        on another connection's write lock"""
+        storage = self.open()
+        chatid = storage._openchat('visitor')
+        messageid = storage._getremotemessagessince(chatid, 0)[-1][0]
+        reader = self.open(pragmas={'busy_timeout': 0})
+        writer = sqlite3.connect(self.dbpath, timeout=0)
+        writer.execute("BEGIN IMMEDIATE TRANSACTION")
+        try:
+            self.assertEqual(reader._getremotemessagessince(chatid, messageid), [])
+        finally:
+            writer.rollback()
+            writer.close()
+
+    def test_pragmas(self):
+        """PRAGMA settings are read from the configuration and applied
+        to every connection"""
+        settings = {'seshat_journal_mode': 'wal', 'synchronous': 'NORMAL', 'busy_timeout': '2500', 'sqlitedb': self.dbpath}
+        self.assertEqual(sqlitebackend.getpragmas(settings), {'journal_mode': 'wal', 'synchronous': 'NORMAL', 'busy_timeout': '2500'})
+        sqlitebackend.CHECKEDDATABASES.discard(os.path.abspath(self.dbpath))
+        for storage in (sqlitebackend.SqliteBackend.fromsettings(settings), sqlitebackend.SqliteBackend.fromsettings(settings)):
+            self.assertEqual(storage.dbconn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+            self.assertEqual(storage.dbconn.execute("PRAGMA synchronous").fetchone()[0], 1)
+            self.assertEqual(storage.dbconn.execute("PRAGMA busy_timeout").fetchone()[0], 2500)
+
+    def test_badpragmas(self):
+        """Unknown settings and values are rejected"""
+        self.assertRaises(ValueError, self.open, pragmas={'journal_mode': 'sideways'})
+        self.assertRaises(ValueError, self.open, pragmas={'busy_timeout': 'soon'})
+        self.assertRaises(ValueError, self.open, pragmas={'locking_mode': 'EXCLUSIVE'})
+
+    def test_transactions(self):
+        """Nested transactions only commit with the outermost one, and
+        an exception anywhere inside rolls them all back"""
+        storage = self.open()
+        other = self.open()
+        chatid = storage._openchat('visitor')
+        with storage.transaction():
+            storage._acceptchat(chatid, 'joe@example.com')
+            with storage.transaction():
+                storage._queuelocal(chatid, 'hi')
+            self.assertEqual(other._countunsentlocalmessages(chatid), 0)
+        self.assertEqual(other._countunsentlocalmessages(chatid), 1)
+        try:
+            with storage.transaction():
+                storage._closechat(chatid, storage.STATUS_CLOSED)
+                with storage.transaction():
+                    storage._queuelocal(chatid, 'bye')
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(other._getchatinfo(chatid).status, storage.STATUS_OPEN)
+        self.assertEqual(other._countunsentlocalmessages(chatid), 1)
+
+    def test_immediatetransaction(self):
+        """An immediate transaction locks out other writers from its
+        start"""
+        storage = self.open()
+        other = self.open(pragmas={'busy_timeout': 0})
+        with storage.transaction(immediate=True):
+            self.assertRaises(sqlite3.OperationalError, other._openchat, 'visitor')
+        self.assertEqual(other._openchat('visitor'), 1)
+
+    def test_chatclaims(self):
+        """A waiting chat is claimed by one worker at a time until its
+        claim is released or expires"""
+        first, second = self.open(), self.open()
+        chatid = first._openchat('visitor', 'hello')
+        self.assertEqual([chat.chatid for chat in first._claimchatswithstatus(first.STATUS_WAITING, 'first', 60)], [chatid])
+        self.assertEqual(second._claimchatswithstatus(first.STATUS_WAITING, 'second', 60), [])
+        # Claiming again renews the worker's own claim
+        self.assertEqual([chat.chatid for chat in first._claimchatswithstatus(first.STATUS_WAITING, 'first', 60)], [chatid])
+        first._releasechats([chatid], 'second')
+        self.assertEqual(second._claimchatswithstatus(first.STATUS_WAITING, 'second', 60), [])
+        first._releasechats([chatid], 'first')
+        self.assertEqual([chat.chatid for chat in second._claimchatswithstatus(first.STATUS_WAITING, 'second', -1)], [chatid])
+        # The second worker's claim has already expired
+        self.assertEqual([chat.chatid for chat in first._claimchatswithstatus(first.STATUS_WAITING, 'first', 60)], [chatid])
+
+    def test_messageclaims(self):
+        """A chat's queued messages are claimed along with the chat,
+        and only taken over by another worker once the claim
+        expires"""
+        first, second = self.open(), self.open()
+        chatid = first._openchat('visitor', 'hello')
+        first._acceptchat(chatid, 'joe@example.com')
+        first._queuelocal(chatid, 'message')
+        self.assertEqual([message.message for message in first._claimqueuedlocalmessages('first', -1)], ['message'])
+        self.assertEqual([message.message for message in second._claimqueuedlocalmessages('second', 60)], ['message'])
+        self.assertEqual(first._claimqueuedlocalmessages('first', 60), [])
+        second._markmessagessent([message.messageid for message in second._claimqueuedlocalmessages('second', 60)])
+        second._releasechats([chatid], 'second')
+        self.assertEqual(first._claimqueuedlocalmessages('first', 60), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Tests for reading back and exporting transcripts:
+
+    $ cd seshat && python -m unittest test_transcript"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import retention
+import sqlitebackend
+import transcript
+
+class TranscriptTest(unittest.TestCase):
+    """Reads chats from a SQLite database in a temporary directory,
+    some of them partly archived"""
+
+    def setUp(self):
+        """Create three chats started a day apart, each with messages
+        going both ways"""
+        self.tempdir = tempfile.mkdtemp()
+        dbpath = os.path.join(self.tempdir, 'seshat.db')
+        sqlitebackend.CHECKEDDATABASES.discard(dbpath)
+        self.storage = sqlitebackend.SqliteBackend(dbpath)
+        self.chatids = [self.startchat(86400 * day) for day in range(1, 4)]
+
+    def tearDown(self):
+        """Remove the databases"""
+        self.storage._close()
+        shutil.rmtree(self.tempdir)
+
+    def startchat(self, starttime):
+        """Start a chat at starttime, in which the visitor and joe take
+        turns saying two things each. Return its chatid."""
+        chatid = self.storage._openchat('visitor', 'hello')
+        self.storage._acceptchat(chatid, 'joe@example.com')
+        # Leave out any greetings, which were posted now
+        self.storage.dbconn.execute("DELETE FROM remotemessagequeue WHERE chatid = ?", (chatid,))
+        self.storage.dbconn.execute("UPDATE chat SET starttime = ? WHERE chatid = ?", (starttime, chatid))
+        for number in range(4):
+            queue = 'localmessagequeue' if number % 2 == 0 else 'remotemessagequeue'
+            self.storage.dbconn.execute("INSERT INTO %s (posttime, chatid, message) VALUES (?, ?, ?)" % queue,
+                                        (starttime + number, chatid, 'line %d' % number))
+        self.storage.dbconn.commit()
+        return chatid
+
+    def test_getpage(self):
+        """Pages follow on from each other in the order the messages
+        were posted, naming who said what"""
+        chat = transcript.gettranscript(self.storage, self.chatids[0], pagesize=3)
+        messages, after = chat.getpage()
+        self.assertEqual([message.message for message in messages], ['line 0', 'line 1', 'line 2'])
+        self.assertEqual([(message.sender, message.recipient) for message in messages[:2]],
+                         [('visitor', 'joe@example.com'), ('joe@example.com', 'visitor')])
+        messages, after = chat.getpage(after)
+        self.assertEqual([message.message for message in messages], ['line 3'])
+        self.assertEqual(chat.getpage(after)[0], [])
+        self.assertEqual([message.message for message in chat.getpage(None, 1)[0]], ['line 0'])
+
+    def test_archived(self):
+        """Archived messages and chats are read along with live ones"""
+        self.storage.dbconn.execute("UPDATE localmessagequeue SET sendtime = 1")
+        self.storage.dbconn.commit()
+        self.storage._closechat(self.chatids[0], self.storage.STATUS_CLOSED)
+        self.storage.dbconn.execute("UPDATE chat SET endtime = 1 WHERE chatid = ?", (self.chatids[0],))
+        self.storage.dbconn.commit()
+        retention.Archiver(self.storage, retention.getarchivedb(self.storage), 0).run(pause=0)
+        self.assertEqual(self.storage._getchatinfo(self.chatids[0]), None)
+        for chatid in self.chatids[:2]:
+            chat = transcript.gettranscript(self.storage, chatid, pagesize=1)
+            self.assertEqual([message.message for message in chat], ['line 0', 'line 1', 'line 2', 'line 3'])
+        self.assertEqual([chat.chatid for chat in transcript.iterchats(self.storage, pagesize=1)], self.chatids)
+
+    def test_gettranscript(self):
+        """Chats that don't exist have no transcript"""
+        self.assertEqual(transcript.gettranscript(self.storage, self.chatids[-1] + 1), None)
+
+    def test_iterchats(self):
+        """Chats are read in order, a page at a time, limited to those
+        started in a range of times"""
+        self.assertEqual([chat.chatid for chat in transcript.iterchats(self.storage, pagesize=2)], self.chatids)
+        self.assertEqual([chat.chatid for chat in transcript.iterchats(self.storage, 86400 * 2, 86400 * 3, pagesize=1)], self.chatids[1:2])
+        self.assertEqual([chat.chatid for chat in transcript.iterchats(self.storage, startedafter=86400 * 2)], self.chatids[1:])
+
+    def test_export(self):
+        """Chats are exported as JSON lines or CSV with a header"""
+        lines = list(transcript.export(self.storage, startedbefore=86400 * 2, pagesize=3))
+        self.assertEqual([json.loads(line)['message'] for line in lines], ['line 0', 'line 1', 'line 2', 'line 3'])
+        self.assertEqual(json.loads(lines[1])['sender'], 'joe@example.com')
+        lines = list(transcript.export(self.storage, 'csv', startedafter=86400 * 3))
+        self.assertEqual(lines[0], 'chatid,messageid,posttime,sender,recipient,message\r\n')
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[1].endswith(',visitor,joe@example.com,line 0\r\n'))
+        self.assertRaises(ValueError, list, transcript.export(self.storage, 'xml'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright 2011 Daycos
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""A broker bot that does its work in several threads
+
+SeshatServer does everything in one thread, so a slow send to the
+Jabber server, a database stall, or the wait before reconnecting holds
+up every chat. ThreadedSeshatServer runs the same command handlers but
+splits the work up:
+
+* A receiver thread reads stanzas from the Jabber connection and
+  reconnects when it's lost.
+* A pool of worker threads handles incoming messages and presence
+  updates. Each localuser's stanzas always go to the same worker so
+  they're handled in the order they arrived.
+* A sender thread delivers outgoing messages as the outbox releases
+  them (see: seshat.sendqueue).
+* The thread calling run looks for waiting chats and queued messages,
+  and archives old ones.
+
+Each thread gets its own backend connection. Choose this engine with
+the "engine = threaded" setting (see: server.main)."""
+
+from __future__ import with_statement
+
+import logging
+import Queue
+import select
+import threading
+import time
+
+import metrics
+import notify
+import server
+
+MODULELOG = logging.getLogger(__name__)
+
+# The number of threads handling incoming stanzas if the "workers"
+# setting isn't given
+DEFAULTWORKERS = 4
+
+# How long (in seconds) to wait before reconnecting to the Jabber
+# server
+RECONNECTDELAY = 20
+
+class ThreadedSeshatServer(server.SeshatServer):
+    """A SeshatServer that handles incoming stanzas, outgoing
+    messages, and queued work in separate threads"""
+
+    def __init__(self, username, password, localusers, backendfactory, workers=DEFAULTWORKERS, **options):
+        """Prepare the broker bot like SeshatServer, except that
+        backendfactory is a function returning a new Backend, which is
+        called once by each thread. The bot must be run by the thread
+        that created it. See: server.SeshatServer.__init__.__doc__"""
+        self.backendfactory = backendfactory
+        self.threadstate = threading.local()
+        self.workqueues = [Queue.Queue() for worker in range(int(workers))]
+        super(ThreadedSeshatServer, self).__init__(username, password, localusers, backendfactory(), **options)
+        # Lets workers wake the thread calling run
+        self.notifier = notify.Notifier(self.listener.path if self.listener is not None else None)
+
+    def _getbackend(self):
+        """Return this thread's Backend, creating it if necessary"""
+        try:
+            return self.threadstate.backend
+        except AttributeError:
+            self.threadstate.backend = metrics.InstrumentedBackend(self.backendfactory(), self.metrics)
+            return self.threadstate.backend
+
+    def _setbackend(self, value):
+        """Set this thread's Backend"""
+        self.threadstate.backend = value
+
+    backend = property(_getbackend, _setbackend)
+
+    def run(self):
+        """Start the receiver, sender, and worker threads, then look
+        for queued work until an error occurs"""
+        threads = [threading.Thread(target=self._receive, name='seshat-receiver'),
+                   threading.Thread(target=self._sendqueuedmessages, name='seshat-sender')]
+        for worker, workqueue in enumerate(self.workqueues):
+            threads.append(threading.Thread(target=self._work, args=(workqueue,), name='seshat-worker-%d' % worker))
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        super(ThreadedSeshatServer, self).run()
+
+
+    #### Internal methods
+
+    def _flushoutbox(self):
+        """Do nothing, as the sender thread sends messages as soon as
+        the outbox releases them"""
+        pass
+
+    def _receive(self):
+        """Hand incoming stanzas to their handlers, reconnecting to the
+        Jabber server whenever the connection is lost"""
+        while True:
+            if self.client.Process(1) == 0:
+                self.connected.clear()
+                MODULELOG.info("Disconnected from the server. Reconnecting soon.")
+                time.sleep(RECONNECTDELAY)
+                try:
+                    self._connect()
+                except Exception:
+                    MODULELOG.exception("Unable to reconnect to the server")
+
+    def _savepresencelater(self, con, presence):
+        """Update a localuser's online status, then wake the thread
+        calling run so that it publishes the new availability and
+        writes the status in time if it couldn't be written yet"""
+        super(ThreadedSeshatServer, self)._presencehandler(con, presence)
+        self.notifier.notify()
+
+    def _sendqueuedmessages(self):
+        """Send messages as the outbox releases them, waiting for the
+        bot to reconnect before each one whenever it's disconnected"""
+        while True:
+            for localuser, messages, messageids in self.outbox.get():
+                self.connected.wait()
+                try:
+                    self._sendbatch(localuser, messages, messageids)
+                except Exception:
+                    MODULELOG.exception("Unable to send a message to %s" % localuser)
+
+    def _submit(self, localuser, function, *args):
+        """Have the worker responsible for the localuser call
+        function(*args)"""
+        self.workqueues[hash(localuser) % len(self.workqueues)].put((function, args))
+
+    def _waitforevents(self, timeout):
+        """Sleep until a client queues work or timeout seconds pass.
+        The receiver thread handles the Jabber connection, so this
+        always returns True."""
+        # Online statuses that change before nextpresencetime are
+        # written then
+        presencedelay = self.nextpresencetime - time.time()
+        if presencedelay > 0:
+            timeout = min(timeout, presencedelay)
+        if self.listener is None:
+            time.sleep(min(timeout, 1))
+        else:
+            select.select([self.listener], [], [], timeout)
+            self.listener.drain()
+        return True
+
+    def _work(self, workqueue):
+        """Call the functions submitted to the workqueue, one at a
+        time"""
+        while True:
+            function, args = workqueue.get()
+            try:
+                function(*args)
+            except Exception:
+                MODULELOG.exception("Error while calling %s" % function)
+                self.backend._abort()
+
+
+    #### Event handlers
+
+    def _messagehandler(self, con, event):
+        """Have a worker handle an incoming message"""
+        self._submit(event.getFrom().getStripped(), super(ThreadedSeshatServer, self)._messagehandler, con, event)
+
+    def _presencehandler(self, con, presence):
+        """Have a worker update a localuser's online status"""
+        self._submit(presence.getFrom().getStripped(), self._savepresencelater, con, presence)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# pylint: disable=C0301
+
+# Copyright (c) 2011, Daycos
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#     * Neither the name of Daycos nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL
+# <COPYRIGHT HOLDER> BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+"""Reads back the messages exchanged in chats
+
+A chat's messages are kept in two queues, one for each direction, and
+may have been moved to the archive (see: retention). A Transcript reads
+them back in the order they were posted, a page at a time. Each page is
+one short indexed query per queue that picks up after the last
+messageid seen in that queue, so reading months of transcripts never
+holds a lock for long or gets slower further in.
+
+Many chats can be exported as JSON lines or CSV, read a page at a time
+and produced a line at a time, in constant memory:
+
+    $ ./transcript.py sample.ini Seshat --since 2011-06-01 --format csv
+
+Messages from Seshat itself, such as "The chat is now closed.", are
+stored alongside the participants' and can't be told apart from
+them."""
+
+from __future__ import with_statement
+
+import calendar
+import cStringIO
+import csv
+import logging
+import optparse
+import sys
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import backend
+import retention
+
+MODULELOG = logging.getLogger(__name__)
+
+# How many chats or messages to read per query
+PAGESIZE = 500
+
+# The formats export can write
+FORMATS = ('jsonl', 'csv')
+
+# The columns written by export, in order
+FIELDS = ('chatid', 'messageid', 'posttime', 'sender', 'recipient', 'message')
+
+class TranscriptMessage(object):
+    """One message in a chat's transcript. Messages sent by the
+    visitor have a queue of 'localmessagequeue', and messages sent to
+    them 'remotemessagequeue'."""
+
+    def __init__(self, chatid, queue, messageid, posttime, sender, recipient, message):
+        self.chatid = chatid
+        self.queue = queue
+        self.messageid = messageid
+        self.posttime = posttime
+        self.sender = sender
+        self.recipient = recipient
+        self.message = message
+
+class Transcript(object):
+    """The messages exchanged in one chat, oldest first"""
+
+    def __init__(self, storage, chatinfo, pagesize=PAGESIZE):
+        """Prepare to read the chat described by the ChatInfo from the
+        Backend, pagesize messages per page"""
+        self.storage = storage
+        self.chatinfo = chatinfo
+        self.pagesize = pagesize
+
+    def __iter__(self):
+        """Yield every TranscriptMessage in the chat, reading one page
+        at a time"""
+        after = None
+        while True:
+            messages, after = self.getpage(after)
+            if not messages:
+                return
+            for message in messages:
+                yield message
+
+    def getpage(self, after=None, limit=None):
+        """Return a (possibly empty) list of up to limit (or pagesize)
+        TranscriptMessages in the order they were posted, and the value
+        to pass as after to get the next page. None starts from the
+        beginning."""
+        if limit is None:
+            limit = self.pagesize
+        lastmessageids = dict(zip(('localmessagequeue', 'remotemessagequeue'), after or (0, 0)))
+        rows = []
+        for queue, lastmessageid in lastmessageids.items():
+            rows.extend((posttime, queue, messageid, message)
+                        for messageid, posttime, message in self.storage._getmessagessince(self.chatinfo.chatid, queue, lastmessageid, limit))
+        # Each queue's rows are in order, so the first limit of them
+        # together are too, and nothing left out belongs before them
+        rows.sort()
+        messages = []
+        for posttime, queue, messageid, message in rows[:limit]:
+            lastmessageids[queue] = messageid
+            if queue == 'localmessagequeue':
+                sender, recipient = self.chatinfo.remoteuser, self.chatinfo.localuser
+            else:
+                sender, recipient = self.chatinfo.localuser, self.chatinfo.remoteuser
+            messages.append(TranscriptMessage(self.chatinfo.chatid, queue, messageid, posttime, sender, recipient, message))
+        return messages, (lastmessageids['localmessagequeue'], lastmessageids['remotemessagequeue'])
+
+def export(storage, format='jsonl', startedafter=None, startedbefore=None, pagesize=PAGESIZE):
+    """Yield every message in the chats started at or after
+    startedafter and before startedbefore (Unix times, or None for no
+    limit), one line at a time, as UTF-8 encoded JSON objects or CSV
+    rows with the FIELDS as columns. CSV output starts with a header
+    line."""
+    if format not in FORMATS:
+        raise ValueError('The export format must be one of %s, not %s' % (', '.join(FORMATS), format))
+    if format == 'csv':
+        buffer = cStringIO.StringIO()
+        writer = csv.writer(buffer)
+        def formatrow(row):
+            writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value for value in row])
+            line = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return line
+        yield formatrow(FIELDS)
+    else:
+        def formatrow(row):
+            return json.dumps(dict(zip(FIELDS, row)), sort_keys=True) + '\n'
+    for chatinfo in iterchats(storage, startedafter, startedbefore, pagesize):
+        for message in Transcript(storage, chatinfo, pagesize):
+            yield formatrow([getattr(message, field) for field in FIELDS])
+
+def gettranscript(storage, chatid, pagesize=PAGESIZE):
+    """Return the Transcript of a live or archived chat, or None if it
+    doesn't exist"""
+    chats = storage._getchatssince(chatid - 1, 1)
+    if not chats or chats[0].chatid != chatid:
+        return None
+    return Transcript(storage, chats[0], pagesize)
+
+def iterchats(storage, startedafter=None, startedbefore=None, pagesize=PAGESIZE):
+    """Yield the ChatInfo of every live or archived chat started at or
+    after startedafter and before startedbefore, in chatid order,
+    reading pagesize of them at a time"""
+    lastchatid = 0
+    while True:
+        chats = storage._getchatssince(lastchatid, pagesize, startedafter, startedbefore)
+        if not chats:
+            return
+        for chatinfo in chats:
+            yield chatinfo
+        lastchatid = chats[-1].chatid
+
+def main(argv=None):
+    """Export the transcripts from the database named in a
+    configuration (.ini) file's section"""
+    import ConfigParser
+
+    parser = optparse.OptionParser(usage='%prog [options] configfile section')
+    parser.add_option('--format', default='jsonl', choices=FORMATS, help='output format [%default]')
+    parser.add_option('--since', metavar='YYYY-MM-DD', help='only chats started on or after this day (UTC)')
+    parser.add_option('--until', metavar='YYYY-MM-DD', help='only chats started before this day (UTC)')
+    parser.add_option('-o', '--output', help='file to write the transcripts to [standard output]')
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('You must give a config file and section name')
+
+    logging.basicConfig()
+    config = ConfigParser.ConfigParser()
+    config.read(args[0])
+    settings = dict(config.items(args[1]))
+    storage = backend.getbackend(settings)
+    # Include the archive if the broker bot keeps one
+    if backend.getsetting(settings, 'retentiondays') is not None or backend.getsetting(settings, 'archivedb') is not None:
+        storage._attacharchive(retention.getarchivedb(storage, backend.getsetting(settings, 'archivedb')))
+    startedafter, startedbefore = [calendar.timegm(time.strptime(day, '%Y-%m-%d')) if day is not None else None
+                                   for day in (options.since, options.until)]
+    if options.output is None:
+        outfile = sys.stdout
+    else:
+        outfile = open(options.output, 'wb')
+    try:
+        for line in export(storage, options.format, startedafter, startedbefore):
+            outfile.write(line)
+    finally:
+        if outfile is not sys.stdout:
+            outfile.close()
+
+if __name__ == '__main__':
+    main()